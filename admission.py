@@ -0,0 +1,105 @@
+"""Admission control for the webhooks.
+
+Turns are answered by a fixed number of dispatcher threads (see shards.py), so
+the turns being answered at once are already bounded. What can still grow
+without bound is the queue of turns waiting for them. When a spike queues more
+turns than the workers can answer quickly, every learner waits. It is better
+to turn a few messages away and answer the rest on time.
+
+A message is shed when the queue holds ADMISSION_MAX_QUEUED turns, or when
+the sender already has ADMISSION_MAX_USER_QUEUED turns waiting. The last
+ADMISSION_RESERVED share of the queue is kept for commands and first
+contacts, so /reset and new learners get through a backlog of ordinary
+messages. Shed messages are answered with 503 so that the Graph API delivers
+them again later. Status callbacks carry no turn and are acknowledged without
+being parsed while the queue is over its soft limit.
+"""
+from os import environ
+from threading import Lock
+import time
+from typing import Optional
+
+from db import Turn
+from metrics import registry
+from shards import shard_of, shard_queue
+
+ADMISSION_MAX_QUEUED = int(environ.get("ADMISSION_MAX_QUEUED", 500))
+ADMISSION_MAX_USER_QUEUED = int(environ.get("ADMISSION_MAX_USER_QUEUED", 3))
+ADMISSION_RESERVED = float(environ.get("ADMISSION_RESERVED", 0.2))
+# seconds the queue length is reused for before it is counted again
+ADMISSION_REFRESH = float(environ.get("ADMISSION_REFRESH", 0.25))
+ADMISSION_RETRY_AFTER = int(environ.get("ADMISSION_RETRY_AFTER", 30))
+
+HIGH = "high"
+NORMAL = "normal"
+STATUS = "status"
+
+DECISIONS = registry.counter(
+    "gringolingo_admission_total", "Webhooks admitted or shed, by priority and reason"
+)
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        max_queued: int = ADMISSION_MAX_QUEUED,
+        max_user_queued: int = ADMISSION_MAX_USER_QUEUED,
+        reserved: float = ADMISSION_RESERVED,
+        refresh: float = ADMISSION_REFRESH,
+    ):
+        self.max_queued = max_queued
+        self.max_user_queued = max_user_queued
+        # ordinary messages are shed once the queue reaches this, commands and first contacts later
+        self.soft_limit = int(max_queued * (1 - reserved))
+        self.refresh = refresh
+
+        self._queued = 0
+        self._counted_at = float("-inf")
+        self._lock = Lock()
+
+    def queued(self) -> int:
+        """Turns waiting in all shards, counted at most every `refresh` seconds."""
+        with self._lock:
+            if time.monotonic() - self._counted_at >= self.refresh:
+                self._queued = Turn.count_pending()
+                self._counted_at = time.monotonic()
+            return self._queued
+
+    def overloaded(self) -> bool:
+        return self.queued() >= self.soft_limit
+
+    def admit(self, key: Optional[str], priority: str) -> bool:
+        """Decides whether a webhook is handled, counting the decision.
+
+        Args:
+            key: conversation key of the sender, None for status callbacks
+            priority: HIGH for commands and first contacts, NORMAL for other messages or STATUS
+
+        Returns:
+            bool: False if the webhook should be shed
+        """
+        reason = self._shed_reason(key, priority)
+        with self._lock:
+            if reason is None:
+                # counted as queued until the next refresh, so a burst cannot overshoot the limits
+                self._queued += priority != STATUS
+        DECISIONS.inc(priority=priority, decision="shed" if reason else "admitted", reason=reason or "")
+        return reason is None
+
+    def _shed_reason(self, key: Optional[str], priority: str) -> Optional[str]:
+        queued = self.queued()
+        if priority == STATUS:
+            return "overloaded" if queued >= self.soft_limit else None
+        if queued >= (self.max_queued if priority == HIGH else self.soft_limit):
+            return "queue_full"
+        if priority == NORMAL and Turn.count_pending([shard_of(key, shard_queue.count)], key) >= self.max_user_queued:
+            return "user_queue_full"
+        return None
+
+
+admission = AdmissionController()
+
+registry.collect(
+    "gringolingo_turns_queued", "Turns waiting or being answered in the shards of each worker, summed over workers",
+    lambda: {(): Turn.count_pending(shard_queue.held())},
+)
@@ -1,12 +1,24 @@
 import logging
 import pathlib
-import openai
+import time
 
-import requests
-from heyoo import WhatsApp
 from os import environ
-from flask import Flask, request, make_response
-from bot import STARTER_PROMPT, get_response, get_starter, trim_conversation
+from flask import Flask, Response, g, request, make_response
+from admission import ADMISSION_RETRY_AFTER, HIGH, NORMAL, STATUS, admission
+from bot import get_response
+from cache import conversation_cache
+from db import OutboxMessage, User, init_db
+import facebook
+import logs
+from logs import Truncated, log_payload
+from media import MediaQueue
+from metrics import REQUEST_SECONDS, REQUESTS, registry, span
+from outbox import DeliveryError, outbox
+from profiling import HEADER, profiler, verify
+from shards import shard_of, shard_queue
+from statuses import status_tracker
+from tenants import tenant_registry
+from transcribe import BACKENDS, TRANSCRIBE_BACKEND, VoicePipeline
 
 # load from .env file if it exists
 if pathlib.Path(".env").exists():
@@ -14,14 +26,97 @@ if pathlib.Path(".env").exists():
 
     load_dotenv()
 
-messenger = WhatsApp(environ.get("TOKEN"), phone_number_id=environ.get("PHONE_NUMBER_ID")) #this should be writen as 
-#WhatsApp(token = "inpust accesstoken", phone_number_id="input phone number id") #messages are not recieved without this pattern
+logs.configure()
+
+media_queue = MediaQueue()
+
+# turns are answered by the worker holding the learner's shard, one at a time, see shards.py
+def reply_to(key: str, channel: str, tenant: str, recipient: str, turn_id: int) -> dict:
+    # where the outbox delivers the reply to a turn
+    return {
+        "shard": shard_of(key, shard_queue.count),
+        "channel": channel,
+        "tenant": tenant,
+        "recipient": recipient,
+        "turn_id": turn_id,
+    }
+
+def answer_whatsapp(key: str, turn: dict, turn_id: int) -> None:
+    if OutboxMessage.answered(turn_id):
+        # answered before the worker died, the outbox still delivers the reply
+        return
+    tenant = tenant_registry.get("whatsapp", turn["tenant"])
+    if tenant is None:
+        logging.error("No WhatsApp number %s to answer %s", turn["tenant"], key)
+        return
+    get_response(
+        key, turn["text"], tenant.language, tenant.prompt,
+        reply_to=reply_to(key, "whatsapp", tenant.id, turn["mobile"], turn_id),
+    )
+    outbox.notify()
+
+def answer_voice(key: str, turn: dict, turn_id: int) -> None:
+    # voice notes are answered like text, so learners can practice speaking
+    if "tenant" not in turn:
+        # stored before voice turns carried their number
+        tenant, mobile = tenant_registry.split_key(key)
+        if tenant is None or tenant.channel != "whatsapp":
+            logging.error("No WhatsApp number to answer the voice note of %s", key)
+            return
+        turn = {"tenant": tenant.id, "mobile": mobile, "text": turn["text"]}
+    answer_whatsapp(key, turn, turn_id)
+
+def answer_messenger(key: str, turn: dict, turn_id: int) -> None:
+    if OutboxMessage.answered(turn_id):
+        return
+    page = tenant_registry.get("messenger", turn["page"])
+    if page is None:
+        logging.error("No Messenger page %s to answer %s", turn["page"], key)
+        return
+    # chat history is kept locally, Graph API is only read once to backfill it
+    if User.get_id(key) is None:
+        with span("backfill"):
+            facebook.backfill_history(
+                turn["sender"], skip_message_id=turn["mid"], key=key, page_id=page.id, access_token=page.token
+            )
+    get_response(
+        key, turn["text"], page.language, page.prompt,
+        reply_to=reply_to(key, "messenger", page.id, turn["sender"], turn_id),
+    )
+    outbox.notify()
+
+def send_whatsapp(tenant_id: str, recipient: str, content: str) -> str:
+    result = tenant_registry.get("whatsapp", tenant_id).client.send_message(content, recipient)
+    if "messages" not in result:
+        raise DeliveryError(result.get("error", result))
+    return result["messages"][0]["id"]
+
+def send_messenger(page_id: str, recipient: str, content: str) -> str:
+    page = tenant_registry.get("messenger", page_id)
+    result = facebook.send_message(recipient, content, page_id=page.id, access_token=page.token)
+    if "message_id" not in result:
+        raise DeliveryError(result.get("error", result))
+    return result["message_id"]
+
+outbox.add_sender("whatsapp", send_whatsapp)
+outbox.add_sender("messenger", send_messenger)
+shard_queue.add_handler("whatsapp", answer_whatsapp)
+shard_queue.add_handler("voice", answer_voice)
+shard_queue.add_handler("messenger", answer_messenger)
+
+if BACKENDS[TRANSCRIBE_BACKEND].available():
+    pipeline = VoicePipeline(
+        lambda key, transcript, context: shard_queue.submit(
+            key, "voice", {"tenant": context["tenant"], "mobile": context["mobile"], "text": transcript}
+        )
+    )
+    media_queue.add_handler("audio", pipeline.submit)
+else:
+    logging.warning("Transcription backend %s is not installed, voice messages will not be answered", TRANSCRIBE_BACKEND)
 
 # Here's an article on how to get the application secret from Facebook developers portal.
 # https://support.appmachine.com/support/solutions/articles/80000978442
 VERIFY_TOKEN = environ.get("APP_SECRET") #application secret here
-MESSENGER_API_KEY = environ.get("MESSENGER_API_KEY") #messenger api key here
-MESSENGER_PAGE_ID = "109100192122534" # environ.get("MESSENGER_PAGE_ID") #messenger page id here
 
 #to be tested in prod environment
 # messenger = WhatsApp(os.getenv("heroku whatsapp token"),phone_number_id='105582068896304')
@@ -29,13 +124,54 @@ MESSENGER_PAGE_ID = "109100192122534" # environ.get("MESSENGER_PAGE_ID") #messen
 
 MESSENGER_VERIFY_TOKEN = "strawberry ice cream"
 
-# Logging
-logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+app = Flask(__name__)
+
+registry.collect(
+    "gringolingo_conversation_cache_users", "Users whose conversation is cached",
+    lambda: {(): conversation_cache.stats()["users"]},
+)
+registry.collect(
+    "gringolingo_conversation_cache_bytes", "Message content held by the conversation cache",
+    lambda: {(): conversation_cache.stats()["bytes"]},
+)
+registry.collect(
+    "gringolingo_conversation_cache_lookups_total", "Conversation cache lookups, by result",
+    lambda: {(("result", "hit"),): conversation_cache.hits, (("result", "miss"),): conversation_cache.misses},
+    type="counter",
+)
+registry.collect(
+    "gringolingo_conversation_cache_evictions_total", "Conversations evicted from the cache",
+    lambda: {(): conversation_cache.evictions},
+    type="counter",
 )
 
-app = Flask(__name__)
+def priority(key: str, text: str = None) -> str:
+    # commands and first contacts are admitted when the queue is too long for ordinary messages
+    if (text or "").startswith("/") or User.get_id(key) is None:
+        return HIGH
+    return NORMAL
+
+def shed():
+    # the Graph API delivers the webhook again later
+    response = make_response("Busy, try again later", 503)
+    response.headers["Retry-After"] = str(ADMISSION_RETRY_AFTER)
+    return response
+
+def is_status_callback(body: bytes) -> bool:
+    # delivery and read statuses, inbound messages always come with contacts
+    return b'"statuses"' in body and b'"contacts"' not in body
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+    registry.start_flushing()
 
+@app.after_request
+def record_request(response):
+    endpoint = request.endpoint or "unknown"
+    REQUEST_SECONDS.observe(time.perf_counter() - g.started, endpoint=endpoint)
+    REQUESTS.inc(endpoint=endpoint, status=str(response.status_code))
+    return response
 
 
 @app.route('/')
@@ -43,7 +179,27 @@ def index():
     return "Hello, It Works"
 
 
+@app.route("/stats")
+def stats():
+    return {"conversation_cache": conversation_cache.stats()}
+
+
+@app.route("/metrics")
+def metrics():
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/profile", methods=["POST"])
+def profile():
+    # opens a profiling window on every worker, see profiling.py
+    if not profiler.secret or not verify(request.headers.get(HEADER, ""), profiler.secret):
+        return "Invalid profiling token", 403
+    seconds = min(float(request.args.get("seconds", 60)), 3600)
+    return {"until": profiler.open_window(seconds)}
+
+
 @app.route("/messenger", methods=["GET", "POST"])
+@profiler.wrap
 def messenger_hook():
     # hook for facebook messenger
     if request.method == "GET":
@@ -56,86 +212,48 @@ def messenger_hook():
         return "Invalid verification token"
     
     # Handle Webhook Subscriptions
-    data = request.get_json()
-    logging.info("Received webhook data: %s", data)
-
-    # get most recent message
-    user_messages = sorted(
-        [message for message in data["entry"][0]["messaging"] if "message" in message],
-        key=lambda message: message["timestamp"],
-    )
+    with span("parse"):
+        data = request.get_json()
+        log_payload("Received webhook data", data)
+
+        page = tenant_registry.for_messenger_webhook(data)
+        if page is None:
+            logging.warning("Messenger: Ignoring webhook for an unknown page")
+            return "ok"
+
+        # get most recent message
+        events = sorted(
+            [event for event in data["entry"][0]["messaging"] if "message" in event],
+            key=lambda event: event["timestamp"],
+        )
     try:
-        user_message = user_messages[-1]["message"]
+        event = events[-1]
     except IndexError:
         logging.error("Messenger: No message found")
         return "ok"
 
-    user_id = user_message["from"]["id"]
-    if user_id == MESSENGER_PAGE_ID:
+    sender_id = event["sender"]["id"]
+    if sender_id == page.id:
         # ignore messages from the page itself
         logging.info("Messenger: Ignoring message from page")
         return "ok"
 
-    # get chat history
-    res = requests.get(
-        f"https://graph.facebook.com/v16.0/{MESSENGER_PAGE_ID}", 
-        params={
-            "access_token": MESSENGER_API_KEY,
-            "fields": "conversations{participants,id,messages{message,from}}",
-            "user_id": user_id
-        }
-    )
-
-    logging.info(f"Made request to {res.url}")
-    chat_history = res.json()
-    # logging.info("Messenger: Chat history: %s", chat_history)
-
-    try:
-        conversation = chat_history["conversations"]["data"][0]
-    except IndexError:
-        logging.error("Messenger: No conversation found")
+    user_message = event["message"].get("text")
+    if not user_message:
+        logging.info("Messenger: Ignoring message without text")
         return "ok"
-    
-    openai_messages = []
-    num_bot_responses = 0
-    for message in conversation["messages"]["data"][::-1]:
-        if "message" in message:
-            if message["message"] == "/reset":
-                break
-            role = "user" if message["from"]["id"] == user_id else "assistant"
-            openai_messages.insert(0, {"role": role, "content": message["message"]})
-            if role == "assistant":
-                num_bot_responses += 1
-
-    logging.info("Messenger: OpenAI messages: %s", openai_messages)
-    if num_bot_responses == 0:
-        bot_message = get_starter()
-    else:
-        # get response from openai
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages = [
-                {"role": "system", "content": STARTER_PROMPT},
-                *trim_conversation(openai_messages, 3000)
-            ]
-        )
-        bot_message = response.choices[0]["message"]["content"]
-
-    # send message to facebook
-    res = requests.post(
-        f"https://graph.facebook.com/v16.0/{MESSENGER_PAGE_ID}/messages",
-        params={
-            "access_token": MESSENGER_API_KEY
-        },
-        json={
-            "recipient": {"id": sender_id},
-            "message": {"text": bot_message}
-        }
-    )
 
+    key = page.conversation_key(sender_id)
+    if not admission.admit(key, priority(key, user_message)):
+        return shed()
+    with span("shard_submit"):
+        shard_queue.submit(
+            key, "messenger", {"page": page.id, "sender": sender_id, "text": user_message, "mid": event["message"].get("mid")}
+        )
     return "ok"
 
 @app.route("/whatsapi", methods=["GET", "POST"])
+@profiler.wrap
 def hook():
     if request.method == "GET":
         if request.args.get("hub.verify_token") == VERIFY_TOKEN:
@@ -147,33 +265,49 @@ def hook():
         return "Invalid verification token"
 
     # Handle Webhook Subscriptions
-    data = request.get_json()
-    logging.info("Received webhook data: %s", data)
-    changed_field = messenger.changed_field(data)
+    with span("parse"):
+        body = request.get_data()
+        if is_status_callback(body):
+            # acknowledged unparsed, the tracker parses them in batches, see statuses.py;
+            # while turns are backing up they are not even recorded
+            if admission.admit(None, STATUS):
+                status_tracker.add(body)
+            return "ok"
+        data = request.get_json()
+        log_payload("Received webhook data", data)
+        tenant = tenant_registry.for_whatsapp_webhook(data)
+        if tenant is None:
+            logging.warning("Ignoring webhook for an unknown phone number")
+            return "ok"
+        messenger = tenant.client
+        changed_field = messenger.changed_field(data)
     if changed_field == "messages":
         new_message = messenger.get_mobile(data)
         if new_message:
             mobile = messenger.get_mobile(data)
-            name = messenger.get_name(data)
+            key = tenant.conversation_key(mobile)
             message_type = messenger.get_message_type(data)
-            logging.info(
-                f"New Message; sender:{mobile} name:{name} type:{message_type}"
-            )
+            logging.info("New message", extra={"tenant": tenant.name, "sender": mobile, "type": message_type})
+
+            message = messenger.get_message(data) if message_type == "text" else None
+            if message_type in ("text", "image", "video", "audio", "document") and not admission.admit(
+                key, priority(key, message)
+            ):
+                return shed()
 
-            messenger.mark_as_read(messenger.get_message_id(data))
+            with span("mark_as_read"):
+                messenger.mark_as_read(messenger.get_message_id(data))
             if message_type == "text":
-                message = messenger.get_message(data)
-                name = messenger.get_name(data)
-                logging.info("Message: %s", message)
-                response = get_response(mobile, message)
-                messenger.send_message(response, mobile)
+                logging.debug("Message: %s", Truncated(message))
+                with span("shard_submit"):
+                    shard_queue.submit(key, "whatsapp", {"tenant": tenant.id, "mobile": mobile, "text": message})
 
             elif message_type == "interactive":
                 message_response = messenger.get_interactive_response(data)
                 intractive_type = message_response.get("type")
                 message_id = message_response[intractive_type]["id"]
                 message_text = message_response[intractive_type]["title"]
-                logging.info(f"Interactive Message; {message_id}: {message_text}")
+                logging.info("Interactive message", extra={"sender": mobile, "id": message_id, "title": Truncated(message_text)})
 
             elif message_type == "location":
                 message_location = messenger.get_location(data)
@@ -181,48 +315,22 @@ def hook():
                 message_longitude = message_location["longitude"]
                 logging.info("Location: %s, %s", message_latitude, message_longitude)
 
-            elif message_type == "image":
-                image = messenger.get_image(data)
-                image_id, mime_type = image["id"], image["mime_type"]
-                image_url = messenger.query_media_url(image_id)
-                image_filename = messenger.download_media(image_url, mime_type)
-                print(f"{mobile} sent image {image_filename}")
-                logging.info(f"{mobile} sent image {image_filename}")
-
-            elif message_type == "video":
-                video = messenger.get_video(data)
-                video_id, mime_type = video["id"], video["mime_type"]
-                video_url = messenger.query_media_url(video_id)
-                video_filename = messenger.download_media(video_url, mime_type)
-                print(f"{mobile} sent video {video_filename}")
-                logging.info(f"{mobile} sent video {video_filename}")
-
-            elif message_type == "audio":
-                audio = messenger.get_audio(data)
-                audio_id, mime_type = audio["id"], audio["mime_type"]
-                audio_url = messenger.query_media_url(audio_id)
-                audio_filename = messenger.download_media(audio_url, mime_type)
-                print(f"{mobile} sent audio {audio_filename}")
-                logging.info(f"{mobile} sent audio {audio_filename}")
-
-            elif message_type == "document":
-                file = messenger.get_document(data)
-                file_id, mime_type = file["id"], file["mime_type"]
-                file_url = messenger.query_media_url(file_id)
-                file_filename = messenger.download_media(file_url, mime_type)
-                print(f"{mobile} sent file {file_filename}")
-                logging.info(f"{mobile} sent file {file_filename}")
+            elif message_type in ("image", "video", "audio", "document"):
+                # downloaded in the background so large media never holds up the webhook
+                with span("media_submit"):
+                    media_queue.submit(
+                        key, message_type, messenger.get_media(data), client=messenger,
+                        context={"tenant": tenant.id, "mobile": mobile, "language": tenant.transcribe_language},
+                    )
+
             else:
-                print(f"{mobile} sent {message_type} ")
-                print(data)
+                logging.info("Unhandled message", extra={"sender": mobile, "type": message_type})
         else:
-            delivery = messenger.get_delivery(data)
-            if delivery:
-                print(f"Message : {delivery}")
-            else:
-                print("No new message")
+            logging.debug("No new message")
     return "ok"
 
 
 if __name__ == '__main__': 
+    # under gunicorn, done by the hooks in gunicorn.conf.py
+    init_db()
     app.run(debug=True)
@@ -0,0 +1,140 @@
+"""Moves old messages out of the live messages table into compressed archive chunks.
+
+Run periodically, e.g. from the Heroku Scheduler:
+
+    python archive.py --older-than-days 90 --closed-sessions
+"""
+import argparse
+from datetime import datetime, timedelta
+from itertools import groupby
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, select
+
+from db import ArchivedMessages, Message, MessageType, OutboxMessage, OutboxStatus, Session, init_db
+
+
+def last_resets() -> Dict[int, datetime]:
+    """Returns the time of each user's most recent /reset, read once per run."""
+    with Session() as session:
+        return dict(
+            session.query(Message.user_id, func.max(Message.timestamp))
+            .filter(Message.message_type == MessageType.bot_command_message)
+            .filter(Message.content == "/reset")
+            .group_by(Message.user_id)
+            .all()
+        )
+
+
+def archive_batch(before: datetime, batch_size: int = 1000, user_id: Optional[int] = None) -> int:
+    """Archives at most `batch_size` messages in a single short transaction.
+
+    Args:
+        before: archive messages sent before this time
+        batch_size: maximum number of messages moved by this batch
+        user_id: only archive this user's messages, found through ix_messages_user_timestamp
+
+    Returns:
+        int: The number of messages archived
+    """
+    # replies the outbox still has to deliver, it reads their content from the messages table
+    undelivered = select(OutboxMessage.id).where(
+        OutboxMessage.message_id == Message.id, OutboxMessage.status == OutboxStatus.pending
+    ).exists()
+    with Session() as session:
+        query = session.query(Message).filter(Message.timestamp < before).filter(~undelivered)
+        if user_id is not None:
+            query = query.filter(Message.user_id == user_id).order_by(Message.timestamp, Message.id)
+        else:
+            query = query.order_by(Message.id.asc())
+        messages = query.limit(batch_size).all()
+        if not messages:
+            return 0
+
+        messages.sort(key=lambda message: (message.user_id, message.timestamp, message.id))
+        for chunk_user_id, chunk in groupby(messages, key=lambda message: message.user_id):
+            chunk = list(chunk)
+            session.add(
+                ArchivedMessages(
+                    user_id=chunk_user_id,
+                    first_timestamp=chunk[0].timestamp,
+                    last_timestamp=chunk[-1].timestamp,
+                    count=len(chunk),
+                    payload=ArchivedMessages.pack(chunk),
+                )
+            )
+        session.query(Message).filter(Message.id.in_([message.id for message in messages])).delete(
+            synchronize_session=False
+        )
+        session.commit()
+        return len(messages)
+
+
+def archive(
+    older_than: Optional[datetime] = None,
+    closed_sessions: bool = False,
+    batch_size: int = 1000,
+    max_batches: Optional[int] = None,
+    pause: float = 0.1,
+) -> int:
+    """Archives messages in bounded batches, pausing between batches so live traffic can write.
+
+    Args:
+        older_than: archive messages sent before this time
+        closed_sessions: archive messages sent before each user's most recent /reset, one user at a time
+    """
+    # (before, user_id) of each pass, every user with a reset and then everyone else
+    passes: List[Tuple[datetime, Optional[int]]] = []
+    if closed_sessions:
+        for user_id, last_reset in last_resets().items():
+            passes.append((last_reset if older_than is None else max(last_reset, older_than), user_id))
+    if older_than is not None:
+        passes.append((older_than, None))
+
+    total = 0
+    batches = 0
+    # most users archive less than a batch, pause once per batch_size messages rather than per user
+    since_pause = 0
+    for before, user_id in passes:
+        while max_batches is None or batches < max_batches:
+            archived = archive_batch(before, batch_size, user_id)
+            if archived == 0:
+                break
+            total += archived
+            batches += 1
+            since_pause += archived
+            if since_pause >= batch_size:
+                logging.info("Archived %d messages", total)
+                time.sleep(pause)
+                since_pause = 0
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive old messages out of the live messages table.")
+    parser.add_argument("--older-than-days", type=float, help="archive messages older than this many days")
+    parser.add_argument(
+        "--closed-sessions", action="store_true", help="archive messages sent before each user's last /reset"
+    )
+    parser.add_argument("--batch-size", type=int, default=1000, help="messages moved per transaction")
+    parser.add_argument("--max-batches", type=int, help="stop after this many transactions")
+    parser.add_argument("--pause", type=float, default=0.1, help="seconds to sleep between batches")
+    args = parser.parse_args()
+
+    if args.older_than_days is None and not args.closed_sessions:
+        parser.error("one of --older-than-days or --closed-sessions is required")
+
+    older_than = None
+    if args.older_than_days is not None:
+        older_than = datetime.now() - timedelta(days=args.older_than_days)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    init_db()
+    total = archive(older_than, args.closed_sessions, args.batch_size, args.max_batches, args.pause)
+    logging.info("Done, archived %d messages", total)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+"""Benchmarks for the bot. Run each module with `python -m benchmarks.<name> --help`."""
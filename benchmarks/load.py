@@ -0,0 +1,195 @@
+"""End-to-end load test of the /whatsapi webhook.
+
+Runs the app under gunicorn against the local Graph API and OpenAI simulator,
+sends a mix of realistic webhook payloads at a fixed concurrency and reports
+throughput plus p50/p95/p99 latency for each payload kind and for each
+external call the app made. Webhooks return once their turn is stored, the
+report waits until the workers have answered every turn.
+
+    python -m benchmarks.load --requests 2000 --concurrency 32 --workers 4 --openai-latency lognormal:800,0.4
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+import os
+import pathlib
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from threading import Lock, local
+import time
+from typing import Dict, List, Optional, Tuple
+
+import requests
+
+from benchmarks import payloads
+from benchmarks.stats import summarize
+from benchmarks.simulator import add_arguments, from_arguments
+
+REPO = pathlib.Path(__file__).resolve().parent.parent
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def app_env(simulator_url: str, directory: str) -> Dict[str, str]:
+    """Environment of an app talking to the simulator, keeping its database and media in `directory`."""
+    return dict(
+        os.environ,
+        OPENAI_API_KEY="stub",
+        OPENAI_API_BASE=f"{simulator_url}/v1",
+        GRAPH_API_URL=simulator_url,
+        TOKEN="stub",
+        PHONE_NUMBER_ID=payloads.PHONE_NUMBER_ID,
+        APP_SECRET="stub",
+        TRANSCRIBE_BACKEND="fake",
+        MEDIA_DIR=os.path.join(directory, "media"),
+    )
+
+
+def start_app(
+    simulator_url: str, port: int, workers: int, worker_class: str, threads: int, directory: str,
+    env: Optional[Dict[str, str]] = None,
+) -> subprocess.Popen:
+    """Starts the app under gunicorn in `directory`, which holds its database and media."""
+    env = dict(app_env(simulator_url, directory), WORKER_CLASS=worker_class, **(env or {}))
+    command = [
+        sys.executable, "-m", "gunicorn", "app:app",
+        "--pythonpath", str(REPO),
+        "--config", str(REPO / "gunicorn.conf.py"),
+        "--bind", f"127.0.0.1:{port}",
+        "--workers", str(workers),
+        "--worker-class", worker_class,
+        "--threads", str(threads),
+        "--log-level", "warning",
+    ]
+    return subprocess.Popen(command, cwd=directory, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_until_ready(url: str, process: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("gunicorn exited during startup, run the app by hand to see why")
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            # the socket is bound before the workers have imported the app
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f"{url} did not come up within {timeout} seconds")
+
+
+def wait_until_answered(database: str, timeout: float = 600) -> float:
+    """Waits until no turns are left in the app's database, returns how long that took."""
+    started = time.monotonic()
+    while time.monotonic() - started < timeout:
+        with sqlite3.connect(database) as connection:
+            if connection.execute("SELECT COUNT(*) FROM turns").fetchone()[0] == 0:
+                return time.monotonic() - started
+        time.sleep(0.1)
+    raise TimeoutError(f"Turns were not answered within {timeout} seconds")
+
+
+def drive(
+    url: str, total: int, concurrency: int, users: int, mix: Dict[str, float]
+) -> Tuple[float, Dict[str, List[float]], Dict[str, int]]:
+    """Posts `total` webhooks with `concurrency` clients.
+
+    Returns:
+        The wall time, latencies in seconds per payload kind and error counts per kind
+    """
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    lock = Lock()
+    sessions = local()
+
+    def send(_):
+        if not hasattr(sessions, "session"):
+            sessions.session = requests.Session()
+        kind, payload = payloads.generate(users, mix)
+        started = time.perf_counter()
+        try:
+            ok = sessions.session.post(url, json=payload, timeout=120).status_code == 200
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies[kind].append(elapsed)
+            if not ok:
+                errors[kind] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(send, range(total)))
+    return time.perf_counter() - started, latencies, errors
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    mix = {}
+    for item in spec.split(","):
+        kind, _, weight = item.partition("=")
+        if kind not in payloads.GENERATORS:
+            raise argparse.ArgumentTypeError(f"Unknown payload kind {kind}")
+        mix[kind] = float(weight)
+    return mix
+
+
+def report(
+    wall: float, answered: float, latencies: Dict[str, List[float]], errors: Dict[str, int], stages: Dict[str, Dict]
+) -> None:
+    total = sum(len(values) for values in latencies.values())
+    print(f"{total} requests in {wall:.1f}s, {total / wall:.1f} requests/s, all turns answered {answered:.1f}s later")
+    print(f"{'stage':<24} {'count':>7} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    # errors of external calls are the faults the simulator injected
+    rows = [(f"webhook:{kind}", summarize(values), errors.get(kind, 0)) for kind, values in sorted(latencies.items())]
+    rows.append(("webhook:all", summarize([value for values in latencies.values() for value in values]), sum(errors.values())))
+    rows += [(stage, summary, summary["faults"]) for stage, summary in stages.items()]
+    for stage, summary, error_count in rows:
+        print(
+            f"{stage:<24} {summary['count']:>7} {error_count:>7} {summary['p50'] * 1000:>9.1f} "
+            f"{summary['p95'] * 1000:>9.1f} {summary['p99'] * 1000:>9.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=1000, help="webhooks to send")
+    parser.add_argument("--warmup", type=int, default=20, help="webhooks sent before measuring")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent clients")
+    parser.add_argument("--users", type=int, default=500, help="distinct learners sending messages")
+    parser.add_argument("--mix", type=parse_mix, default=payloads.MIX, help="e.g. text=0.3,interactive=0.05,media=0.05,status=0.6")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--worker-class", default="sync", help="gunicorn worker class")
+    parser.add_argument("--threads", type=int, default=1, help="threads per gunicorn worker")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    simulator = from_arguments(args).start()
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory(prefix="load-") as directory:
+        app = start_app(simulator.url, port, args.workers, args.worker_class, args.threads, directory)
+        try:
+            wait_until_ready(url, app)
+            database = os.path.join(directory, "example.db")
+            drive(f"{url}/whatsapi", args.warmup, min(args.concurrency, args.warmup), args.users, args.mix)
+            wait_until_answered(database)
+            simulator.reset()
+            wall, latencies, errors = drive(f"{url}/whatsapi", args.requests, args.concurrency, args.users, args.mix)
+            answered = wait_until_answered(database)
+            report(wall, answered, latencies, errors, simulator.stats())
+        finally:
+            app.terminate()
+            app.wait()
+            simulator.shutdown()
+
+
+if __name__ == "__main__":
+    main()
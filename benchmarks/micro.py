@@ -0,0 +1,216 @@
+"""Microbenchmarks of the functions every turn goes through.
+
+Seeds a database with synthetic users and messages (reused between runs with
+the same size), then times the token counter, conversation trimming,
+`get_response` with a canned completion, message writes and reads and the
+heyoo webhook getters. Every run is appended to a results file together with
+the commit it ran on, so runs on different commits can be compared. Without
+network access to download tiktoken's vocabulary, tokens are counted by a
+stand-in of similar cost and results are only compared with other such runs:
+
+    python -m benchmarks.micro --rows 1000000 --users 10000
+    python -m benchmarks.micro --rows 1000000 --users 10000 --compare HEAD~3
+"""
+import argparse
+from datetime import datetime
+import json
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List
+
+from benchmarks import payloads
+from benchmarks.schema import build, phone_id
+
+RESULTS = os.path.join(".benchmarks", "micro.jsonl")
+
+
+def seed(directory: str, rows: int, users: int, threshold: int) -> str:
+    """Returns the path of a database holding `rows` messages of `users` users, building it once."""
+    path = os.path.abspath(os.path.join(directory, f"micro-{rows}-{users}-{threshold}.db"))
+    if not os.path.exists(path):
+        print(f"Seeding {rows} messages of {users} users into {path}", file=sys.stderr)
+        build(f"{path}.tmp", "compact", rows, users, threshold)
+        os.replace(f"{path}.tmp", path)
+    return path
+
+
+def timeit(function: Callable[[], object], number: int, repeat: int) -> Dict[str, float]:
+    """Seconds per call: the best and median of `repeat` runs of `number` calls."""
+    function()
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            function()
+        runs.append((time.perf_counter() - started) / number)
+    return {"min": min(runs), "median": statistics.median(runs)}
+
+
+def benchmarks(users: int, rng: random.Random) -> Dict[str, Callable[[], object]]:
+    # imported once DATABASE_URL points at the seeded database
+    import openai
+
+    import bot
+    from cache import conversation_cache
+    from db import Message, MessageType, init_db
+    from heyoo import WhatsApp
+
+    init_db()
+
+    class Completion:
+        choices = [{"message": {"role": "assistant", "content": "Great! You said it well. What did you do next?"}}]
+
+    # the canned completion keeps OpenAI's latency out of get_response
+    openai.ChatCompletion.create = lambda **kwargs: Completion()
+
+    def user() -> str:
+        return phone_id(rng.randrange(users))
+
+    short = "I goed to the beach yesterday with my friends."
+    long = " ".join([short] * 50)
+    conversation = [
+        {"role": "user" if i % 2 else "assistant", "content": short if i % 2 else long[:400]} for i in range(100)
+    ]
+    whatsapp = WhatsApp("token", payloads.PHONE_NUMBER_ID)
+    webhook = payloads.text("5511999999999")
+
+    def cold_conversation():
+        phone = user()
+        conversation_cache.invalidate(phone)
+        return Message.get_conversation(phone, 100)
+
+    hot_user = user()
+
+    return {
+        "get_num_tokens/short": lambda: bot.get_num_tokens(short),
+        "get_num_tokens/long": lambda: bot.get_num_tokens(long),
+        "trim_conversation/100": lambda: bot.trim_conversation(conversation, 3000),
+        "get_response": lambda: bot.get_response(user(), short),
+        "get_progress": lambda: bot.get_progress(user()),
+        "add_message": lambda: Message.add_message(user(), short, MessageType.user_message, timestamp=datetime.now()),
+        "get_last_n_messages/100": lambda: Message.get_last_n_messages(user(), 100),
+        "get_conversation/cold": cold_conversation,
+        "get_conversation/cached": lambda: Message.get_conversation(hot_user, 100),
+        "heyoo/changed_field": lambda: whatsapp.changed_field(webhook),
+        "heyoo/get_mobile": lambda: whatsapp.get_mobile(webhook),
+        "heyoo/get_message": lambda: whatsapp.get_message(webhook),
+        "heyoo/get_message_type": lambda: whatsapp.get_message_type(webhook),
+    }
+
+
+class OfflineEncoding:
+    """Splits text like GPT-2's pre-tokenizer, about as costly as encoding and about as many tokens."""
+    PIECES = re.compile(r"'(?:s|t|re|ve|m|ll|d)| ?[^\W\d_]+| ?\d+| ?[^\s\w]+|\s+(?!\S)|\s+")
+
+    def encode(self, text: str) -> List[str]:
+        return self.PIECES.findall(text)
+
+
+def has_vocabulary() -> bool:
+    """True if tiktoken can load its vocabulary, otherwise `bot.get_encoding` is replaced by `OfflineEncoding`.
+
+    tiktoken downloads the vocabulary on first use, so offline the token
+    counter would fail and take get_response and trim_conversation with it.
+    """
+    import bot
+
+    try:
+        bot.get_encoding()
+        return True
+    except Exception as error:
+        print(f"tiktoken vocabulary unavailable ({error}), counting tokens with OfflineEncoding", file=sys.stderr)
+        encoding = OfflineEncoding()
+        bot.get_encoding = lambda: encoding
+        return False
+
+
+def revision(ref: str = "HEAD") -> str:
+    """Short commit hash of a git ref, or the ref itself outside a git checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", ref], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ref
+
+
+def load_baseline(path: str, ref: str, rows: int, users: int, tokenizer: str) -> Dict[str, Dict[str, float]]:
+    """Returns the latest results recorded for `ref` on a dataset of the same size with the same tokenizer."""
+    baseline = {}
+    if not os.path.exists(path):
+        return baseline
+    ref = revision(ref)
+    with open(path) as file:
+        for line in file:
+            result = json.loads(line)
+            if (
+                result["commit"] == ref and result["rows"] == rows and result["users"] == users
+                and result.get("tokenizer", "tiktoken") == tokenizer
+            ):
+                baseline[result["name"]] = result
+    return baseline
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000, help="messages in the seeded database")
+    parser.add_argument("--users", type=int, default=1000, help="users the messages are spread over")
+    parser.add_argument("--threshold", type=int, default=512, help="compression threshold of the seeded messages")
+    parser.add_argument("--data-dir", default=".benchmarks", help="where seeded databases are kept")
+    parser.add_argument("--number", type=int, default=200, help="calls per run")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per benchmark")
+    parser.add_argument("--only", help="only run benchmarks whose name starts with this")
+    parser.add_argument("--output", default=RESULTS, help="results file, one JSON object per benchmark and run")
+    parser.add_argument("--compare", metavar="REF", help="compare with the results recorded on this commit")
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    path = seed(args.data_dir, args.rows, args.users, args.threshold)
+    # get_response and add_message write to the database, work on a copy so every run starts the same
+    working = f"{path}.run"
+    with open(path, "rb") as source, open(working, "wb") as target:
+        while chunk := source.read(1 << 20):
+            target.write(chunk)
+    os.environ["DATABASE_URL"] = f"sqlite:///{working}"
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    tokenizer = "tiktoken" if has_vocabulary() else "offline"
+
+    baseline = load_baseline(args.output, args.compare, args.rows, args.users, tokenizer) if args.compare else {}
+    commit = revision()
+    rng = random.Random(0)
+    results = []
+    print(f"{'benchmark':<28} {'min us':>10} {'median us':>10}" + (f" {'vs ' + args.compare:>12}" if args.compare else ""))
+    for name, function in benchmarks(args.users, rng).items():
+        if args.only and not name.startswith(args.only):
+            continue
+        timing = timeit(function, args.number, args.repeat)
+        line = f"{name:<28} {timing['min'] * 1e6:>10.1f} {timing['median'] * 1e6:>10.1f}"
+        if name in baseline:
+            line += f" {timing['median'] / baseline[name]['median']:>11.2f}x"
+        print(line)
+        results.append({
+            "commit": commit,
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "name": name,
+            "rows": args.rows,
+            "users": args.users,
+            "number": args.number,
+            "repeat": args.repeat,
+            "tokenizer": tokenizer,
+            **timing,
+        })
+    os.remove(working)
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "a") as file:
+        for result in results:
+            file.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
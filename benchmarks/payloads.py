@@ -0,0 +1,86 @@
+"""Realistic WhatsApp Cloud API webhook payloads for load tests."""
+import random
+import time
+from typing import Dict, Tuple
+
+PHONE_NUMBER_ID = "100000000000001"
+
+TEXTS = [
+    "Hello, how are you?",
+    "I goed to the beach yesterday with my friends.",
+    "What is the difference between make and do?",
+    "My favourite food are pizza and pasta.",
+    "Can you help me practice for a job interview?",
+    "Yesterday I have visited my grandmother and we cooked together.",
+]
+
+# payload kinds and how often they are generated, status callbacks dominate real traffic
+MIX = {"text": 0.3, "interactive": 0.05, "media": 0.05, "status": 0.6}
+
+MEDIA = [
+    ("image", "image/jpeg"),
+    ("audio", "audio/ogg; codecs=opus"),
+    ("video", "video/mp4"),
+    ("document", "application/pdf"),
+]
+
+
+def _envelope(value: Dict) -> Dict:
+    value = {"messaging_product": "whatsapp", "metadata": {"display_phone_number": "15550000000", "phone_number_id": PHONE_NUMBER_ID}, **value}
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [{"id": "200000000000002", "changes": [{"value": value, "field": "messages"}]}],
+    }
+
+
+def _message(mobile: str, message_type: str, body: Dict) -> Dict:
+    return _envelope({
+        "contacts": [{"profile": {"name": f"Learner {mobile[-4:]}"}, "wa_id": mobile}],
+        "messages": [{
+            "from": mobile,
+            "id": f"wamid.{random.getrandbits(64):016x}",
+            "timestamp": str(int(time.time())),
+            "type": message_type,
+            message_type: body,
+        }],
+    })
+
+
+def text(mobile: str) -> Dict:
+    return _message(mobile, "text", {"body": random.choice(TEXTS)})
+
+
+def interactive(mobile: str) -> Dict:
+    if random.random() < 0.5:
+        body = {"type": "button_reply", "button_reply": {"id": "continue", "title": "Continue"}}
+    else:
+        body = {"type": "list_reply", "list_reply": {"id": "beginner", "title": "Beginner", "description": "Simple words"}}
+    return _message(mobile, "interactive", body)
+
+
+def media(mobile: str) -> Dict:
+    media_type, mime_type = random.choice(MEDIA)
+    return _message(mobile, media_type, {"id": f"{random.getrandbits(48)}", "mime_type": mime_type, "sha256": "0" * 64})
+
+
+def status(mobile: str) -> Dict:
+    return _envelope({
+        "statuses": [{
+            "id": f"wamid.{random.getrandbits(64):016x}",
+            "status": random.choice(["sent", "delivered", "read"]),
+            "timestamp": str(int(time.time())),
+            "recipient_id": mobile,
+            "conversation": {"id": f"{random.getrandbits(64):016x}", "origin": {"type": "user_initiated"}},
+            "pricing": {"billable": True, "pricing_model": "CBP", "category": "user_initiated"},
+        }],
+    })
+
+
+GENERATORS = {"text": text, "interactive": interactive, "media": media, "status": status}
+
+
+def generate(users: int, mix: Dict[str, float] = MIX) -> Tuple[str, Dict]:
+    """Returns a random (kind, payload) from one of `users` learners."""
+    kind = random.choices(list(mix), weights=list(mix.values()))[0]
+    mobile = f"55119{random.randrange(users):08d}"
+    return kind, GENERATORS[kind](mobile)
@@ -0,0 +1,147 @@
+"""Compares the original and the compact messages layout on a synthetic dataset.
+
+Builds one SQLite file per layout with the same synthetic messages and reports
+file size, rows per page and the latency of loading a user's recent window,
+which is the query the bot runs every turn.
+
+    python -m benchmarks.schema --rows 10000000 --users 100000
+"""
+import argparse
+from datetime import datetime, timedelta
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+import zlib
+
+LEGACY_SCHEMA = [
+    "CREATE TABLE messages (id INTEGER PRIMARY KEY, phone_id VARCHAR, content VARCHAR, timestamp DATETIME, "
+    "message_type VARCHAR(19))",
+]
+LEGACY_QUERY = "SELECT * FROM messages WHERE phone_id = ? ORDER BY timestamp DESC LIMIT 100"
+
+COMPACT_SCHEMA = [
+    "CREATE TABLE users (id INTEGER PRIMARY KEY, phone_id VARCHAR UNIQUE, mode VARCHAR(12))",
+    "CREATE TABLE messages (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES users (id), content TEXT, "
+    "timestamp INTEGER, message_type SMALLINT)",
+    "CREATE INDEX ix_messages_user_timestamp ON messages (user_id, timestamp)",
+]
+COMPACT_QUERY = (
+    "SELECT * FROM messages WHERE user_id = (SELECT id FROM users WHERE phone_id = ?) "
+    "ORDER BY timestamp DESC, id DESC LIMIT 100"
+)
+
+# (legacy enum name, compact code) of the message types in the dataset
+MESSAGE_TYPES = [("user_message", 1), ("bot_message", 5)]
+WORDS = "the a I you to is was and of in it my what do like how very good today go have want".split()
+
+
+def synthetic_messages(rows: int, users: int, seed: int = 0):
+    """Yields (user, content, timestamp, message_type) with users interleaved as in production."""
+    rng = random.Random(seed)
+    start = datetime(2023, 1, 1)
+    for i in range(rows):
+        user = rng.randrange(users)
+        message_type = i % 2
+        length = rng.randint(3, 15) if message_type == 0 else rng.randint(20, 160)
+        content = " ".join(rng.choice(WORDS) for _ in range(length))
+        yield user, content, start + timedelta(seconds=i * 3), MESSAGE_TYPES[message_type]
+
+
+def phone_id(user: int) -> str:
+    return f"55{user:011d}"
+
+
+def compress(content: str, threshold: int) -> object:
+    if not threshold or len(content) < threshold:
+        return content
+    raw = content.encode()
+    compressed = zlib.compress(raw)
+    return compressed if len(compressed) < len(raw) else content
+
+
+def build(path: str, layout: str, rows: int, users: int, threshold: int, batch_size: int = 100000) -> float:
+    connection = sqlite3.connect(path)
+    for statement in LEGACY_SCHEMA if layout == "legacy" else COMPACT_SCHEMA:
+        connection.execute(statement)
+    if layout == "compact":
+        connection.executemany(
+            "INSERT INTO users (id, phone_id) VALUES (?, ?)", ((user + 1, phone_id(user)) for user in range(users))
+        )
+
+    started = time.perf_counter()
+    batch = []
+    for user, content, timestamp, (name, code) in synthetic_messages(rows, users):
+        if layout == "legacy":
+            batch.append((phone_id(user), content, timestamp.isoformat(" "), name))
+        else:
+            batch.append((user + 1, compress(content, threshold), int(timestamp.timestamp()), code))
+        if len(batch) == batch_size:
+            _insert(connection, layout, batch)
+            batch = []
+    if batch:
+        _insert(connection, layout, batch)
+    connection.commit()
+    connection.close()
+    return time.perf_counter() - started
+
+
+def _insert(connection: sqlite3.Connection, layout: str, batch: list) -> None:
+    columns = "phone_id" if layout == "legacy" else "user_id"
+    connection.executemany(
+        f"INSERT INTO messages ({columns}, content, timestamp, message_type) VALUES (?, ?, ?, ?)", batch
+    )
+
+
+def measure(path: str, layout: str, users: int, queries: int) -> dict:
+    connection = sqlite3.connect(path)
+    rows = connection.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+    pages = connection.execute(
+        "SELECT COUNT(*) FROM dbstat WHERE name = 'messages' AND pagetype = 'leaf'"
+    ).fetchone()[0]
+    rng = random.Random(1)
+    query = LEGACY_QUERY if layout == "legacy" else COMPACT_QUERY
+    latencies = []
+    for _ in range(queries):
+        user = rng.randrange(users)
+        started = time.perf_counter()
+        connection.execute(query, (phone_id(user),)).fetchall()
+        latencies.append((time.perf_counter() - started) * 1000)
+    connection.close()
+    latencies.sort()
+    return {
+        "file_mb": os.path.getsize(path) / 2 ** 20,
+        "rows_per_page": rows / pages if pages else 0,
+        "p50_ms": statistics.median(latencies),
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] if len(latencies) >= 20 else max(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=100, help="window queries timed per layout")
+    parser.add_argument("--threshold", type=int, default=512, help="compression threshold of the compact layout")
+    parser.add_argument("--dir", default=None, help="where to write the databases, defaults to a temp dir")
+    args = parser.parse_args()
+
+    directory = args.dir or tempfile.mkdtemp(prefix="schema-bench-")
+    print(f"{args.rows} rows, {args.users} users, databases in {directory}")
+    print(f"{'layout':<8} {'build s':>8} {'file MB':>8} {'rows/page':>10} {'p50 ms':>8} {'p95 ms':>8}")
+    for layout in ("legacy", "compact"):
+        path = os.path.join(directory, f"{layout}.db")
+        if os.path.exists(path):
+            os.remove(path)
+        build_seconds = build(path, layout, args.rows, args.users, args.threshold)
+        result = measure(path, layout, args.users, args.queries)
+        print(
+            f"{layout:<8} {build_seconds:>8.1f} {result['file_mb']:>8.1f} {result['rows_per_page']:>10.1f} "
+            f"{result['p50_ms']:>8.3f} {result['p95_ms']:>8.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
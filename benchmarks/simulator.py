@@ -0,0 +1,400 @@
+"""Local stand-in for the Graph API and OpenAI.
+
+Implements the endpoints the app calls: WhatsApp messages, media upload,
+media urls, media downloads and media deletion, the Messenger conversations,
+history and send endpoints, and chat completions with and without streaming.
+
+Every response waits for a latency drawn from a configurable distribution and
+can be turned into a 429, a 5xx or a body that trickles in slowly, so load
+and resilience tests can reproduce slow or failing upstreams. Replies are
+derived from the request content and ids and faults come from a seeded
+generator, so with a fixed `--seed` and a single client every run sees the
+same responses.
+
+Run it on its own and point the app at it:
+
+    python -m benchmarks.simulator --port 8081 --seed 1 --fault openai:429:0.05 --fault graph:5xx:0.01
+    GRAPH_API_URL=http://127.0.0.1:8081 OPENAI_API_BASE=http://127.0.0.1:8081/v1 gunicorn app:app
+"""
+import argparse
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+from threading import Lock, Thread
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlencode, urlsplit
+import zlib
+
+from benchmarks.stats import parse_latency, summarize
+
+REPLIES = [
+    "Great! You said it well. What did you do next?",
+    "Almost! We say 'I went', not 'I goed'. Where did you go?",
+    "Good question! 'Make' is for creating things and 'do' is for tasks. Can you make a sentence with each?",
+    "Small correction: 'My favourite food is pizza'. What else do you like to eat?",
+    "Of course! Tell me about the job you are applying for.",
+    "Nice! We say 'Yesterday I visited my grandmother'. What did you cook?",
+]
+
+# id of the Messenger page in simulated conversations, as set in facebook.py
+PAGE_ID = "109100192122534"
+
+# kinds of injected faults, each with its own probability per service
+FAULTS = ("429", "5xx", "slow")
+
+ERRORS = {
+    "openai": {
+        429: {"error": {"message": "Rate limit reached for requests", "type": "requests", "code": "rate_limit_exceeded"}},
+        500: {"error": {"message": "The server had an error while processing your request.", "type": "server_error"}},
+    },
+    "graph": {
+        429: {"error": {"message": "(#4) Application request limit reached", "type": "OAuthException", "code": 4}},
+        500: {"error": {"message": "An unexpected error has occurred. Please retry your request later.", "type": "OAuthException", "code": 2}},
+    },
+}
+
+
+def reply_for(messages: List[Dict]) -> str:
+    """The completion for a conversation, always the same for the same last message."""
+    content = messages[-1]["content"] if messages else ""
+    return REPLIES[zlib.crc32(content.encode()) % len(REPLIES)]
+
+
+class Simulator(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        port: int = 0,
+        openai_latency: str = "lognormal:800,0.4",
+        graph_latency: str = "lognormal:120,0.3",
+        slow_body: str = "fixed:5000",
+        faults: Optional[Dict[str, Dict[str, float]]] = None,
+        media_bytes: int = 64 * 1024,
+        history_length: int = 20,
+        seed: Optional[int] = None,
+    ):
+        """
+        Args:
+            port: port to listen on, 0 picks a free one
+            openai_latency: latency of chat completions, see `benchmarks.stats.parse_latency`
+            graph_latency: latency of Graph API calls
+            slow_body: how long a body takes to arrive when a slow body is injected
+            faults: probability of each kind of fault per service, e.g. {"openai": {"429": 0.05}}
+            media_bytes: size of downloaded media
+            history_length: messages in every Messenger conversation
+            seed: seed of the generator behind latencies, faults and ids
+        """
+        super().__init__(("127.0.0.1", port), SimulatorHandler)
+        self.rng = random.Random(seed)
+        self.latencies: Dict[str, Callable[[], float]] = {
+            "openai": parse_latency(openai_latency, self.rng),
+            "graph": parse_latency(graph_latency, self.rng),
+            "slow": parse_latency(slow_body, self.rng),
+        }
+        self.faults = faults or {}
+        self.media_bytes = media_bytes
+        self.history_length = history_length
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.injected: Dict[str, int] = defaultdict(int)
+        self._lock = Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def draw(self, service: str) -> Optional[str]:
+        """Picks the fault injected into the next response of a service, if any."""
+        with self._lock:
+            for fault, probability in self.faults.get(service, {}).items():
+                if self.rng.random() < probability:
+                    return fault
+        return None
+
+    def sample(self, latency: str) -> float:
+        with self._lock:
+            return self.latencies[latency]()
+
+    def new_id(self) -> str:
+        with self._lock:
+            return f"{self.rng.getrandbits(64):016x}"
+
+    def record(self, stage: str, seconds: float, fault: Optional[str] = None) -> None:
+        with self._lock:
+            self.samples[stage].append(seconds)
+            if fault:
+                self.injected[stage] += 1
+
+    def reset(self) -> None:
+        with self._lock:
+            self.samples.clear()
+            self.injected.clear()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Latency summary and number of injected faults per stage."""
+        with self._lock:
+            return {
+                stage: {**summarize(samples), "faults": self.injected.get(stage, 0)}
+                for stage, samples in sorted(self.samples.items())
+            }
+
+    def start(self) -> "Simulator":
+        Thread(target=self.serve_forever, name="simulator", daemon=True).start()
+        return self
+
+
+class SimulatorHandler(BaseHTTPRequestHandler):
+    server: Simulator
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if parts[0] == "media-download":
+            self._respond("graph_media_download", "graph", body=b"\0" * self.server.media_bytes, content_type="application/octet-stream")
+        elif len(parts) == 3 and parts[2] == "conversations":
+            self._respond("graph_conversations", "graph", {"data": [{"id": f"t_{query.get('user_id')}"}]})
+        elif len(parts) == 3 and parts[2] == "messages":
+            self._respond("graph_history", "graph", self._history(url.path, parts[1], query))
+        elif len(parts) == 2:
+            media_id = parts[1]
+            self._respond("graph_media_url", "graph", {
+                "url": f"{self.server.url}/media-download/{media_id}",
+                "mime_type": "application/octet-stream",
+                "sha256": f"{zlib.crc32(media_id.encode()):064x}",
+                "file_size": self.server.media_bytes,
+                "id": media_id,
+                "messaging_product": "whatsapp",
+            })
+        else:
+            self._not_found()
+
+    def do_DELETE(self):
+        if len(urlsplit(self.path).path.strip("/").split("/")) == 2:
+            self._respond("graph_media_delete", "graph", {"success": True})
+        else:
+            self._not_found()
+
+    def do_POST(self):
+        parts = urlsplit(self.path).path.strip("/").split("/")
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length)
+
+        if parts[-1] == "media":
+            # multipart upload, only its size matters
+            self._respond("graph_media_upload", "graph", {"id": self.server.new_id()})
+            return
+
+        body = json.loads(raw or b"{}")
+        if parts[-2:] == ["chat", "completions"]:
+            self._completion(body)
+        elif parts[-1] == "messages" and "recipient" in body:
+            self._respond("graph_messenger_send", "graph", {
+                "recipient_id": body["recipient"]["id"],
+                "message_id": f"m_{self.server.new_id()}",
+            })
+        elif parts[-1] == "messages" and body.get("status") == "read":
+            self._respond("graph_mark_as_read", "graph", {"success": True})
+        elif parts[-1] == "messages":
+            self._respond("graph_send", "graph", {
+                "messaging_product": "whatsapp",
+                "contacts": [{"input": body.get("to"), "wa_id": body.get("to")}],
+                "messages": [{"id": f"wamid.{self.server.new_id()}"}],
+            })
+        else:
+            self._not_found()
+
+    def _history(self, path: str, conversation_id: str, query: Dict[str, str]) -> Dict:
+        """A page of a Messenger conversation, newest first, alternating between the user and the page."""
+        user_id = conversation_id[len("t_"):]
+        limit = int(query.get("limit", 25))
+        offset = int(query.get("after", 0))
+        now = int(time.time())
+        data = []
+        for index in range(offset, min(offset + limit, self.server.history_length)):
+            from_user = index % 2 == 1
+            data.append({
+                "id": f"m_{conversation_id}_{index}",
+                "message": REPLIES[index % len(REPLIES)] if not from_user else f"Message {index} from the learner",
+                "from": {"id": user_id if from_user else PAGE_ID},
+                "created_time": time.strftime("%Y-%m-%dT%H:%M:%S+0000", time.gmtime(now - 60 * index)),
+            })
+        page = {"data": data}
+        if offset + limit < self.server.history_length:
+            next_query = {**query, "after": offset + limit}
+            page["paging"] = {"next": f"{self.server.url}{path}?{urlencode(next_query)}"}
+        return page
+
+    def _completion(self, body: Dict) -> None:
+        content = reply_for(body.get("messages", []))
+        completion_id = f"chatcmpl-{self.server.new_id()}"
+        model = body.get("model", "gpt-3.5-turbo")
+        if not body.get("stream"):
+            self._respond("openai", "openai", {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 100, "completion_tokens": len(content.split()), "total_tokens": 100 + len(content.split())},
+            })
+            return
+
+        def chunk(delta: Dict, finish_reason: Optional[str] = None) -> bytes:
+            event = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            return f"data: {json.dumps(event)}\n\n".encode()
+
+        words = content.split(" ")
+        events = [chunk({"role": "assistant"})]
+        events += [chunk({"content": word if i == 0 else f" {word}"}) for i, word in enumerate(words)]
+        events += [chunk({}, "stop"), b"data: [DONE]\n\n"]
+        self._stream("openai_stream", "openai", events)
+
+    def _fault(self, stage: str, service: str, started: float) -> Optional[str]:
+        """Sends an injected error response, returns the fault drawn for this response."""
+        fault = self.server.draw(service)
+        if fault not in ("429", "5xx"):
+            return fault
+        status = 429 if fault == "429" else self.server.rng.choice((500, 502, 503))
+        body = json.dumps(ERRORS[service][429 if status == 429 else 500]).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if status == 429:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.record(stage, time.perf_counter() - started, fault)
+        return fault
+
+    def _respond(
+        self,
+        stage: Optional[str],
+        latency: Optional[str],
+        payload: Optional[Dict] = None,
+        status: int = 200,
+        body: Optional[bytes] = None,
+        content_type: str = "application/json",
+    ) -> None:
+        started = time.perf_counter()
+        fault = None
+        if latency:
+            time.sleep(self.server.sample(latency))
+            fault = self._fault(stage, latency, started)
+            if fault in ("429", "5xx"):
+                return
+        if body is None:
+            body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if fault == "slow":
+            self._trickle(body)
+        else:
+            self.wfile.write(body)
+        if stage:
+            self.server.record(stage, time.perf_counter() - started, fault)
+
+    def _stream(self, stage: str, latency: str, events: List[bytes]) -> None:
+        """Sends server-sent events with chunked encoding, spread over the sampled latency."""
+        started = time.perf_counter()
+        total = self.server.sample(latency)
+        # the first token arrives after a fifth of the latency, the rest stream in
+        time.sleep(total / 5)
+        fault = self._fault(stage, latency, started)
+        if fault in ("429", "5xx"):
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        delay = (self.server.sample("slow") if fault == "slow" else total * 4 / 5) / len(events)
+        for event in events:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+            self.wfile.flush()
+            time.sleep(delay)
+        self.wfile.write(b"0\r\n\r\n")
+        self.server.record(stage, time.perf_counter() - started, fault)
+
+    def _trickle(self, body: bytes, pieces: int = 16) -> None:
+        """Writes a body in pieces spread over a slow body's latency."""
+        size = max(1, -(-len(body) // pieces))
+        delay = self.server.sample("slow") / pieces
+        for start in range(0, len(body), size):
+            time.sleep(delay)
+            self.wfile.write(body[start:start + size])
+            self.wfile.flush()
+
+    def _not_found(self) -> None:
+        self._respond(None, None, {"error": {"message": f"Unknown path {self.path}"}}, status=404)
+
+
+def parse_fault(spec: str) -> Tuple[str, str, float]:
+    """Parses SERVICE:KIND:PROBABILITY, e.g. openai:429:0.05."""
+    try:
+        service, fault, probability = spec.split(":")
+        probability = float(probability)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected SERVICE:KIND:PROBABILITY, got {spec}")
+    if service not in ERRORS or fault not in FAULTS:
+        raise argparse.ArgumentTypeError(f"Service must be one of {', '.join(ERRORS)} and kind one of {', '.join(FAULTS)}")
+    return service, fault, probability
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--openai-latency", default="lognormal:800,0.4", help="fixed:MS, uniform:MIN,MAX or lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--graph-latency", default="lognormal:120,0.3")
+    parser.add_argument("--slow-body", default="fixed:5000", help="time a slow body takes to arrive")
+    parser.add_argument(
+        "--fault", type=parse_fault, action="append", default=[], dest="faults",
+        help="SERVICE:KIND:PROBABILITY with SERVICE openai or graph and KIND 429, 5xx or slow, repeatable",
+    )
+    parser.add_argument("--seed", type=int, help="seed for reproducible latencies, faults and ids")
+
+
+def from_arguments(args: argparse.Namespace, port: int = 0) -> Simulator:
+    faults: Dict[str, Dict[str, float]] = defaultdict(dict)
+    for service, fault, probability in args.faults:
+        faults[service][fault] = probability
+    return Simulator(
+        port=port,
+        openai_latency=args.openai_latency,
+        graph_latency=args.graph_latency,
+        slow_body=args.slow_body,
+        faults=dict(faults),
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8081)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    simulator = from_arguments(args, args.port)
+    print(f"Simulating the Graph API and OpenAI on {simulator.url}", flush=True)
+    try:
+        simulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    for stage, summary in simulator.stats().items():
+        print(f"{stage}: {summary}")
+
+
+if __name__ == "__main__":
+    main()
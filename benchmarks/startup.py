@@ -0,0 +1,122 @@
+"""Startup time and memory of the app under gunicorn, with and without preloading.
+
+For each mode, measures how long a fresh interpreter takes to import the app,
+how long gunicorn takes until it answers, and the memory of the master and
+the workers once every worker has answered a few turns. PSS splits the pages
+that processes share between them, so the summed PSS is what the deployment
+really costs; USS is the memory private to a process. Reads /proc, so it only
+runs on Linux.
+
+    python -m benchmarks.startup --workers 4 --turns 200
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from benchmarks.load import REPO, app_env, drive, free_port, start_app, wait_until_answered, wait_until_ready
+from benchmarks.simulator import add_arguments, from_arguments
+
+IMPORT_APP = f"""
+import sys, time
+sys.path.insert(0, {str(REPO)!r})
+started = time.perf_counter()
+import app
+print(time.perf_counter() - started)
+"""
+
+
+def import_seconds(env: Dict[str, str], directory: str, repeat: int) -> List[float]:
+    """Seconds a fresh interpreter takes to import the app, once per run."""
+    return [
+        float(subprocess.run(
+            [sys.executable, "-c", IMPORT_APP], cwd=directory, env=env, check=True, capture_output=True, text=True
+        ).stdout)
+        for _ in range(repeat)
+    ]
+
+
+def memory(pid: int) -> Dict[str, int]:
+    """RSS, PSS and USS of a process in bytes."""
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as smaps:
+        for line in smaps:
+            name, _, value = line.partition(":")
+            if value.strip().endswith("kB"):
+                fields[name] = int(value.split()[0]) * 1024
+    return {"rss": fields["Rss"], "pss": fields["Pss"], "uss": fields["Private_Clean"] + fields["Private_Dirty"]}
+
+
+def workers_of(pid: int) -> List[int]:
+    with open(f"/proc/{pid}/task/{pid}/children") as children:
+        return [int(child) for child in children.read().split()]
+
+
+def measure(simulator_url: str, workers: int, turns: int, users: int, preload: bool, repeat: int) -> Dict[str, float]:
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    env = {"PRELOAD_APP": "1" if preload else "0"}
+    with tempfile.TemporaryDirectory(prefix="startup-") as directory:
+        imports = import_seconds(dict(app_env(simulator_url, directory), **env), directory, repeat)
+        started = time.monotonic()
+        app = start_app(simulator_url, port, workers, "sync", 1, directory, env)
+        try:
+            wait_until_ready(url, app)
+            ready = time.monotonic() - started
+            # answering turns loads what is only imported on first use
+            drive(f"{url}/whatsapi", turns, 8, users, {"text": 1.0})
+            wait_until_answered(os.path.join(directory, "example.db"))
+            master = memory(app.pid)
+            children = [memory(pid) for pid in workers_of(app.pid)]
+        finally:
+            app.terminate()
+            app.wait()
+    return {
+        "import": statistics.median(imports),
+        "ready": ready,
+        "master_rss": master["rss"],
+        "worker_rss": statistics.mean(child["rss"] for child in children),
+        "worker_pss": statistics.mean(child["pss"] for child in children),
+        "worker_uss": statistics.mean(child["uss"] for child in children),
+        "total_pss": master["pss"] + sum(child["pss"] for child in children),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    parser.add_argument("--turns", type=int, default=200, help="text messages answered before measuring memory")
+    parser.add_argument("--users", type=int, default=100, help="distinct learners sending them")
+    parser.add_argument("--repeat", type=int, default=5, help="imports timed per mode")
+    add_arguments(parser)
+    parser.set_defaults(openai_latency="fixed:5", graph_latency="fixed:1")
+    args = parser.parse_args()
+
+    simulator = from_arguments(args).start()
+    try:
+        results = {
+            mode: measure(simulator.url, args.workers, args.turns, args.users, mode == "preload", args.repeat)
+            for mode in ("no preload", "preload")
+        }
+    finally:
+        simulator.shutdown()
+
+    mb = 1024 * 1024
+    print(
+        f"{'mode':<12} {'import s':>9} {'ready s':>8} {'master RSS':>11} {'worker RSS':>11} "
+        f"{'worker PSS':>11} {'worker USS':>11} {'total PSS':>10}"
+    )
+    for mode, result in results.items():
+        print(
+            f"{mode:<12} {result['import']:>9.2f} {result['ready']:>8.2f} {result['master_rss'] / mb:>10.1f}M "
+            f"{result['worker_rss'] / mb:>10.1f}M {result['worker_pss'] / mb:>10.1f}M "
+            f"{result['worker_uss'] / mb:>10.1f}M {result['total_pss'] / mb:>9.1f}M"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""Helpers shared by the benchmarks."""
+import math
+import random
+from typing import Callable, Dict, List
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile of `values`, `q` in [0, 100]."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+    }
+
+
+def parse_latency(spec: str, rng: random.Random = random) -> Callable[[], float]:
+    """Parses a latency distribution into a sampler returning seconds.
+
+    Specs are in milliseconds:
+        fixed:50            always 50 ms
+        uniform:20,80       uniformly between 20 and 80 ms
+        lognormal:300,0.5   median 300 ms with a long tail of shape 0.5
+    """
+    kind, _, args = spec.partition(":")
+    values = [float(value) for value in args.split(",") if value]
+    if kind == "fixed":
+        return lambda: values[0] / 1000
+    if kind == "uniform":
+        return lambda: rng.uniform(values[0], values[1]) / 1000
+    if kind == "lognormal":
+        mu = math.log(values[0])
+        return lambda: rng.lognormvariate(mu, values[1]) / 1000
+    raise ValueError(f"Unknown latency distribution {spec}")
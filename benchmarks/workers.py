@@ -0,0 +1,90 @@
+"""Compares gunicorn worker classes on the same load.
+
+Runs the load test of benchmarks/load.py once per worker configuration,
+against one simulator with the same seed, and prints one line per
+configuration: webhook latency, and how long it took until every turn was
+answered, which is where the worker class matters as turns wait on OpenAI.
+
+    python -m benchmarks.workers --requests 2000 --workers 2 --threads 8 --greenlets 64
+"""
+import argparse
+import os
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+from benchmarks import payloads
+from benchmarks.load import drive, free_port, parse_mix, start_app, wait_until_answered, wait_until_ready
+from benchmarks.simulator import add_arguments, from_arguments
+from benchmarks.stats import summarize
+
+
+def run(simulator, args: argparse.Namespace, worker_class: str, threads: int, env: Dict[str, str]) -> Dict[str, float]:
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory(prefix="workers-") as directory:
+        app = start_app(simulator.url, port, args.workers, worker_class, threads, directory, env)
+        try:
+            wait_until_ready(url, app)
+            database = os.path.join(directory, "example.db")
+            drive(f"{url}/whatsapi", args.warmup, min(args.concurrency, args.warmup), args.users, args.mix)
+            wait_until_answered(database)
+            simulator.reset()
+            started = time.perf_counter()
+            wall, latencies, errors = drive(f"{url}/whatsapi", args.requests, args.concurrency, args.users, args.mix)
+            wait_until_answered(database)
+            total = time.perf_counter() - started
+        finally:
+            app.terminate()
+            app.wait()
+    webhooks = summarize([value for values in latencies.values() for value in values])
+    return {
+        "wall": wall,
+        "total": total,
+        "turns": simulator.stats().get("openai", {}).get("count", 0),
+        "errors": sum(errors.values()),
+        **webhooks,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=1000, help="webhooks to send")
+    parser.add_argument("--warmup", type=int, default=20, help="webhooks sent before measuring")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent clients")
+    parser.add_argument("--users", type=int, default=500, help="distinct learners sending messages")
+    parser.add_argument("--mix", type=parse_mix, default=payloads.MIX, help="e.g. text=0.3,interactive=0.05,media=0.05,status=0.6")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers of every configuration")
+    parser.add_argument("--threads", type=int, default=8, help="threads per worker of the threaded configuration")
+    parser.add_argument("--greenlets", type=int, default=64, help="dispatcher greenlets per gevent worker")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    # the sync and threaded workers answer turns on SHARD_THREADS native threads, gevent on greenlets
+    configurations: List[Tuple[str, str, int, Dict[str, str]]] = [
+        ("sync", "sync", 1, {}),
+        (f"gthread x{args.threads}", "gthread", args.threads, {"SHARD_THREADS": str(args.threads)}),
+        (f"gevent x{args.greenlets}", "gevent", 1, {"SHARD_THREADS": str(args.greenlets)}),
+    ]
+    simulator = from_arguments(args).start()
+    results = {}
+    try:
+        for name, worker_class, threads, env in configurations:
+            results[name] = run(simulator, args, worker_class, threads, env)
+    finally:
+        simulator.shutdown()
+
+    print(
+        f"{'workers':<14} {'requests/s':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7} "
+        f"{'turns':>6} {'answered s':>11} {'turns/s':>8}"
+    )
+    for name, result in results.items():
+        print(
+            f"{name:<14} {result['count'] / result['wall']:>10.1f} {result['p50'] * 1000:>8.1f} "
+            f"{result['p95'] * 1000:>8.1f} {result['p99'] * 1000:>8.1f} {result['errors']:>7} "
+            f"{result['turns']:>6} {result['total']:>11.1f} {result['turns'] / result['total']:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,18 @@
+from collections import deque
 from datetime import datetime
 from functools import lru_cache
+import logging
 import os
 import random
-from typing import Dict, List
-import openai
+from typing import Dict, List, Optional
 import pathlib
-import tiktoken
 from topics import TOPICS
 
-from db import Message, MessageType
+from breaker import CircuitBreaker, CircuitOpenError
+from corrections import is_correction
+from db import Message, MessageIndex, MessageType, UserStats, init_db
+from green import offload
+from metrics import span
 
 thisdir = pathlib.Path(__file__).resolve().parent
 # get from .env file if it exists
@@ -16,69 +20,162 @@ if thisdir.joinpath('.env').exists():
     from dotenv import load_dotenv
     load_dotenv()
 
-if "OPENAI_API_KEY" in os.environ:
-    openai.api_key = os.environ["OPENAI_API_KEY"]
+# seconds before a completion is abandoned
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", 30))
 
-# if no API KEY, raise error
-if not openai.api_key:
-    raise ValueError("No OpenAI API Key found. Please set the OPENAI_API_KEY environment variable.")
+# fails completions fast while OpenAI is slow or down, see breaker.py
+openai_breaker = CircuitBreaker(
+    "openai",
+    window=float(os.environ.get("OPENAI_BREAKER_WINDOW", 60)),
+    min_calls=int(os.environ.get("OPENAI_BREAKER_MIN_CALLS", 10)),
+    failure_rate=float(os.environ.get("OPENAI_BREAKER_FAILURE_RATE", 0.5)),
+    slow_seconds=float(os.environ.get("OPENAI_BREAKER_SLOW_SECONDS", 15)),
+    open_seconds=float(os.environ.get("OPENAI_BREAKER_OPEN_SECONDS", 30)),
+)
 
 # enumeration for supported languages
 
 LEARNING_MODE = "English"
 DIFFICULTY = "beginner"
 
-STARTER_PROMPT = " ".join([
-    f"Be my {LEARNING_MODE} Tutor.", 
-    f"Converse with me in {LEARNING_MODE}.",
-    f"Whenever I make spelling or grammar mistakes, correct me and then continue the conversation.",
-    f"Only correct me if I make a mistake.",
-    f"Use {DIFFICULTY} {LEARNING_MODE} vocabulary and grammar only.",
-])
+@lru_cache(maxsize=None)
+def get_tutor_prompt(language: str = LEARNING_MODE) -> str:
+    return " ".join([
+        f"Be my {language} Tutor.", 
+        f"Converse with me in {language}.",
+        f"Whenever I make spelling or grammar mistakes, correct me and then continue the conversation.",
+        f"Only correct me if I make a mistake.",
+        f"Use {DIFFICULTY} {language} vocabulary and grammar only.",
+    ])
+
+STARTER_PROMPT = get_tutor_prompt()
 
 WELCOME_MESSAGES = {
     "English": " ".join([
         f"Olá, meu nome é Gringo Lingo e eu serei seu tutor de inglês!",
         f"Vamos conversar e eu vou corrigir seu inglês quando necessário.",
         f"Você pode fazer qualquer pergunta e eu farei o meu melhor para ajudá-lo!",
-        f"Se quiser começar de novo, basta digitar '/reset'."
+        f"Se quiser começar de novo, basta digitar '/reset'.",
+        f"Para rever correções anteriores, digite '/review' seguido de uma palavra.",
+        f"Para ver seu progresso, digite '/progress'."
     ]),
     "Portuguese": " ".join([
         f"Hello, my name is Gringo Lingo and I will be your Portuguese tutor!",
         f"Let's talk and I will correct your Portuguese when needed.", 
         f"You can ask me any questions and I will do my best to help you!", 
-        f"If you want to start over, just type '/reset'."
+        f"If you want to start over, just type '/reset'.",
+        f"To review past corrections, type '/review' followed by a word.",
+        f"To see your progress, type '/progress'."
     ])
 }
 
-def get_starter() -> str:
+# sent while OpenAI is unavailable, in the language the learner practices
+TRY_AGAIN_MESSAGES = {
+    "English": "Sorry, I can't answer right now. Please send your message again in a minute.",
+    "Portuguese": "Desculpe, não consigo responder agora. Envie sua mensagem de novo em um minuto.",
+}
+FALLBACK_STARTERS = {
+    "English": "What did you do today?",
+    "Portuguese": "O que você fez hoje?",
+}
+# recently generated starters per language, reused while OpenAI is unavailable
+recent_starters: Dict[str, deque] = {}
+
+class CompletionError(Exception):
+    """Raised when OpenAI did not complete a chat."""
+
+@lru_cache(maxsize=None)
+def get_openai():
+    """Imports and configures the OpenAI client on first use, it is slow to import."""
+    import openai
+    if "OPENAI_API_KEY" in os.environ:
+        openai.api_key = os.environ["OPENAI_API_KEY"]
+    if not openai.api_key:
+        logging.error("No OpenAI API Key found. Please set the OPENAI_API_KEY environment variable.")
+    return openai
+
+@lru_cache(maxsize=None)
+def get_encoding():
+    import tiktoken
+    return tiktoken.get_encoding('gpt2')
+
+def warmup() -> None:
+    """Loads the OpenAI client and the tokenizer ahead of the first message.
+
+    Run in the gunicorn master when the app is preloaded, so that the workers
+    share them instead of each loading its own copy on its first turn. Loading
+    the tokenizer downloads its vocabulary on first use, if that fails the app
+    still starts and loads it on the first turn instead.
+    """
+    for name, load in (("OpenAI client", get_openai), ("tokenizer", lambda: get_num_tokens("warmup"))):
+        try:
+            load()
+        except Exception:
+            logging.exception("Loading the %s ahead of the first message failed, it is loaded on first use", name)
+
+def complete(messages: List[Dict[str, str]], stage: str = "openai") -> str:
+    """Returns the completion of a chat.
+
+    Raises CircuitOpenError at once while OpenAI is failing, and CompletionError when a call fails.
+    """
+    openai = get_openai()
+    with span(stage):
+        try:
+            response = openai_breaker.call(
+                openai.ChatCompletion.create,
+                model="gpt-3.5-turbo",
+                messages=messages,
+                request_timeout=OPENAI_TIMEOUT,
+            )
+        except openai.error.OpenAIError as error:
+            raise CompletionError(type(error).__name__) from error
+    return response.choices[0]["message"]["content"]
+
+def get_starter(language: str = LEARNING_MODE) -> str:
     topic = random.choice(TOPICS)
 
     CONVERSATION_STARTER_PROMPT = " ".join([
-        f"Generate a conversation starter in {LEARNING_MODE} about {topic}.",
+        f"Generate a conversation starter in {language} about {topic}.",
         f"Do not wrap in quotation marks or include context.",
         f"Only respond with the conversation starter."
     ])
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages = [
-            {"role": "system", "content": CONVERSATION_STARTER_PROMPT}
-        ]
-    )
-    starter = response.choices[0]["message"]["content"]
-    return f"{WELCOME_MESSAGES[LEARNING_MODE]}\n{starter}"
+    try:
+        starter = complete([{"role": "system", "content": CONVERSATION_STARTER_PROMPT}], "openai_starter")
+        recent_starters.setdefault(language, deque(maxlen=50)).append(starter)
+    except (CircuitOpenError, CompletionError):
+        logging.warning("OpenAI unavailable, sending a stored starter")
+        starters = recent_starters.get(language)
+        starter = random.choice(starters) if starters else FALLBACK_STARTERS.get(language, FALLBACK_STARTERS[LEARNING_MODE])
+    return f"{WELCOME_MESSAGES.get(language, WELCOME_MESSAGES[LEARNING_MODE])}\n{starter}"
+
+def get_nudge(phone_id: str, language: str = LEARNING_MODE) -> str:
+    """Writes a message inviting a learner who stopped practicing back, based on their last conversation."""
+    topic = random.choice(TOPICS)
+    conversation = trim_conversation(Message.get_conversation(phone_id, 20), 500)
+
+    NUDGE_PROMPT = " ".join([
+        f"Be my {language} tutor. I have not practiced with you for a few days.",
+        f"Write a short, friendly message in {DIFFICULTY} {language} inviting me back to practice.",
+        f"Mention something from our last conversation, or suggest talking about {topic} if there is none.",
+        f"Do not wrap in quotation marks or include context.",
+        f"Only respond with the message."
+    ])
+    return complete([*conversation, {"role": "system", "content": NUDGE_PROMPT}], "openai_nudge")
 
 @lru_cache(maxsize=None)
 def load_prompt() -> str:
     return thisdir.joinpath('prompt.txt').read_text()
 
 def get_num_tokens(text: str) -> int:
-    encoding = tiktoken.get_encoding('gpt2')
-    num_tokens = len(encoding.encode(text))
+    num_tokens = len(get_encoding().encode(text))
     return num_tokens
 
 def trim_conversation(conversation: List[Dict[str, str]], max_tokens: int) -> List[str]:
     """Trims a conversation to a maximum number of tokens. Keeping the most recent messages."""
+    # counting tokens is CPU-bound, on gevent workers it runs off the hub
+    return offload(_trim_conversation, conversation, max_tokens)
+
+def _trim_conversation(conversation: List[Dict[str, str]], max_tokens: int) -> List[str]:
     num_tokens = 0
     return_conversation = []
     for message in conversation[::-1]:
@@ -88,52 +185,125 @@ def trim_conversation(conversation: List[Dict[str, str]], max_tokens: int) -> Li
             break
     return return_conversation[::-1]
 
-def get_response(phone_id: str, new_message: str):
-    messages = Message.get_last_n_messages(phone_id, 100)
+def get_review(phone_id: str, phrase: str, limit: int = 5) -> str:
+    """Lists past corrections that mention a word or phrase."""
+    if not phrase:
+        return "Send '/review' followed by a word or phrase to see past corrections about it."
 
-    # format messages for openai
-    openai_messages = []
-    for message in messages[::-1]:
+    corrections = []
+    seen = set()
+    for message in MessageIndex.search(phone_id, phrase, limit=4 * limit):
+        # a match in the learner's message is corrected by the bot reply that follows it
         if message.message_type == MessageType.user_message:
-            openai_messages.append({"role": "user", "content": message.content})
-        elif message.message_type == MessageType.system:
-            openai_messages.append({"role": "system", "content": message.content})
-        elif message.message_type == MessageType.bot_message:
-            openai_messages.append({"role": "assistant", "content": message.content})
-        elif message.message_type == MessageType.bot_command_message:
-            if message.content == "/reset":
-                break
+            message = MessageIndex.get_reply(phone_id, message.id)
+        if message is None or message.id in seen:
+            continue
+        seen.add(message.id)
+        # replies praising or just answering the learner are not corrections
+        if not is_correction(message.content):
+            continue
+        corrections.append(message)
+        if len(corrections) == limit:
+            break
+
+    if not corrections:
+        return f"No past corrections found for '{phrase}'."
+    lines = [f"Past corrections for '{phrase}':"]
+    for message in corrections:
+        content = message.content if len(message.content) <= 300 else message.content[:300] + "..."
+        lines.append(f"\n{message.timestamp:%Y-%m-%d}: {content}")
+    return "\n".join(lines)
+
+def get_progress(phone_id: str) -> str:
+    """Summarizes a learner's practice from their running totals."""
+    stats, mistakes = UserStats.get_progress(phone_id)
+    if stats is None or stats.messages == 0:
+        return "No progress yet, send me a message to start practicing!"
+    # a streak ends once a whole day passed without a message
+    streak = stats.streak if datetime.now().toordinal() - stats.last_day <= 1 else 0
+    lines = [
+        "Your progress:",
+        f"Messages sent: {stats.messages}",
+        f"Corrections received: {stats.corrections}",
+        f"Streak: {streak} {'day' if streak == 1 else 'days'} (longest {stats.longest_streak})",
+    ]
+    if mistakes:
+        lines.append("Most frequent mistakes: " + ", ".join(f"{word} ({count})" for word, count in mistakes))
+    return "\n".join(lines)
+
+def get_response(
+    phone_id: str,
+    new_message: str,
+    language: str = LEARNING_MODE,
+    prompt: Optional[str] = None,
+    reply_to: Optional[Dict] = None,
+):
+    """Answers a learner's message and stores both in their conversation.
 
-    openai_messages = openai_messages[::-1]
+    Args:
+        phone_id: key of the conversation
+        new_message: the learner's message
+        language: language the learner practices
+        prompt: system prompt, defaults to the tutor prompt for `language`
+        reply_to: where to deliver the reply, queues it in the outbox together with storing it
+    """
+    if new_message.startswith("/review"):
+        # commands and their replies are stored without a role so they stay out of the conversation
+        Message.add_message(phone_id, new_message, MessageType.user_command, timestamp=datetime.now())
+        with span("review"):
+            review = get_review(phone_id, new_message[len("/review"):].strip())
+        Message.add_message(phone_id, review, MessageType.bot_command_message, timestamp=datetime.now(), outbox=reply_to)
+        return review
+
+    if new_message.startswith("/progress"):
+        Message.add_message(phone_id, new_message, MessageType.user_command, timestamp=datetime.now())
+        with span("progress"):
+            progress = get_progress(phone_id)
+        Message.add_message(phone_id, progress, MessageType.bot_command_message, timestamp=datetime.now(), outbox=reply_to)
+        return progress
+
+    with span("history"):
+        openai_messages = Message.get_conversation(phone_id, 100)
 
     # Add new_message to database
     if new_message.startswith("/reset") or len(openai_messages) == 0:
         Message.add_message(phone_id, new_message, MessageType.bot_command_message, timestamp=datetime.now())
-        starter = get_starter()
-        Message.add_message(phone_id, starter, MessageType.bot_message, timestamp=datetime.now())        
+        starter = get_starter(language)
+        Message.add_message(phone_id, starter, MessageType.bot_message, timestamp=datetime.now(), outbox=reply_to)
         return starter
     
-    Message.add_message(phone_id, new_message, MessageType.user_message, timestamp=datetime.now())
+    with span("store"):
+        Message.add_message(phone_id, new_message, MessageType.user_message, timestamp=datetime.now())
 
     reminder = "" # f"(Remember to correct my mistakes if I made any, then continue the conversation using beginners {LEARNING_MODE})"
     openai_messages.append({"role": "user", "content": f"{new_message}\n\n{reminder}"})
 
+    with span("trim"):
+        openai_messages = trim_conversation(openai_messages, 3000)
+
     # get response from openai
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages = [
-            {"role": "system", "content": STARTER_PROMPT},
-            *trim_conversation(openai_messages, 3000)
-        ]
-    )
+    try:
+        bot_message = complete([
+            {"role": "system", "content": prompt or get_tutor_prompt(language)},
+            *openai_messages
+        ])
+    except (CircuitOpenError, CompletionError) as error:
+        # the learner's message is kept, so it is answered together with the next one
+        logging.warning("OpenAI unavailable (%s), asking %s to try again", error, phone_id)
+        try_again = TRY_AGAIN_MESSAGES.get(language, TRY_AGAIN_MESSAGES[LEARNING_MODE])
+        Message.add_message(phone_id, try_again, MessageType.bot_command_message, timestamp=datetime.now(), outbox=reply_to)
+        return try_again
 
     # Add response to database
-    bot_message = response.choices[0]["message"]
-    Message.add_message(phone_id, bot_message["content"], MessageType.bot_message, timestamp=datetime.now())
+    with span("store"):
+        Message.add_message(
+            phone_id, bot_message, MessageType.bot_message, timestamp=datetime.now(), outbox=reply_to, answers=new_message
+        )
 
-    return bot_message["content"]
+    return bot_message
 
 def cli():
+    init_db()
     phone_id = "123456789"
     user_message = "/reset"
     while True:
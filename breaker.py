@@ -0,0 +1,133 @@
+"""Circuit breaker for calls to a service that can become slow or unavailable.
+
+The breaker counts the calls of the last `window` seconds. Once at least
+`min_calls` were made and `failure_rate` of them failed or took longer than
+`slow_seconds`, it opens: calls fail at once with `CircuitOpenError` instead
+of waiting for the service, and callers answer with a fallback. After
+`open_seconds` the breaker lets `probes` calls through. If they succeed it
+closes again, otherwise it stays open for another `open_seconds`.
+
+    with span("openai"):
+        response = openai_breaker.call(openai.ChatCompletion.create, model=..., messages=...)
+
+Every gunicorn worker has its own breakers.
+"""
+from collections import deque
+import logging
+from threading import Lock
+import time
+from typing import Callable, Deque, List, Tuple
+
+from metrics import registry
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a service whose circuit is open."""
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        window: float = 60,
+        min_calls: int = 10,
+        failure_rate: float = 0.5,
+        slow_seconds: float = 15,
+        open_seconds: float = 30,
+        probes: int = 1,
+    ):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_seconds = slow_seconds
+        self.open_seconds = open_seconds
+        self.probes = probes
+
+        self.state = CLOSED
+        self.rejected = 0
+        # (monotonic time, failed) of the calls in the window
+        self._calls: Deque[Tuple[float, bool]] = deque()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = 0
+        self._lock = Lock()
+        _breakers.append(self)
+
+    def call(self, function: Callable, *args, **kwargs):
+        """Calls `function` unless the circuit is open, recording whether it failed or was slow."""
+        self._before_call()
+        started = time.monotonic()
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            self._record(started, failed=True)
+            raise
+        self._record(started, failed=time.monotonic() - started >= self.slow_seconds)
+        return result
+
+    def _before_call(self) -> None:
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                self._transition(HALF_OPEN)
+                self._probing = 0
+            if self.state == CLOSED:
+                return
+            if self.state == HALF_OPEN and self._probing < self.probes:
+                self._probing += 1
+                return
+            self.rejected += 1
+        raise CircuitOpenError(f"Circuit {self.name} is open")
+
+    def _record(self, started: float, failed: bool) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if failed:
+                    self._open(now)
+                else:
+                    self._transition(CLOSED)
+                    self._calls.clear()
+                    self._failures = 0
+                return
+            if self.state == OPEN:
+                # started before the circuit opened
+                return
+
+            self._calls.append((now, failed))
+            self._failures += failed
+            while self._calls and self._calls[0][0] < now - self.window:
+                self._failures -= self._calls.popleft()[1]
+            if len(self._calls) >= self.min_calls and self._failures >= self.failure_rate * len(self._calls):
+                self._open(now)
+
+    def _open(self, now: float) -> None:
+        self._transition(OPEN)
+        self._opened_at = now
+        self._calls.clear()
+        self._failures = 0
+
+    def _transition(self, state: str) -> None:
+        if state != self.state:
+            logging.warning("Circuit %s is %s", self.name, state.replace("_", "-"))
+            self.state = state
+
+
+_breakers: List[CircuitBreaker] = []
+
+registry.collect(
+    "gringolingo_circuit_state", "Circuit breakers in each state, summed over workers",
+    lambda: {
+        (("circuit", breaker.name), ("state", state)): int(breaker.state == state)
+        for breaker in _breakers for state in (CLOSED, OPEN, HALF_OPEN)
+    },
+)
+registry.collect(
+    "gringolingo_circuit_rejected_total", "Calls that failed fast because their circuit was open",
+    lambda: {(("circuit", breaker.name),): breaker.rejected for breaker in _breakers},
+    type="counter",
+)
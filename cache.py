@@ -0,0 +1,132 @@
+from collections import OrderedDict
+from os import environ
+from threading import Lock
+import time
+from typing import Callable, Dict, List, Optional
+
+
+class ConversationCache:
+    """Bounded LRU of each user's recent conversation window.
+
+    Entries hold the OpenAI formatted messages (role/content dicts) since the
+    user's last reset, oldest first. The cache is write-through: `Message.add_message`
+    appends to an entry that is already cached, so a hot user never needs to
+    re-read their history from the database. Entries expire after `ttl` seconds
+    so that writes made by another worker process are eventually picked up.
+    """
+
+    def __init__(self, max_users: int = 1024, max_messages: int = 100, ttl: float = 600, max_bytes: int = 32 * 1024 * 1024):
+        self.max_users = max_users
+        self.max_messages = max_messages
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = Lock()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, phone_id: str) -> Optional[List[Dict[str, str]]]:
+        """Returns a copy of the cached window for a user or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(phone_id)
+            if entry is None or entry.expires_at < time.monotonic():
+                if entry is not None:
+                    self._remove(phone_id)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(phone_id)
+            self.hits += 1
+            return list(entry.messages)
+
+    def put(self, phone_id: str, messages: List[Dict[str, str]]) -> None:
+        """Stores the window for a user, replacing anything already cached."""
+        with self._lock:
+            if phone_id in self._entries:
+                self._remove(phone_id)
+            entry = _Entry(messages[-self.max_messages:], time.monotonic() + self.ttl)
+            self._entries[phone_id] = entry
+            self._bytes += entry.size
+            self._evict()
+
+    def append(self, phone_id: str, message: Optional[Dict[str, str]], reset: bool = False) -> None:
+        """Write-through update for a new message. Users that are not cached are left alone."""
+        with self._lock:
+            entry = self._entries.get(phone_id)
+            if entry is None:
+                return
+            self._bytes -= entry.size
+            if reset:
+                entry.clear()
+            if message is not None:
+                entry.append(message, self.max_messages)
+            self._bytes += entry.size
+            self._entries.move_to_end(phone_id)
+            self._evict()
+
+    def invalidate(self, phone_id: Optional[str] = None) -> None:
+        """Drops a single user, or every user if no phone_id is given."""
+        with self._lock:
+            if phone_id is None:
+                self._entries.clear()
+                self._bytes = 0
+            elif phone_id in self._entries:
+                self._remove(phone_id)
+
+    def invalidate_matching(self, predicate: Callable[[str], bool]) -> None:
+        """Drops every user whose phone_id matches the predicate."""
+        with self._lock:
+            for phone_id in [phone_id for phone_id in self._entries if predicate(phone_id)]:
+                self._remove(phone_id)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "users": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _remove(self, phone_id: str) -> None:
+        entry = self._entries.pop(phone_id)
+        self._bytes -= entry.size
+
+    def _evict(self) -> None:
+        while self._entries and (len(self._entries) > self.max_users or self._bytes > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            self.evictions += 1
+
+
+class _Entry:
+    __slots__ = ("messages", "expires_at", "size")
+
+    def __init__(self, messages: List[Dict[str, str]], expires_at: float):
+        self.messages = list(messages)
+        self.expires_at = expires_at
+        self.size = sum(len(message["content"]) for message in self.messages)
+
+    def append(self, message: Dict[str, str], max_messages: int) -> None:
+        self.messages.append(message)
+        self.size += len(message["content"])
+        while len(self.messages) > max_messages:
+            self.size -= len(self.messages.pop(0)["content"])
+
+    def clear(self) -> None:
+        self.messages = []
+        self.size = 0
+
+
+conversation_cache = ConversationCache(
+    max_users=int(environ.get("CONVERSATION_CACHE_USERS", 1024)),
+    max_messages=int(environ.get("CONVERSATION_CACHE_MESSAGES", 100)),
+    ttl=float(environ.get("CONVERSATION_CACHE_TTL", 600)),
+    max_bytes=int(environ.get("CONVERSATION_CACHE_BYTES", 32 * 1024 * 1024)),
+)
@@ -0,0 +1,57 @@
+"""Recognizes corrections in the tutor's replies, for the learner's progress report.
+
+The tutor is told to correct mistakes and then carry on with the conversation
+(see `bot.get_tutor_prompt`), and corrections usually quote the corrected
+sentence: "Small correction: 'I went home yesterday'." A reply counts as a
+correction when it uses one of the usual phrasings. The learner's mistakes
+are the words of their message that the quoted correction replaced, or the
+words of a quoted mistake ("We say 'I went', not 'I goed'") that the
+correction does not repeat. This is a heuristic: rewrites of a whole sentence are not attributed to single words,
+and a correction without a quote counts as a correction without mistakes.
+"""
+import re
+from typing import List, Set
+
+# "correct" alone is usually praise ("That is correct!"), only phrasings that fix something count
+CORRECTION = re.compile(
+    r"\b(corrections?|should (be|say)|instead of|you meant|we say|we'd say|"
+    r"correç(ão|ões)|corrigi\w*|o correto é|em vez de|ao invés de|dizemos)\b",
+    re.IGNORECASE,
+)
+# an apostrophe inside a word ("don't") neither opens nor closes a quote
+QUOTED = re.compile(r"(?<!\w)'(.{2,200}?)'(?!\w)|\"([^\"]{2,200})\"|“([^”]{2,200})”|‘([^’]{2,200})’")
+WORD = re.compile(r"[^\W\d_]+(?:'[^\W\d_]+)?")
+
+# a correction replacing more words than this rewrote the sentence rather than fixing a mistake
+MAX_MISTAKES = 3
+
+
+def words(text: str) -> Set[str]:
+    return {word.lower() for word in WORD.findall(text)}
+
+
+def is_correction(reply: str) -> bool:
+    return CORRECTION.search(reply) is not None
+
+
+def find_mistakes(message: str, reply: str) -> List[str]:
+    """Returns the words of a learner's message that the reply corrected, if it is a correction."""
+    if not is_correction(reply):
+        return []
+    learner = words(message)
+    quotes = [words(next(group for group in match if group)) for match in QUOTED.findall(reply)]
+    # quotes that repeat the learner's own words are the mistake, not its correction
+    repeated = [quote for quote in quotes if quote and not quote - learner]
+    quotes = [quote for quote in quotes if quote - learner]
+    if not learner or not quotes:
+        return []
+    corrected = max(quotes, key=lambda quote: len(quote & learner))
+    if repeated:
+        # "We say 'I went', not 'I goed'": the quoted mistake says which words were wrong
+        mistakes = sorted(set().union(*repeated) - set().union(*quotes))
+    elif len(corrected & learner) * 2 < len(learner):
+        # otherwise the correction is a rewrite of the learner's message, it keeps most of its words
+        return []
+    else:
+        mistakes = sorted(learner - corrected)
+    return mistakes if len(mistakes) <= MAX_MISTAKES else []
@@ -1,16 +1,35 @@
 from datetime import datetime
 from enum import Enum
-from typing import List, Optional
+import json
+import logging
+from os import environ
+from threading import Lock
+import time
+from typing import Dict, List, Optional, Tuple
+import zlib
 
-from sqlalchemy import Column, Integer, String, DateTime, Enum as SQLAlchemyEnum, create_engine, desc
+from sqlalchemy import (
+    Column, Integer, SmallInteger, String, Text, Float, LargeBinary, Enum as SQLAlchemyEnum, ForeignKey, Index,
+    UniqueConstraint, case, create_engine, desc, func, inspect, or_, select, text,
+)
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, joinedload
+from sqlalchemy.orm import aliased, sessionmaker, joinedload
+from sqlalchemy.types import TypeDecorator
 
+from cache import conversation_cache
+from corrections import find_mistakes, is_correction
+from green import engine_options
 
-engine = create_engine("sqlite:///example.db") #, echo=True)
+DATABASE_URL = environ.get("DATABASE_URL", "sqlite:///example.db")
+
+engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL)) #, echo=True)
 Session = sessionmaker(bind=engine)
 Base = declarative_base()
 
+# contents at least this long are stored zlib compressed, 0 disables compression
+COMPRESSION_THRESHOLD = int(environ.get("MESSAGE_COMPRESSION_THRESHOLD", 512))
+
 
 class MessageType(Enum):
     user_message = "user_message"
@@ -19,6 +38,76 @@ class MessageType(Enum):
     bot_command_message = "bot_command_message"
     bot_message = "bot_message"
 
+# stored codes for each message type, never reuse or renumber these
+MESSAGE_TYPE_CODES = {
+    MessageType.user_message: 1,
+    MessageType.user_command: 2,
+    MessageType.system: 3,
+    MessageType.bot_command_message: 4,
+    MessageType.bot_message: 5,
+}
+MESSAGE_TYPES = {code: message_type for message_type, code in MESSAGE_TYPE_CODES.items()}
+
+# OpenAI chat roles for the message types that are part of a conversation
+MESSAGE_ROLES = {
+    MessageType.user_message: "user",
+    MessageType.system: "system",
+    MessageType.bot_message: "assistant",
+}
+
+# types stored when the learner writes, first messages and /reset are stored as bot commands
+ACTIVITY_TYPES = (MessageType.user_message, MessageType.user_command, MessageType.bot_command_message)
+
+def is_reset(message_type: MessageType, content: str) -> bool:
+    return message_type == MessageType.bot_command_message and content == "/reset"
+
+
+class MessageTypeCode(TypeDecorator):
+    """Stores a MessageType as a small integer."""
+    impl = SmallInteger
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else MESSAGE_TYPE_CODES[value]
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else MESSAGE_TYPES[value]
+
+
+class EpochDateTime(TypeDecorator):
+    """Stores a naive local datetime as integer seconds since the epoch."""
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else int(value.timestamp())
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else datetime.fromtimestamp(value)
+
+
+class CompressedText(TypeDecorator):
+    """Text that is transparently zlib compressed when it is long.
+
+    Short contents are stored as plain TEXT. Long contents are stored as a
+    zlib BLOB, which SQLite's dynamic typing allows in the same column.
+    """
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None or not COMPRESSION_THRESHOLD or len(value) < COMPRESSION_THRESHOLD:
+            return value
+        raw = value.encode()
+        compressed = zlib.compress(raw)
+        return compressed if len(compressed) < len(raw) else value
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, bytes):
+            return zlib.decompress(value).decode()
+        return value
+
+
 class UserMode(Enum):
     beginner = "beginner"
     intermediate = "intermediate"
@@ -29,6 +118,11 @@ class User(Base):
     id = Column(Integer, primary_key=True)
     phone_id = Column(String, unique=True)
     mode = Column(SQLAlchemyEnum(UserMode))
+    # when the learner last wrote, kept up to date by `Message.add_message`
+    last_active = Column(EpochDateTime, index=True)
+
+    # phone_id -> users.id, ids never change once assigned
+    _ids: Dict[str, int] = {}
 
     @staticmethod
     def get_user(phone_id: str) -> Optional["User"]:
@@ -43,25 +137,86 @@ class User(Base):
             return user.mode
         return None
 
+    @staticmethod
+    def get_id(phone_id: str, create: bool = False) -> Optional[int]:
+        """Returns the integer id of a user, creating the user if `create` is set."""
+        user_id = User._ids.get(phone_id)
+        if user_id is not None:
+            return user_id
+
+        with Session() as session:
+            user_id = session.query(User.id).filter(User.phone_id == phone_id).scalar()
+            if user_id is None and create:
+                user = User(phone_id=phone_id)
+                session.add(user)
+                try:
+                    session.commit()
+                    user_id = user.id
+                except IntegrityError:
+                    # created concurrently by another worker
+                    session.rollback()
+                    user_id = session.query(User.id).filter(User.phone_id == phone_id).scalar()
+
+        if user_id is not None:
+            User._ids[phone_id] = user_id
+        return user_id
+
 class Message(Base):
     __tablename__ = "messages"
     id = Column(Integer, primary_key=True)
-    phone_id = Column(String)
-    content = Column(String)
-    timestamp = Column(DateTime)
-    message_type = Column(SQLAlchemyEnum(MessageType))
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    content = Column(CompressedText)
+    timestamp = Column(EpochDateTime)
+    message_type = Column(MessageTypeCode)
+
+    __table_args__ = (Index("ix_messages_user_timestamp", "user_id", "timestamp"),)
 
     @staticmethod
     def add_message(
-        phone_id: str, content: str, message_type: MessageType, timestamp: Optional[datetime] = None
+        phone_id: str,
+        content: str,
+        message_type: MessageType,
+        timestamp: Optional[datetime] = None,
+        outbox: Optional[Dict] = None,
+        answers: Optional[str] = None,
     ) -> "Message":
+        """Stores a message of a conversation.
+
+        Args:
+            phone_id: key of the conversation
+            content: text of the message
+            message_type: who wrote the message and whether it is part of the conversation
+            timestamp: when the message was written, now by default
+            outbox: for replies, the `OutboxMessage` columns saying where to deliver it. The
+                delivery is queued in the same transaction, see outbox.py
+            answers: for bot replies, the learner's message they answer, to count corrections
+        """
         if timestamp is None:
             timestamp = datetime.now()
+        user_id = User.get_id(phone_id, create=True)
         with Session() as session:
-            message = Message(phone_id=phone_id, content=content, timestamp=timestamp, message_type=message_type)
+            message = Message(user_id=user_id, content=content, timestamp=timestamp, message_type=message_type)
             session.add(message)
+            if message_type in SEARCHABLE_TYPES or outbox is not None:
+                session.flush()
+            if message_type in SEARCHABLE_TYPES:
+                MessageIndex.add(session, message)
+            if outbox is not None:
+                session.add(OutboxMessage(message_id=message.id, key=phone_id, status=OutboxStatus.pending, **outbox))
+            if message_type in ACTIVITY_TYPES:
+                session.query(User).filter(User.id == user_id).update(
+                    {User.last_active: timestamp}, synchronize_session=False
+                )
+            UserStats.record(session, user_id, message_type, timestamp, content, answers)
             session.commit()
-            return message
+
+        role = MESSAGE_ROLES.get(message_type)
+        conversation_cache.append(
+            phone_id,
+            {"role": role, "content": content} if role else None,
+            reset=is_reset(message_type, content),
+        )
+        return message
 
     @staticmethod
     def update_user_mode(phone_id: str, mode: UserMode) -> None:
@@ -76,34 +231,960 @@ class Message(Base):
 
     @staticmethod
     def get_most_recent_message(phone_id: str, before_timestamp: datetime) -> Optional["Message"]:
+        user_id = User.get_id(phone_id)
+        if user_id is None:
+            return None
         with Session() as session:
             message = (
                 session.query(Message)
-                .filter(Message.phone_id == phone_id)
+                .filter(Message.user_id == user_id)
                 .filter(Message.timestamp < before_timestamp)
-                .order_by(desc(Message.timestamp))
+                .order_by(desc(Message.timestamp), desc(Message.id))
                 .first()
             )
             return message
 
     @staticmethod
     def get_last_n_messages(phone_id: str, n: int) -> List["Message"]:
+        user_id = User.get_id(phone_id)
+        if user_id is None:
+            return []
         with Session() as session:
             messages = (
                 session.query(Message)
-                .filter(Message.phone_id == phone_id)
-                .order_by(Message.timestamp.asc())
+                .filter(Message.user_id == user_id)
+                .order_by(desc(Message.timestamp), desc(Message.id))
                 .limit(n)
                 .all()
             )
-            return messages
-        
-# create tables if they don't exist
-try:
-    Base.metadata.create_all(engine)
-except:
-    # delete database and try again
-    import os
-    print("Deleting database and trying again")
-    os.remove("example.db")
+            return messages[::-1]
+
+    @staticmethod
+    def get_conversation(phone_id: str, n: int = 100) -> List[Dict[str, str]]:
+        """Returns the OpenAI formatted messages since the user's last reset, oldest first.
+
+        Served from the conversation cache when possible, otherwise loaded from
+        the last `n` stored messages and cached.
+        """
+        openai_messages = conversation_cache.get(phone_id)
+        if openai_messages is not None:
+            return openai_messages
+
+        openai_messages = []
+        for message in Message.get_last_n_messages(phone_id, n)[::-1]:
+            if is_reset(message.message_type, message.content):
+                break
+            role = MESSAGE_ROLES.get(message.message_type)
+            if role:
+                openai_messages.append({"role": role, "content": message.content})
+        openai_messages = openai_messages[::-1]
+
+        conversation_cache.put(phone_id, openai_messages)
+        return list(openai_messages)
+
+    @staticmethod
+    def get_history(
+        phone_id: str, since: Optional[datetime] = None, until: Optional[datetime] = None
+    ) -> List["Message"]:
+        """Returns a user's full history, archived and live, oldest first."""
+        user_id = User.get_id(phone_id)
+        if user_id is None:
+            return []
+        with Session() as session:
+            query = session.query(Message).filter(Message.user_id == user_id)
+            if since is not None:
+                query = query.filter(Message.timestamp >= since)
+            if until is not None:
+                query = query.filter(Message.timestamp < until)
+            live = query.order_by(Message.timestamp.asc(), Message.id.asc()).all()
+        return ArchivedMessages.get_messages(user_id, since, until) + live
+
+
+class ArchivedMessages(Base):
+    """A compressed chunk of one user's messages moved out of the live messages table."""
+    __tablename__ = "messages_archive"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    first_timestamp = Column(EpochDateTime)
+    last_timestamp = Column(EpochDateTime)
+    count = Column(Integer)
+    payload = Column(LargeBinary)
+
+    @staticmethod
+    def pack(messages: List[Message]) -> bytes:
+        rows = [
+            [message.timestamp.isoformat(), message.message_type.value, message.content]
+            for message in messages
+        ]
+        return zlib.compress(json.dumps(rows, separators=(",", ":")).encode(), 9)
+
+    def unpack(self) -> List[Message]:
+        return [
+            Message(
+                user_id=self.user_id,
+                content=content,
+                timestamp=datetime.fromisoformat(timestamp),
+                message_type=MessageType(message_type),
+            )
+            for timestamp, message_type, content in json.loads(zlib.decompress(self.payload))
+        ]
+
+    @staticmethod
+    def get_messages(
+        user_id: int, since: Optional[datetime] = None, until: Optional[datetime] = None
+    ) -> List[Message]:
+        """Returns the archived messages of a user, oldest first. Archived messages are detached."""
+        with Session() as session:
+            query = session.query(ArchivedMessages).filter(ArchivedMessages.user_id == user_id)
+            if since is not None:
+                query = query.filter(ArchivedMessages.last_timestamp >= since)
+            if until is not None:
+                query = query.filter(ArchivedMessages.first_timestamp < until)
+            chunks = query.all()
+
+        messages = sorted(
+            (message for chunk in chunks for message in chunk.unpack()), key=lambda message: message.timestamp
+        )
+        return [
+            message for message in messages
+            if (since is None or message.timestamp >= since) and (until is None or message.timestamp < until)
+        ]
+
+
+class MediaStatus(Enum):
+    pending = "pending"
+    downloaded = "downloaded"
+    failed = "failed"
+    deleted = "deleted"
+
+class Media(Base):
+    """A media file sent by a user, downloaded in the background by `media.MediaQueue`."""
+    __tablename__ = "media"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    media_id = Column(String, unique=True)
+    media_type = Column(String)
+    mime_type = Column(String)
+    path = Column(String)
+    size = Column(Integer)
+    status = Column(SQLAlchemyEnum(MediaStatus))
+    timestamp = Column(EpochDateTime)
+
+    @staticmethod
+    def add_media(phone_id: str, media_id: str, media_type: str, mime_type: str) -> Optional[int]:
+        """Records a pending download, returns None if the media was already recorded."""
+        user_id = User.get_id(phone_id, create=True)
+        with Session() as session:
+            media = Media(
+                user_id=user_id,
+                media_id=media_id,
+                media_type=media_type,
+                mime_type=mime_type,
+                status=MediaStatus.pending,
+                timestamp=datetime.now(),
+            )
+            session.add(media)
+            try:
+                session.flush()
+            except IntegrityError:
+                # webhooks are retried, the same media can arrive twice
+                session.rollback()
+                return None
+            id = media.id
+            session.commit()
+            return id
+
+    @staticmethod
+    def update_media(id: int, status: MediaStatus, path: Optional[str] = None, size: Optional[int] = None) -> None:
+        with Session() as session:
+            values = {Media.status: status}
+            if path is not None:
+                values[Media.path] = path
+            if size is not None:
+                values[Media.size] = size
+            session.query(Media).filter(Media.id == id).update(values)
+            session.commit()
+
+    @staticmethod
+    def mark_deleted(paths: List[str]) -> None:
+        with Session() as session:
+            session.query(Media).filter(Media.path.in_(paths)).update(
+                {Media.status: MediaStatus.deleted}, synchronize_session=False
+            )
+            session.commit()
+
+
+class Turn(Base):
+    """A message waiting to be answered by the worker owning its shard, see `shards.ShardedQueue`."""
+    __tablename__ = "turns"
+    id = Column(Integer, primary_key=True)
+    shard = Column(SmallInteger, nullable=False)
+    key = Column(String, nullable=False)
+    kind = Column(String, nullable=False)
+    payload = Column(Text)
+    # epoch seconds, to time how long turns wait for their shard
+    created = Column(Float)
+
+    # ids are never reused, replies in the outbox refer to the turn they answer
+    __table_args__ = (Index("ix_turns_shard_id", "shard", "id"), {"sqlite_autoincrement": True})
+
+    @staticmethod
+    def add_turn(shard: int, key: str, kind: str, payload: Dict) -> int:
+        with Session() as session:
+            turn = Turn(shard=shard, key=key, kind=kind, payload=json.dumps(payload), created=time.time())
+            session.add(turn)
+            session.flush()
+            # read before committing, the turn may be answered and deleted right after
+            id = turn.id
+            session.commit()
+            return id
+
+    @staticmethod
+    def get_pending(shards: List[int], limit: int = 100) -> List["Turn"]:
+        """Returns the oldest turns of some shards, in the order they arrived."""
+        with Session() as session:
+            return (
+                session.query(Turn)
+                .filter(Turn.shard.in_(shards))
+                .order_by(Turn.id)
+                .limit(limit)
+                .all()
+            )
+
+    @staticmethod
+    def pending_shards(shards: List[int]) -> List[int]:
+        """Returns which of some shards have turns waiting or being answered."""
+        with Session() as session:
+            return [shard for shard, in session.query(Turn.shard).filter(Turn.shard.in_(shards)).distinct()]
+
+    @staticmethod
+    def count_pending(shards: Optional[List[int]] = None, key: Optional[str] = None) -> int:
+        """Counts the turns waiting or being answered, optionally only of some shards or of one key."""
+        with Session() as session:
+            query = session.query(Turn.id)
+            if shards is not None:
+                query = query.filter(Turn.shard.in_(shards))
+            if key is not None:
+                query = query.filter(Turn.key == key)
+            return query.count()
+
+    @staticmethod
+    def delete_turn(id: int) -> None:
+        with Session() as session:
+            session.query(Turn).filter(Turn.id == id).delete()
+            session.commit()
+
+
+class ShardLease(Base):
+    """Which worker answers the turns of a shard, see `shards.ShardedQueue`.
+
+    A worker answers the turns of a shard only while it holds the shard's
+    lease, so two workers never answer the same learner at once, also while
+    gunicorn runs old and new workers side by side during a reload.
+    """
+    __tablename__ = "shard_leases"
+    shard = Column(SmallInteger, primary_key=True, autoincrement=False)
+    # host and process id of the worker
+    owner = Column(String, nullable=False)
+    # epoch seconds after which another worker may take the shard
+    expires = Column(Float, nullable=False)
+
+    @staticmethod
+    def acquire(shards: List[int], owner: str, until: float, expired_before: Optional[float] = None) -> List[int]:
+        """Renews the leases an owner holds on some shards and takes those that expired.
+
+        Args:
+            shards: shards to lease
+            owner: the worker leasing them
+            until: epoch seconds the leases are held until
+            expired_before: only take leases of other workers that expired before this time, defaults to now
+
+        Returns:
+            list: The shards the owner holds until `until`
+        """
+        if not shards:
+            return []
+        if expired_before is None:
+            expired_before = time.time()
+        with Session() as session:
+            existing = {shard for shard, in session.query(ShardLease.shard).filter(ShardLease.shard.in_(shards))}
+            missing = [shard for shard in shards if shard not in existing]
+            if missing:
+                # never leased, taken like an expired lease, by the update below
+                session.add_all(ShardLease(shard=shard, owner=owner, expires=0) for shard in missing)
+                try:
+                    session.commit()
+                except IntegrityError:
+                    # created meanwhile by another worker
+                    session.rollback()
+            # one statement, so that of two workers taking the same lease one changes no row
+            session.query(ShardLease).filter(
+                ShardLease.shard.in_(shards),
+                or_(ShardLease.owner == owner, ShardLease.expires < expired_before),
+            ).update({"owner": owner, "expires": until}, synchronize_session=False)
+            session.commit()
+            return [
+                shard for shard, in session.query(ShardLease.shard)
+                .filter(ShardLease.shard.in_(shards), ShardLease.owner == owner, ShardLease.expires == until)
+            ]
+
+    @staticmethod
+    def release(shards: List[int], owner: str) -> None:
+        """Ends an owner's leases on some shards, so that other workers take them at once."""
+        if not shards:
+            return
+        with Session() as session:
+            session.query(ShardLease).filter(ShardLease.shard.in_(shards), ShardLease.owner == owner).update(
+                {"expires": 0}, synchronize_session=False
+            )
+            session.commit()
+
+
+class OutboxStatus(Enum):
+    pending = "pending"
+    sent = "sent"
+    failed = "failed"
+
+class OutboxMessage(Base):
+    """A reply waiting to be delivered, or delivered, by `outbox.Outbox`.
+
+    Rows are written in the transaction that stores the reply, so every stored
+    reply is delivered and no reply is generated twice for the same turn.
+    """
+    __tablename__ = "outbox"
+    id = Column(Integer, primary_key=True)
+    message_id = Column(Integer, ForeignKey("messages.id"), nullable=False)
+    shard = Column(SmallInteger, nullable=False)
+    key = Column(String, nullable=False)
+    # whatsapp or messenger, with the tenant id and recipient id on that channel
+    channel = Column(String, nullable=False)
+    tenant = Column(String, nullable=False)
+    recipient = Column(String, nullable=False)
+    # the turn answered by this reply
+    turn_id = Column(Integer, unique=True)
+    status = Column(SQLAlchemyEnum(OutboxStatus), nullable=False)
+    attempts = Column(SmallInteger, nullable=False, default=0)
+    # epoch seconds before which a failed delivery is not retried
+    next_attempt = Column(Float)
+    # message id returned by the Graph API
+    provider_id = Column(String)
+    sent = Column(EpochDateTime)
+
+    __table_args__ = (Index("ix_outbox_status_shard_id", "status", "shard", "id"),)
+
+    @staticmethod
+    def answered(turn_id: int) -> bool:
+        """True if the reply to a turn was already stored, e.g. before a worker died delivering it."""
+        with Session() as session:
+            return session.query(OutboxMessage.id).filter(OutboxMessage.turn_id == turn_id).first() is not None
+
+    @staticmethod
+    def get_pending(shards: List[int], limit: int = 100, now: Optional[float] = None) -> List[Dict]:
+        """Returns the oldest replies of some shards due for delivery with their content, in the order they were stored.
+
+        A reply waiting for its retry is not due, and neither are the later
+        replies to the same learner, so that replies arrive in order. Both are
+        left out by the query, so however many replies are waiting, the limit
+        only counts replies that can be sent now.
+        """
+        if now is None:
+            now = time.time()
+        earlier = aliased(OutboxMessage)
+        waiting = select(earlier.id).where(
+            earlier.status == OutboxStatus.pending,
+            earlier.shard == OutboxMessage.shard,
+            earlier.key == OutboxMessage.key,
+            earlier.id < OutboxMessage.id,
+            earlier.next_attempt > now,
+        ).exists()
+        with Session() as session:
+            rows = (
+                session.query(OutboxMessage, Message.content)
+                .join(Message, Message.id == OutboxMessage.message_id)
+                .filter(OutboxMessage.status == OutboxStatus.pending, OutboxMessage.shard.in_(shards))
+                .filter(or_(OutboxMessage.next_attempt.is_(None), OutboxMessage.next_attempt <= now))
+                .filter(~waiting)
+                .order_by(OutboxMessage.id)
+                .limit(limit)
+                .all()
+            )
+            return [
+                dict(
+                    id=row.id, key=row.key, channel=row.channel, tenant=row.tenant, recipient=row.recipient,
+                    attempts=row.attempts, next_attempt=row.next_attempt, content=content,
+                )
+                for row, content in rows
+            ]
+
+    @staticmethod
+    def pending_shards() -> List[int]:
+        """Returns the shards with replies waiting for delivery."""
+        with Session() as session:
+            return [
+                shard for shard, in session.query(OutboxMessage.shard)
+                .filter(OutboxMessage.status == OutboxStatus.pending).distinct()
+            ]
+
+    @staticmethod
+    def update_batch(updates: Dict[int, Dict]) -> None:
+        """Records the outcome of several deliveries in one transaction."""
+        with Session() as session:
+            for id, values in updates.items():
+                session.query(OutboxMessage).filter(OutboxMessage.id == id).update(values, synchronize_session=False)
+            session.commit()
+
+
+# delivery statuses reported by the Graph API, a higher code replaces a lower one
+DELIVERY_STATUS_CODES = {"sent": 1, "delivered": 2, "read": 3, "failed": 4}
+
+class MessageStatus(Base):
+    """How far an outbound message got, from the status webhooks, see statuses.py.
+
+    Keyed by the message id the Graph API returned, which replies keep in
+    `outbox.provider_id`. Statuses arrive out of order and more than once, so
+    rows are upserted: the furthest status wins and each step keeps the time
+    it was first reported.
+    """
+    __tablename__ = "message_statuses"
+    provider_id = Column(String, primary_key=True)
+    recipient = Column(String)
+    status = Column(SmallInteger, nullable=False)
+    sent = Column(EpochDateTime)
+    delivered = Column(EpochDateTime)
+    read = Column(EpochDateTime)
+    failed = Column(EpochDateTime)
+    # error code of a failed delivery
+    error = Column(Integer)
+
+    @staticmethod
+    def upsert_batch(rows: List[Dict]) -> None:
+        """Records the statuses of many messages in one statement.
+
+        Args:
+            rows: one dict per message with every column, None for those not reported
+        """
+        if not rows:
+            return
+        table = MessageStatus.__table__
+        if engine.dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as upsert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as upsert
+        statement = upsert(table).values(rows)
+        excluded = statement.excluded
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.provider_id],
+            set_={
+                "recipient": func.coalesce(table.c.recipient, excluded.recipient),
+                "status": case((excluded.status > table.c.status, excluded.status), else_=table.c.status),
+                "sent": func.coalesce(table.c.sent, excluded.sent),
+                "delivered": func.coalesce(table.c.delivered, excluded.delivered),
+                "read": func.coalesce(table.c.read, excluded.read),
+                "failed": func.coalesce(table.c.failed, excluded.failed),
+                "error": func.coalesce(excluded.error, table.c.error),
+            },
+        )
+        with engine.begin() as connection:
+            connection.execute(statement)
+
+
+class NudgeStatus(Enum):
+    pending = "pending"
+    generated = "generated"
+    sending = "sending"
+    sent = "sent"
+    failed = "failed"
+    skipped = "skipped"
+
+class Nudge(Base):
+    """A practice reminder for an inactive learner, see nudges.py.
+
+    There is at most one nudge per learner and period of inactivity, identified
+    by the `last_active` time it answers.
+    """
+    __tablename__ = "nudges"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    since = Column(EpochDateTime, nullable=False)
+    status = Column(SQLAlchemyEnum(NudgeStatus), nullable=False)
+    content = Column(Text)
+    timestamp = Column(EpochDateTime)
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "since", name="uq_nudges_user_since"),
+        Index("ix_nudges_status_id", "status", "id"),
+    )
+
+
+class UserStats(Base):
+    """Running totals of a learner's practice, kept up to date by `Message.add_message`.
+
+    Reading a learner's progress is a lookup by primary key, however long their
+    history. `rebuild` recomputes the totals from the live and archived
+    messages, e.g. after importing history.
+    """
+    __tablename__ = "user_stats"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    messages = Column(Integer, nullable=False, default=0)
+    corrections = Column(Integer, nullable=False, default=0)
+    # date.toordinal() of the last day the learner wrote
+    last_day = Column(Integer)
+    streak = Column(Integer, nullable=False, default=0)
+    longest_streak = Column(Integer, nullable=False, default=0)
+
+    @staticmethod
+    def record(
+        session, user_id: int, message_type: MessageType, timestamp: datetime, content: str, answers: Optional[str] = None
+    ) -> None:
+        """Counts a message in its learner's progress, in the session's transaction.
+
+        Args:
+            message_type: only the learner's messages and the replies to them count
+            answers: for bot replies, the learner's message they answer
+        """
+        if message_type == MessageType.user_message:
+            stats = UserStats._get(session, user_id)
+            stats.messages += 1
+            day = timestamp.toordinal()
+            if stats.last_day is None or day > stats.last_day + 1:
+                stats.streak = 1
+            elif day == stats.last_day + 1:
+                stats.streak += 1
+            stats.last_day = max(day, stats.last_day or day)
+            stats.longest_streak = max(stats.longest_streak, stats.streak)
+        elif message_type == MessageType.bot_message and answers is not None and is_correction(content):
+            UserStats._get(session, user_id).corrections += 1
+            for word in find_mistakes(answers, content):
+                mistake = session.get(UserMistake, (user_id, word))
+                if mistake is None:
+                    session.add(UserMistake(user_id=user_id, word=word, count=1))
+                else:
+                    mistake.count += 1
+
+    @staticmethod
+    def _get(session, user_id: int) -> "UserStats":
+        stats = session.get(UserStats, user_id)
+        if stats is None:
+            stats = UserStats(user_id=user_id, messages=0, corrections=0, streak=0, longest_streak=0)
+            session.add(stats)
+        return stats
+
+    @staticmethod
+    def get_progress(phone_id: str, mistakes: int = 5) -> Tuple[Optional["UserStats"], List[Tuple[str, int]]]:
+        """Returns a learner's totals and their most frequent mistakes with their counts."""
+        user_id = User.get_id(phone_id)
+        if user_id is None:
+            return None, []
+        with Session() as session:
+            stats = session.get(UserStats, user_id)
+            top = (
+                session.query(UserMistake.word, UserMistake.count)
+                .filter(UserMistake.user_id == user_id)
+                .order_by(desc(UserMistake.count), UserMistake.word)
+                .limit(mistakes)
+                .all()
+            )
+            return stats, [tuple(row) for row in top]
+
+    @staticmethod
+    def rebuild(batch_size: int = 1000) -> int:
+        """Recomputes the totals of every learner from their live and archived messages.
+
+        Each batch of learners is deleted and recounted in one transaction, so
+        a report never shows empty totals. The app must not be running: a
+        message stored while its learner is being recounted can be counted
+        twice or not at all. `history.py progress` refuses to run while
+        learners are active.
+
+        Returns:
+            int: The number of messages counted
+        """
+        counted = (MessageType.user_message, MessageType.bot_message)
+        count = 0
+        last_user_id = 0
+        while True:
+            with Session() as session:
+                user_ids = [
+                    user_id for user_id, in session.query(User.id)
+                    .filter(User.id > last_user_id)
+                    .order_by(User.id)
+                    .limit(batch_size)
+                ]
+                if not user_ids:
+                    return count
+                session.query(UserMistake).filter(UserMistake.user_id.in_(user_ids)).delete(synchronize_session=False)
+                session.query(UserStats).filter(UserStats.user_id.in_(user_ids)).delete(synchronize_session=False)
+
+                # archived messages are older than the live ones, a stable sort keeps them first on equal timestamps
+                by_user: Dict[int, List[Tuple]] = {}
+                chunks = (
+                    session.query(ArchivedMessages)
+                    .filter(ArchivedMessages.user_id.in_(user_ids))
+                    .order_by(ArchivedMessages.user_id, ArchivedMessages.first_timestamp, ArchivedMessages.id)
+                )
+                for chunk in chunks:
+                    by_user.setdefault(chunk.user_id, []).extend(
+                        (m.message_type, m.timestamp, m.content) for m in chunk.unpack() if m.message_type in counted
+                    )
+                live = (
+                    session.query(Message.user_id, Message.message_type, Message.timestamp, Message.content)
+                    .filter(Message.user_id.in_(user_ids))
+                    .filter(Message.message_type.in_(counted))
+                    .order_by(Message.user_id, Message.timestamp, Message.id)
+                )
+                for user_id, message_type, timestamp, content in live:
+                    by_user.setdefault(user_id, []).append((message_type, timestamp, content))
+
+                for user_id, messages in by_user.items():
+                    # the learner's message each reply answers, a reply answers the message just before it
+                    unanswered = None
+                    for message_type, timestamp, content in sorted(messages, key=lambda message: message[1]):
+                        if message_type == MessageType.user_message:
+                            answers = None
+                            unanswered = content
+                        else:
+                            answers, unanswered = unanswered, None
+                        UserStats.record(session, user_id, message_type, timestamp, content, answers)
+                        count += 1
+                session.commit()
+                last_user_id = user_ids[-1]
+
+
+class UserMistake(Base):
+    """How often a learner was corrected for a word, see corrections.py."""
+    __tablename__ = "user_mistakes"
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    word = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False)
+
+    __table_args__ = (Index("ix_user_mistakes_user_count", "user_id", "count"),)
+
+
+# message types indexed for full-text search
+SEARCHABLE_TYPES = (MessageType.user_message, MessageType.bot_message)
+
+class MessageIndex:
+    """SQLite FTS5 index over user and bot messages.
+
+    The index keeps its own copy of each message, keyed by the message id, so
+    archived messages stay searchable. Every document is tagged with its user so a
+    search only walks that user's postings.
+
+    Other databases, and SQLite builds without FTS5, search the live messages
+    with LIKE instead: archived messages are not found and diacritics must match.
+    """
+    enabled = True
+
+    @staticmethod
+    def create() -> None:
+        if engine.dialect.name != "sqlite":
+            logging.info("Message search scans the messages table, full-text search needs SQLite FTS5")
+            MessageIndex.enabled = False
+            return
+        try:
+            with engine.begin() as connection:
+                connection.execute(text(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+                    "user, content, message_type UNINDEXED, timestamp UNINDEXED, "
+                    "tokenize = 'unicode61 remove_diacritics 2')"
+                ))
+        except OperationalError:
+            logging.warning("SQLite was built without FTS5, message search scans the messages table")
+            MessageIndex.enabled = False
+
+    @staticmethod
+    def detect() -> None:
+        """Uses the index if `create` created it, in processes that did not create it themselves."""
+        MessageIndex.enabled = engine.dialect.name == "sqlite" and inspect(engine).has_table("messages_fts")
+
+    @staticmethod
+    def add(session, message: Message) -> None:
+        """Indexes a flushed message in the session's transaction."""
+        if MessageIndex.enabled:
+            session.execute(
+                text(
+                    "INSERT INTO messages_fts (rowid, user, content, message_type, timestamp) "
+                    "VALUES (:id, :user, :content, :message_type, :timestamp)"
+                ),
+                MessageIndex._row(message.id, message.user_id, message.content, message.message_type, message.timestamp),
+            )
+
+    @staticmethod
+    def index_pending(batch_size: int = 10000) -> int:
+        """Indexes stored messages that are missing from the index, e.g. after a bulk import.
+
+        The live app indexes every new message, so the index can hold recent
+        messages while older ones are still missing. Each message is looked up
+        in the index by id rather than assuming the index is complete up to its
+        newest row.
+
+        Returns:
+            int: The number of messages indexed
+        """
+        if not MessageIndex.enabled:
+            return 0
+        count = 0
+        last_id = 0
+        while True:
+            with Session() as session:
+                messages = (
+                    session.query(Message)
+                    .filter(Message.id > last_id)
+                    .filter(Message.message_type.in_(SEARCHABLE_TYPES))
+                    .filter(text("NOT EXISTS (SELECT 1 FROM messages_fts WHERE messages_fts.rowid = messages.id)"))
+                    .order_by(Message.id)
+                    .limit(batch_size)
+                    .all()
+                )
+                if not messages:
+                    return count
+                session.execute(
+                    text(
+                        "INSERT INTO messages_fts (rowid, user, content, message_type, timestamp) "
+                        "VALUES (:id, :user, :content, :message_type, :timestamp)"
+                    ),
+                    [
+                        MessageIndex._row(m.id, m.user_id, m.content, m.message_type, m.timestamp)
+                        for m in messages
+                    ],
+                )
+                last_id = messages[-1].id
+                session.commit()
+            count += len(messages)
+
+    @staticmethod
+    def search(phone_id: str, phrase: str, limit: int = 10) -> List[Message]:
+        """Returns a user's messages that contain `phrase`, most recent first. Results are detached.
+
+        Ordering by rowid lets FTS5 stop after `limit` matches instead of ranking them all.
+        """
+        user_id = User.get_id(phone_id)
+        words = phrase.split()
+        if user_id is None or not words:
+            return []
+        if not MessageIndex.enabled:
+            with Session() as session:
+                query = session.query(Message).filter(
+                    Message.user_id == user_id, Message.message_type.in_(SEARCHABLE_TYPES)
+                )
+                for word in words:
+                    pattern = word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+                    query = query.filter(Message.content.ilike(f"%{pattern}%", escape="\\"))
+                return query.order_by(desc(Message.id)).limit(limit).all()
+        # quote every word so user input is never parsed as FTS5 query syntax
+        query = 'user:"u{}" AND content:({})'.format(
+            user_id, " ".join('"{}"'.format(word.replace('"', '""')) for word in words)
+        )
+        with engine.connect() as connection:
+            rows = connection.execute(
+                text(
+                    "SELECT rowid, content, message_type, timestamp FROM messages_fts "
+                    "WHERE messages_fts MATCH :query ORDER BY rowid DESC LIMIT :limit"
+                ),
+                {"query": query, "limit": limit},
+            ).fetchall()
+        return [MessageIndex._message(user_id, *row) for row in rows]
+
+    @staticmethod
+    def get_reply(phone_id: str, message_id: int) -> Optional[Message]:
+        """Returns the first bot message after `message_id`, searching the index so archived replies are found."""
+        user_id = User.get_id(phone_id)
+        if user_id is None:
+            return None
+        if not MessageIndex.enabled:
+            with Session() as session:
+                message = (
+                    session.query(Message)
+                    .filter(Message.user_id == user_id, Message.id > message_id)
+                    .filter(Message.message_type.in_(SEARCHABLE_TYPES))
+                    .order_by(Message.id)
+                    .first()
+                )
+            return message if message is not None and message.message_type == MessageType.bot_message else None
+        with engine.connect() as connection:
+            row = connection.execute(
+                text(
+                    "SELECT rowid, content, message_type, timestamp FROM messages_fts "
+                    "WHERE messages_fts MATCH :query AND rowid > :id ORDER BY rowid LIMIT 1"
+                ),
+                {"query": f'user:"u{user_id}"', "id": message_id},
+            ).first()
+        if row is None or MESSAGE_TYPES[row[2]] != MessageType.bot_message:
+            return None
+        return MessageIndex._message(user_id, *row)
+
+    @staticmethod
+    def _row(id: int, user_id: int, content: str, message_type: MessageType, timestamp: datetime) -> Dict:
+        return {
+            "id": id,
+            "user": f"u{user_id}",
+            "content": content,
+            "message_type": MESSAGE_TYPE_CODES[message_type],
+            "timestamp": int(timestamp.timestamp()),
+        }
+
+    @staticmethod
+    def _message(user_id: int, id: int, content: str, message_type: int, timestamp: int) -> Message:
+        return Message(
+            id=id,
+            user_id=user_id,
+            content=content,
+            message_type=MESSAGE_TYPES[message_type],
+            timestamp=datetime.fromtimestamp(timestamp),
+        )
+
+
+def has_legacy_schema() -> bool:
+    """True if the database still uses the original layout keyed by phone_id strings."""
+    inspector = inspect(engine)
+    return any(
+        table in inspector.get_table_names()
+        and "phone_id" in [column["name"] for column in inspector.get_columns(table)]
+        for table in ("messages", "messages_archive", "messages_legacy", "messages_archive_legacy")
+    )
+
+def migrate_legacy_schema(batch_size: int = 10000) -> None:
+    """Migrates messages from the original schema to the compact one.
+
+    The legacy tables are renamed, users are created for every phone_id, and
+    rows are copied in batches of `batch_size`, one transaction each. The
+    migration resumes where it left off if it is interrupted.
+    """
+    with engine.begin() as connection:
+        tables = inspect(connection).get_table_names()
+        for table in ("messages", "messages_archive"):
+            columns = [column["name"] for column in inspect(connection).get_columns(table)] if table in tables else []
+            if "phone_id" in columns:
+                connection.execute(text(f"ALTER TABLE {table} RENAME TO {table}_legacy"))
+        tables = inspect(connection).get_table_names()
+
     Base.metadata.create_all(engine)
+
+    for table in ("messages_legacy", "messages_archive_legacy"):
+        if table not in tables:
+            continue
+        logging.info("Migrating %s to the compact schema", table)
+        with engine.begin() as connection:
+            connection.execute(text(
+                f"INSERT INTO users (phone_id) SELECT DISTINCT phone_id FROM {table} "
+                "WHERE phone_id NOT IN (SELECT phone_id FROM users WHERE phone_id IS NOT NULL)"
+            ))
+        user_ids = {phone_id: user_id for user_id, phone_id in _execute("SELECT id, phone_id FROM users")}
+
+        target = Message if table == "messages_legacy" else ArchivedMessages
+        last_id = _execute(f"SELECT COALESCE(MAX(id), 0) FROM {target.__tablename__}")[0][0]
+        while True:
+            if target is Message:
+                rows = _execute(
+                    "SELECT id, phone_id, content, timestamp, message_type FROM messages_legacy "
+                    "WHERE id > :last_id ORDER BY id LIMIT :limit",
+                    last_id=last_id, limit=batch_size,
+                )
+                values = [
+                    dict(
+                        id=id,
+                        user_id=user_ids[phone_id],
+                        content=content,
+                        timestamp=_parse_legacy_timestamp(timestamp),
+                        message_type=MessageType[message_type] if message_type else None,
+                    )
+                    for id, phone_id, content, timestamp, message_type in rows
+                ]
+            else:
+                rows = _execute(
+                    "SELECT id, phone_id, first_timestamp, last_timestamp, count, payload FROM messages_archive_legacy "
+                    "WHERE id > :last_id ORDER BY id LIMIT :limit",
+                    last_id=last_id, limit=batch_size,
+                )
+                values = [
+                    dict(
+                        id=id,
+                        user_id=user_ids[phone_id],
+                        first_timestamp=_parse_legacy_timestamp(first_timestamp),
+                        last_timestamp=_parse_legacy_timestamp(last_timestamp),
+                        count=count,
+                        payload=payload,
+                    )
+                    for id, phone_id, first_timestamp, last_timestamp, count, payload in rows
+                ]
+            if not rows:
+                break
+            with engine.begin() as connection:
+                connection.execute(target.__table__.insert(), values)
+            last_id = rows[-1][0]
+            logging.info("Migrated %s up to id %d", table, last_id)
+
+        with engine.begin() as connection:
+            connection.execute(text(f"DROP TABLE {table}"))
+
+def add_last_active() -> None:
+    """Adds users.last_active to databases created before it, filled from each user's latest message."""
+    columns = [column["name"] for column in inspect(engine).get_columns("users")]
+    if "last_active" in columns:
+        return
+    logging.info("Adding users.last_active")
+    codes = ", ".join(str(MESSAGE_TYPE_CODES[message_type]) for message_type in ACTIVITY_TYPES)
+    with engine.begin() as connection:
+        connection.execute(text("ALTER TABLE users ADD COLUMN last_active INTEGER"))
+        # one index range per user on ix_messages_user_timestamp
+        connection.execute(text(
+            "UPDATE users SET last_active = (SELECT MAX(timestamp) FROM messages "
+            f"WHERE messages.user_id = users.id AND message_type IN ({codes}))"
+        ))
+        connection.execute(text("CREATE INDEX ix_users_last_active ON users (last_active)"))
+
+def add_turns_autoincrement() -> None:
+    """Recreates the turns table of SQLite databases created before its ids were never reused."""
+    if engine.dialect.name != "sqlite":
+        return
+    sql = _execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'turns'")[0][0]
+    if "AUTOINCREMENT" in sql.upper():
+        return
+    logging.info("Recreating turns with AUTOINCREMENT")
+    with engine.begin() as connection:
+        connection.execute(text("ALTER TABLE turns RENAME TO turns_old"))
+        connection.execute(text("DROP INDEX ix_turns_shard_id"))
+        Turn.__table__.create(connection)
+        connection.execute(text("INSERT INTO turns SELECT id, shard, key, kind, payload, created FROM turns_old"))
+        connection.execute(text("DROP TABLE turns_old"))
+
+def _execute(statement: str, **params) -> list:
+    with engine.connect() as connection:
+        return connection.execute(text(statement), params).fetchall()
+
+def _parse_legacy_timestamp(value: Optional[str]) -> Optional[datetime]:
+    return None if value is None else datetime.fromisoformat(value)
+
+
+_initialized = False
+_init_lock = Lock()
+
+def init_db() -> None:
+    """Creates missing tables and migrates older databases, once per process.
+
+    Called by the app and the command line tools before they use the database,
+    not on import, so that importing this module opens no connection. gunicorn's
+    master initializes the database before it starts the workers and sets
+    DATABASE_INITIALIZED (see gunicorn.conf.py), then workers only look up
+    which features the database has instead of migrating it all at once.
+    """
+    global _initialized
+    with _init_lock:
+        if _initialized:
+            return
+        if environ.get("DATABASE_INITIALIZED") == "1":
+            MessageIndex.detect()
+            _initialized = True
+            return
+        # migrate databases created before the compact schema
+        if has_legacy_schema():
+            migrate_legacy_schema()
+        had_stats = inspect(engine).has_table("user_stats")
+        Base.metadata.create_all(engine)
+        if not had_stats and _execute("SELECT 1 FROM messages LIMIT 1"):
+            logging.warning("Progress reports only count new messages, run `python history.py progress` to count the history")
+        # columns added to existing tables
+        add_last_active()
+        add_turns_autoincrement()
+        MessageIndex.create()
+        _initialized = True
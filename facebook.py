@@ -0,0 +1,137 @@
+"""Graph API calls for the Facebook Messenger page."""
+from datetime import datetime
+from functools import lru_cache
+import logging
+from os import environ
+from typing import Dict, Iterator, Optional
+
+from bot import get_num_tokens
+from db import Message, MessageType
+from graph import GRAPH_API_URL, session
+
+GRAPH_URL = f"{GRAPH_API_URL}/v16.0"
+MESSENGER_API_KEY = environ.get("MESSENGER_API_KEY") #messenger api key here
+MESSENGER_PAGE_ID = environ.get("MESSENGER_PAGE_ID", "109100192122534") #messenger page id here
+# messages requested per Graph page when backfilling history
+HISTORY_PAGE_SIZE = int(environ.get("MESSENGER_HISTORY_PAGE_SIZE", 25))
+
+
+def conversation_key(sender_id: str) -> str:
+    """Messenger users are stored next to WhatsApp numbers, prefixed so the ids never collide."""
+    return f"messenger:{sender_id}"
+
+
+@lru_cache(maxsize=4096)
+def get_conversation_id(sender_id: str, page_id: str = MESSENGER_PAGE_ID, access_token: str = MESSENGER_API_KEY) -> str:
+    """Returns the id of the page's conversation with a user, cached since it never changes.
+
+    Raises:
+        LookupError: if the page has no conversation with the user
+    """
+    res = session.get(
+        f"{GRAPH_URL}/{page_id}/conversations",
+        params={"access_token": access_token, "platform": "messenger", "user_id": sender_id, "fields": "id"},
+    )
+    try:
+        return res.json()["data"][0]["id"]
+    except (KeyError, IndexError):
+        raise LookupError(f"No conversation found with {sender_id}")
+
+
+def iter_conversation_messages(
+    sender_id: str,
+    page_size: int = HISTORY_PAGE_SIZE,
+    page_id: str = MESSENGER_PAGE_ID,
+    access_token: str = MESSENGER_API_KEY,
+) -> Iterator[Dict]:
+    """Yields the page's messages with a user, newest first.
+
+    Messages are requested `page_size` at a time and the next page is only
+    fetched once the caller has consumed the previous one.
+    """
+    try:
+        conversation_id = get_conversation_id(sender_id, page_id, access_token)
+    except LookupError:
+        logging.error("Messenger: No conversation found")
+        return
+
+    url: Optional[str] = f"{GRAPH_URL}/{conversation_id}/messages"
+    params: Optional[Dict] = {
+        "access_token": access_token,
+        "fields": "id,message,from,created_time",
+        "limit": page_size,
+    }
+    while url:
+        res = session.get(url, params=params)
+        page = res.json()
+        # the url carries the access token, keep it out of the logs
+        logging.debug("Messenger: Fetched %d messages of %s", len(page.get("data", [])), sender_id)
+        yield from page.get("data", [])
+        # the next url already carries the access token, limit and cursor
+        url, params = page.get("paging", {}).get("next"), None
+
+
+def backfill_history(
+    sender_id: str,
+    skip_message_id: str = None,
+    max_tokens: int = 3000,
+    key: Optional[str] = None,
+    page_id: str = MESSENGER_PAGE_ID,
+    access_token: str = MESSENGER_API_KEY,
+) -> int:
+    """Copies a user's recent Messenger history into the local store.
+
+    Only needed once per user: after that every turn is written by `get_response`.
+    History is read back to the last /reset, or until it holds `max_tokens`
+    tokens, which is all `get_response` sends to OpenAI.
+
+    Args:
+        sender_id: page scoped id of the user
+        skip_message_id: id of the inbound message being handled, it is stored by `get_response`
+        max_tokens: token budget of the backfilled history
+        key: key the conversation is stored under, `conversation_key(sender_id)` by default
+        page_id: page the user talks to
+        access_token: page access token
+
+    Returns:
+        int: The number of messages stored
+    """
+    history = []
+    num_tokens = 0
+    for message in iter_conversation_messages(sender_id, page_id=page_id, access_token=access_token):
+        if "message" not in message or message.get("id") == skip_message_id:
+            continue
+        history.append(message)
+        if message["message"] == "/reset":
+            break
+        num_tokens += get_num_tokens(message["message"])
+        if num_tokens >= max_tokens:
+            break
+
+    key = key or conversation_key(sender_id)
+    for message in history[::-1]:
+        if message["message"] == "/reset":
+            message_type = MessageType.bot_command_message
+        elif message["from"]["id"] == sender_id:
+            message_type = MessageType.user_message
+        else:
+            message_type = MessageType.bot_message
+        Message.add_message(key, message["message"], message_type, timestamp=_parse_time(message.get("created_time")))
+    logging.info("Messenger: Backfilled %d messages for %s", len(history), sender_id)
+    return len(history)
+
+
+def send_message(sender_id: str, text: str, page_id: str = MESSENGER_PAGE_ID, access_token: str = MESSENGER_API_KEY) -> Dict:
+    res = session.post(
+        f"{GRAPH_URL}/{page_id}/messages",
+        params={"access_token": access_token},
+        json={"recipient": {"id": sender_id}, "message": {"text": text}},
+    )
+    return res.json()
+
+
+def _parse_time(created_time: str) -> datetime:
+    if not created_time:
+        return datetime.now()
+    # Graph returns e.g. 2023-03-01T12:00:00+0000, stored timestamps are naive local time
+    return datetime.strptime(created_time, "%Y-%m-%dT%H:%M:%S%z").astimezone().replace(tzinfo=None)
@@ -0,0 +1,37 @@
+"""Connection pool shared by every call to the Graph API."""
+from os import environ
+from typing import Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+GRAPH_API_URL = environ.get("GRAPH_API_URL", "https://graph.facebook.com")
+# connections kept open to the Graph API, shared by all tenants and threads
+GRAPH_POOL_SIZE = int(environ.get("GRAPH_POOL_SIZE", 32))
+# seconds to connect, and to wait for each read, before a call fails
+GRAPH_CONNECT_TIMEOUT = float(environ.get("GRAPH_CONNECT_TIMEOUT", 5))
+GRAPH_READ_TIMEOUT = float(environ.get("GRAPH_READ_TIMEOUT", 20))
+
+
+class TimeoutAdapter(HTTPAdapter):
+    """Applies a timeout to every request that does not set its own, heyoo sets none."""
+
+    def __init__(self, timeout: Tuple[float, float], **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=self.timeout if timeout is None else timeout, **kwargs)
+
+
+def create_session(
+    pool_size: int = GRAPH_POOL_SIZE, timeout: Tuple[float, float] = (GRAPH_CONNECT_TIMEOUT, GRAPH_READ_TIMEOUT)
+) -> requests.Session:
+    session = requests.Session()
+    adapter = TimeoutAdapter(timeout, pool_connections=4, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+session = create_session()
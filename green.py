@@ -0,0 +1,59 @@
+"""Support for running the app on gevent workers (pip install gevent).
+
+With WORKER_CLASS=gevent, gunicorn.conf.py patches the standard library
+before the app is imported, in the master too when the app is preloaded. The
+Graph API and OpenAI calls go through requests, and so do heyoo's, so they
+wait on the hub instead of blocking the worker. The dispatcher and outbox
+threads become greenlets, and there are more of them by default, so one
+process answers many turns while they wait on OpenAI.
+
+Two things still hold the hub and are handled here:
+    CPU-bound work such as counting tokens, which `offload` runs on gevent's
+        native thread pool (tiktoken releases the GIL while encoding)
+    the database driver, which is C code the patching cannot reach, see `engine_options`
+"""
+import logging
+from os import environ
+from typing import Callable, Dict, TypeVar
+
+T = TypeVar("T")
+
+
+def cooperative() -> bool:
+    """True if gevent patched the standard library of this process."""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("socket")
+
+
+def offload(function: Callable[..., T], *args) -> T:
+    """Calls `function` on a native thread when cooperative, so the hub keeps serving other greenlets."""
+    if not cooperative():
+        return function(*args)
+    import gevent
+
+    return gevent.get_hub().threadpool.apply(function, args)
+
+
+def engine_options(url: str) -> Dict:
+    """Pool settings for `create_engine`.
+
+    SQLite waits for a locked database inside C code, which would hold the hub
+    while the greenlet holding the lock cannot run to release it. Cooperative
+    workers therefore use one SQLite connection per process, and greenlets
+    wait for it on the hub. PostgreSQL queries wait on the hub once psycogreen
+    is installed, and get a pool of DATABASE_POOL_SIZE connections.
+    """
+    if not cooperative() or url in ("sqlite://", "sqlite:///:memory:"):
+        return {}
+    if url.startswith("sqlite"):
+        return {"pool_size": 1, "max_overflow": 0}
+    try:
+        from psycogreen.gevent import patch_psycopg
+
+        patch_psycopg()
+    except ImportError:
+        logging.warning("Queries to %s block the gevent hub, install psycogreen for PostgreSQL", url.split(":")[0])
+    return {"pool_size": int(environ.get("DATABASE_POOL_SIZE", 20)), "max_overflow": 0}
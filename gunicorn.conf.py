@@ -0,0 +1,112 @@
+# Read by gunicorn from the working directory, see https://docs.gunicorn.org/en/stable/settings.html
+import gc
+import os
+from os import environ
+
+# gevent workers answer many turns at once in one process, see green.py
+worker_class = environ.get("WORKER_CLASS", "sync")
+if worker_class == "gevent":
+    # before the app imports socket, ssl or threading
+    from gevent import monkey
+
+    monkey.patch_all()
+
+# the app is imported once by the master and the workers are forked from it, sharing its memory copy-on-write
+preload_app = environ.get("PRELOAD_APP", "1") == "1"
+
+
+def on_starting(server):
+    if server.cfg.worker_class_str == "gevent" and worker_class != "gevent":
+        raise RuntimeError("Use WORKER_CLASS=gevent instead of --worker-class, the standard library must be patched first")
+    # tables and migrations once, rather than by every worker at the same time
+    if server.cfg.preload_app:
+        # the master imported the app already, and the workers inherit that the database is initialized
+        from db import init_db
+
+        init_db()
+        environ["DATABASE_INITIALIZED"] = "1"
+        return
+    # in a child process, so that the master imports none of the app and --reload reloads all of it
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            from db import init_db
+
+            init_db()
+            status = 0
+        except BaseException:
+            server.log.exception("Creating the database tables failed")
+        finally:
+            os._exit(status)
+    _, status = os.waitpid(pid, 0)
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError("Creating the database tables failed")
+    environ["DATABASE_INITIALIZED"] = "1"
+
+
+def when_ready(server):
+    if not server.cfg.preload_app:
+        return
+    # loaded here once instead of by every worker on its first turn
+    from bot import warmup
+
+    warmup()
+    # never collected, so collections in the workers do not write to (and copy) the pages these objects live on
+    gc.freeze()
+
+
+def pre_fork(server, worker):
+    # an index below the number of workers, the one fewest live workers have. During a reload gunicorn
+    # starts the new workers before it stops the old ones, so a new worker takes the index, and the
+    # shards, of the worker it is about to replace. Shard leases keep two workers from answering the
+    # same shard meanwhile, and after TTIN or TTOU, when workers disagree on their number, see shards.py
+    indexes = [getattr(other, "shard_index", None) for other in server.WORKERS.values()]
+    worker.shard_workers = server.num_workers
+    worker.shard_index = min(range(worker.shard_workers), key=indexes.count)
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        # connections the master opened while importing the app stay with the master
+        from db import engine
+
+        engine.dispose(close=False)
+
+
+# Threads and process pools (dispatchers, outbox, media downloads, transcription, status flushing) are
+# started here or on first use, never on import. The master imports the app before forking the workers,
+# and a fork copies no threads but does copy the locks they hold, which then stay locked in the workers.
+def post_worker_init(worker):
+    # workers answer the turns and deliver the replies of their shards even before they receive a request
+    from db import init_db
+    from outbox import outbox
+    from shards import shard_queue
+
+    # only looks up which features the database the master initialized has
+    init_db()
+    try:
+        shard_queue.assign(worker.shard_index, worker.shard_workers)
+        shard_queue.start()
+        outbox.start()
+    except Exception:
+        # gunicorn halts when a worker fails to boot, started on first use instead
+        worker.log.exception("Starting worker %s failed", worker.pid)
+
+
+def worker_exit(server, worker):
+    # turns being answered finish before another worker takes their shards
+    from shards import shard_queue
+
+    try:
+        shard_queue.stop(server.cfg.graceful_timeout / 2)
+    except Exception:
+        server.log.exception("Releasing shards failed")
+
+    # statuses buffered since the last flush, so a graceful restart loses none
+    from statuses import status_tracker
+
+    try:
+        status_tracker.flush()
+    except Exception:
+        server.log.exception("Recording delivery statuses failed")
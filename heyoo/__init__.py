@@ -5,35 +5,29 @@ import os
 import mimetypes
 import requests
 import logging
-from requests_toolbelt.multipart.encoder import MultipartEncoder
 from typing import Optional, Dict, Any, List, Union, Tuple, Callable
 
 
-# Setup logging
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-)
-
-
 class WhatsApp(object):
     """ "
     WhatsApp Object
     """
 
-    def __init__(self, token=None, phone_number_id=None):
+    def __init__(self, token=None, phone_number_id=None, graph_url="https://graph.facebook.com", session=None):
         """
         Initialize the WhatsApp Object
 
         Args:
             token[str]: Token for the WhatsApp cloud API obtained from the developer portal
             phone_number_id[str]: Phone number id for the WhatsApp cloud API obtained from the developer portal
+            graph_url[str]: Root url of the Graph API, override to use a local stand-in
+            session[requests.Session]: Session to send requests with, share one between clients to pool connections
         """
         self.token = token
         self.phone_number_id = phone_number_id
-        self.base_url = "https://graph.facebook.com/v14.0"
-        self.v15_base_url = "https://graph.facebook.com/v15.0"
+        self.session = session or requests.Session()
+        self.base_url = f"{graph_url}/v14.0"
+        self.v15_base_url = f"{graph_url}/v15.0"
         self.url = f"{self.base_url}/{phone_number_id}/messages"
 
         self.headers = {
@@ -41,6 +35,15 @@ class WhatsApp(object):
             "Authorization": "Bearer {}".format(self.token),
         }
 
+    def _log_error(self, r, message, *args):
+        """Logs a failed request once and returns its body, parsed only once."""
+        try:
+            body = r.json()
+        except ValueError:
+            body = {"error": {"message": r.text}}
+        logging.error(message + " (status code %s): %s", *args, r.status_code, body)
+        return body
+
     def send_message(
         self, message, recipient_id, recipient_type="individual", preview_url=True
     ):
@@ -68,15 +71,12 @@ class WhatsApp(object):
             "type": "text",
             "text": {"preview_url": preview_url, "body": message},
         }
-        logging.info(f"Sending message to {recipient_id}")
-        r = requests.post(f"{self.url}", headers=self.headers, json=data)
+        logging.debug("Sending message to %s", recipient_id)
+        r = self.session.post(f"{self.url}", headers=self.headers, json=data)
         if r.status_code == 200:
-            logging.info(f"Message sent to {recipient_id}")
+            logging.info("Message sent to %s", recipient_id)
             return r.json()
-        logging.info(f"Message not sent to {recipient_id}")
-        logging.info(f"Status code: {r.status_code}")
-        logging.info(f"Response: {r.json()}")
-        return r.json()
+        return self._log_error(r, "Message not sent to %s", recipient_id)
 
     def reply_to_message(
         self, message_id: str, recipient_id: str, message: str, preview_url: bool = True
@@ -99,15 +99,12 @@ class WhatsApp(object):
             "text": {"preview_url": preview_url, "body": message},
         }
 
-        logging.info(f"Replying to {message_id}")
-        r = requests.post(f"{self.url}", headers=self.headers, json=data)
+        logging.debug("Replying to %s", message_id)
+        r = self.session.post(f"{self.url}", headers=self.headers, json=data)
         if r.status_code == 200:
-            logging.info(f"Message sent to {recipient_id}")
+            logging.info("Message sent to %s", recipient_id)
             return r.json()
-        logging.info(f"Message not sent to {recipient_id}")
-        logging.info(f"Status code: {r.status_code}")
-        logging.info(f"Response: {r.json()}")
-        return r.json()
+        return self._log_error(r, "Message not sent to %s", recipient_id)
 
     def send_template(self, template: str, recipient_id: str, recipient_type="individual",
                         lang: str = "en_US", components: List = None):  
@@ -142,16 +139,13 @@ class WhatsApp(object):
                     "components": components,
                 },
             }
-            logging.info(f"Sending template to {recipient_id}")
-            r = requests.post(self.url, headers=self.headers, json=data)
+            logging.debug("Sending template to %s", recipient_id)
+            r = self.session.post(self.url, headers=self.headers, json=data)
 
             if r.status_code == 200:
-                logging.info(f"Template sent to {recipient_id}")
+                logging.info("Template sent to %s", recipient_id)
                 return r.json()
-            logging.info(f"Template not sent to {recipient_id}")
-            logging.info(f"Status code: {r.status_code}")
-            logging.info(f"Response: {r.json()}")
-            return r.json()
+            return self._log_error(r, "Template not sent to %s", recipient_id)
 
     def send_templatev2(self, template, recipient_id, components, lang="en_US"):
         data = {
@@ -164,15 +158,12 @@ class WhatsApp(object):
                 "components": components,
             },
         }
-        logging.info(f"Sending template to {recipient_id}")
-        r = requests.post(self.url, headers=self.headers, json=data)
+        logging.debug("Sending template to %s", recipient_id)
+        r = self.session.post(self.url, headers=self.headers, json=data)
         if r.status_code == 200:
-            logging.info(f"Template sent to {recipient_id}")
+            logging.info("Template sent to %s", recipient_id)
             return r.json()
-        logging.info(f"Template not sent to {recipient_id}")
-        logging.info(f"Status code: {r.status_code}")
-        logging.info(f"Response: {r.json()}")
-        return r.json()
+        return self._log_error(r, "Template not sent to %s", recipient_id)
 
     def send_location(self, lat, long, name, address, recipient_id):
         """
@@ -201,15 +192,12 @@ class WhatsApp(object):
                 "address": address,
             },
         }
-        logging.info(f"Sending location to {recipient_id}")
-        r = requests.post(self.url, headers=self.headers, json=data)
+        logging.debug("Sending location to %s", recipient_id)
+        r = self.session.post(self.url, headers=self.headers, json=data)
         if r.status_code == 200:
-            logging.info(f"Location sent to {recipient_id}")
+            logging.info("Location sent to %s", recipient_id)
             return r.json()
-        logging.info(f"Location not sent to {recipient_id}")
-        logging.info(f"Status code: {r.status_code}")
-        logging.error(r.json())
-        return r.json()
+        return self._log_error(r, "Location not sent to %s", recipient_id)
 
     def send_image(
         self,
@@ -254,15 +242,12 @@ class WhatsApp(object):
                 "type": "image",
                 "image": {"id": image, "caption": caption},
             }
-        logging.info(f"Sending image to {recipient_id}")
-        r = requests.post(self.url, headers=self.headers, json=data)
+        logging.debug("Sending image to %s", recipient_id)
+        r = self.session.post(self.url, headers=self.headers, json=data)
         if r.status_code == 200:
-            logging.info(f"Image sent to {recipient_id}")
+            logging.info("Image sent to %s", recipient_id)
             return r.json()
-        logging.info(f"Image not sent to {recipient_id}")
-        logging.info(f"Status code: {r.status_code}")
-        logging.error(r.json())
-        return r.json()
+        return self._log_error(r, "Image not sent to %s", recipient_id)
 
     def send_sticker(self, sticker: str, recipient_id: str, linl=True):
         pass
@@ -296,15 +281,12 @@ class WhatsApp(object):
                 "type": "audio",
                 "audio": {"id": audio},
             }
-        logging.info(f"Sending audio to {recipient_id}")
-        r = requests.post(self.url, headers=self.headers, json=data)
+        logging.debug("Sending audio to %s", recipient_id)
+        r = self.session.post(self.url, headers=self.headers, json=data)
         if r.status_code == 200:
-            logging.info(f"Audio sent to {recipient_id}")
+            logging.info("Audio sent to %s", recipient_id)
             return r.json()
-        logging.info(f"Audio not sent to {recipient_id}")
-        logging.info(f"Status code: {r.status_code}")
-        logging.error(f"Response: {r.json()}")
-        return r.json()
+        return self._log_error(r, "Audio not sent to %s", recipient_id)
 
     def send_video(self, video, recipient_id, caption=None, link=True):
         """ "
@@ -336,15 +318,12 @@ class WhatsApp(object):
                 "type": "video",
                 "video": {"id": video, "caption": caption},
             }
-        logging.info(f"Sending video to {recipient_id}")
-        r = requests.post(self.url, headers=self.headers, json=data)
+        logging.debug("Sending video to %s", recipient_id)
+        r = self.session.post(self.url, headers=self.headers, json=data)
         if r.status_code == 200:
-            logging.info(f"Video sent to {recipient_id}")
+            logging.info("Video sent to %s", recipient_id)
             return r.json()
-        logging.info(f"Video not sent to {recipient_id}")
-        logging.info(f"Status code: {r.status_code}")
-        logging.error(f"Response: {r.json()}")
-        return r.json()
+        return self._log_error(r, "Video not sent to %s", recipient_id)
 
     def send_document(self, document, recipient_id, caption=None, link=True):
         """ "
@@ -377,15 +356,12 @@ class WhatsApp(object):
                 "document": {"id": document, "caption": caption},
             }
 
-        logging.info(f"Sending document to {recipient_id}")
-        r = requests.post(self.url, headers=self.headers, json=data)
+        logging.debug("Sending document to %s", recipient_id)
+        r = self.session.post(self.url, headers=self.headers, json=data)
         if r.status_code == 200:
-            logging.info(f"Document sent to {recipient_id}")
+            logging.info("Document sent to %s", recipient_id)
             return r.json()
-        logging.info(f"Document not sent to {recipient_id}")
-        logging.info(f"Status code: {r.status_code}")
-        logging.error(f"Response: {r.json()}")
-        return r.json()
+        return self._log_error(r, "Document not sent to %s", recipient_id)
 
     def send_contacts(self, contacts: List[Dict[Any, Any]], recipient_id: str):
         """send_contacts
@@ -422,15 +398,12 @@ class WhatsApp(object):
             "type": "contacts",
             "contacts": contacts,
         }
-        logging.info(f"Sending contacts to {recipient_id}")
-        r = requests.post(self.url, headers=self.headers, json=data)
+        logging.debug("Sending contacts to %s", recipient_id)
+        r = self.session.post(self.url, headers=self.headers, json=data)
         if r.status_code == 200:
-            logging.info(f"Contacts sent to {recipient_id}")
+            logging.info("Contacts sent to %s", recipient_id)
             return r.json()
-        logging.info(f"Contacts not sent to {recipient_id}")
-        logging.info(f"Status code: {r.status_code}")
-        logging.error(f"Response: {r.json()}")
-        return r.json()
+        return self._log_error(r, "Contacts not sent to %s", recipient_id)
 
     def upload_media(self, media: str):
         """
@@ -446,6 +419,9 @@ class WhatsApp(object):
 
         REFERENCE: https://developers.facebook.com/docs/whatsapp/cloud-api/reference/media#
         """
+        # only needed for uploads, imported here to keep it out of startup
+        from requests_toolbelt.multipart.encoder import MultipartEncoder
+
         form_data = {
             "file": (
                 media,
@@ -458,19 +434,17 @@ class WhatsApp(object):
         form_data = MultipartEncoder(fields=form_data)
         headers = self.headers.copy()
         headers["Content-Type"] = form_data.content_type
-        logging.info(f"Content-Type: {form_data.content_type}")
-        logging.info(f"Uploading media {media}")
-        r = requests.post(
+        logging.debug("Content-Type: %s", form_data.content_type)
+        logging.debug("Uploading media %s", media)
+        r = self.session.post(
             f"{self.base_url}/{self.phone_number_id}/media",
             headers=headers,
             data=form_data,
         )
         if r.status_code == 200:
-            logging.info(f"Media {media} uploaded")
+            logging.info("Media %s uploaded", media)
             return r.json()
-        logging.info(f"Error uploading media {media}")
-        logging.info(f"Status code: {r.status_code}")
-        logging.info(f"Response: {r.json()}")
+        self._log_error(r, "Error uploading media %s", media)
         return None
 
     def delete_media(self, media_id: str):
@@ -480,14 +454,12 @@ class WhatsApp(object):
         Args:
             media_id[str]: Id of the media to be deleted
         """
-        logging.info(f"Deleting media {media_id}")
-        r = requests.delete(f"{self.base_url}/{media_id}", headers=self.headers)
+        logging.debug("Deleting media %s", media_id)
+        r = self.session.delete(f"{self.base_url}/{media_id}", headers=self.headers)
         if r.status_code == 200:
-            logging.info(f"Media {media_id} deleted")
+            logging.info("Media %s deleted", media_id)
             return r.json()
-        logging.info(f"Error deleting media {media_id}")
-        logging.info(f"Status code: {r.status_code}")
-        logging.info(f"Response: {r.json()}")
+        self._log_error(r, "Error deleting media %s", media_id)
         return None
     
     def mark_as_read(self, message_id: str):
@@ -507,7 +479,7 @@ class WhatsApp(object):
             'status': 'read',
             'message_id': message_id,
         }
-        response = requests.post(
+        response = self.session.post(
             f'{self.v15_base_url}/{self.phone_number_id}/messages', headers=headers, json=json_data).json()
         return response["success"]
 
@@ -545,15 +517,12 @@ class WhatsApp(object):
             "type": "interactive",
             "interactive": self.create_button(button),
         }
-        logging.info(f"Sending buttons to {recipient_id}")
-        r = requests.post(self.url, headers=self.headers, json=data)
+        logging.debug("Sending buttons to %s", recipient_id)
+        r = self.session.post(self.url, headers=self.headers, json=data)
         if r.status_code == 200:
-            logging.info(f"Buttons sent to {recipient_id}")
+            logging.info("Buttons sent to %s", recipient_id)
             return r.json()
-        logging.info(f"Buttons not sent to {recipient_id}")
-        logging.info(f"Status code: {r.status_code}")
-        logging.info(f"Response: {r.json()}")
-        return r.json()
+        return self._log_error(r, "Buttons not sent to %s", recipient_id)
 
     def send_reply_button(self, button, recipient_id):
         """
@@ -573,14 +542,11 @@ class WhatsApp(object):
             "type": "interactive",
             "interactive": button,
         }
-        r = requests.post(self.url, headers=self.headers, json=data)
+        r = self.session.post(self.url, headers=self.headers, json=data)
         if r.status_code == 200:
-            logging.info(f"Reply buttons sent to {recipient_id}")
+            logging.info("Reply buttons sent to %s", recipient_id)
             return r.json()
-        logging.info(f"Reply buttons not sent to {recipient_id}")
-        logging.info(f"Status code: {r.status_code}")
-        logging.info(f"Response: {r.json()}")
-        return r.json()
+        return self._log_error(r, "Reply buttons not sent to %s", recipient_id)
 
     def query_media_url(self, media_id: str):
         """
@@ -598,14 +564,12 @@ class WhatsApp(object):
             >>> whatsapp.query_media_url("media_id")
         """
 
-        logging.info(f"Querying media url for {media_id}")
-        r = requests.get(f"{self.base_url}/{media_id}", headers=self.headers)
+        logging.debug("Querying media url for %s", media_id)
+        r = self.session.get(f"{self.base_url}/{media_id}", headers=self.headers)
         if r.status_code == 200:
-            logging.info(f"Media url queried for {media_id}")
+            logging.info("Media url queried for %s", media_id)
             return r.json()["url"]
-        logging.info(f"Media url not queried for {media_id}")
-        logging.info(f"Status code: {r.status_code}")
-        logging.info(f"Response: {r.json()}")
+        self._log_error(r, "Media url not queried for %s", media_id)
         return None
 
     def download_media(self, media_url: str, mime_type: str, file_path: str = "temp"):
@@ -619,7 +583,7 @@ class WhatsApp(object):
                             Do not include the file extension. It will be added automatically.
 
         Returns:
-            str: Media url
+            str: Path of the downloaded file, None if the download failed
 
         Example:
             >>> from whatsapp import WhatsApp
@@ -627,22 +591,27 @@ class WhatsApp(object):
             >>> whatsapp.download_media("media_url", "image/jpeg")
             >>> whatsapp.download_media("media_url", "video/mp4", "path/to/file") #do not include the file extension
         """
-        r = requests.get(media_url, headers=self.headers)
-        content = r.content
-        extension = mime_type.split("/")[1]
+        r = self.session.get(media_url, headers=self.headers, stream=True)
+        # drop parameters such as "audio/ogg; codecs=opus"
+        extension = mime_type.split(";")[0].split("/")[1]
+        save_file_here = (
+            f"{file_path}.{extension}" if file_path else f"temp.{extension}"
+        )
+        if not r.ok:
+            # an expired url or an error, whose body is not the media
+            with r:
+                self._log_error(r, "Media not downloaded to %s", save_file_here)
+            return None
         # create a temporary file
         try:
-
-            save_file_here = (
-                f"{file_path}.{extension}" if file_path else f"temp.{extension}"
-            )
-            with open(save_file_here, "wb") as f:
-                f.write(content)
-            logging.info(f"Media downloaded to {save_file_here}")
+            # stream to disk so large media is never held in memory
+            with r, open(save_file_here, "wb") as f:
+                for chunk in r.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
+            logging.info("Media downloaded to %s", save_file_here)
             return f.name
-        except Exception as e:
-            print(e)
-            logging.info(f"Error downloading media to {save_file_here}")
+        except Exception:
+            logging.exception("Error downloading media to %s", save_file_here)
             return None
 
     def preprocess(self, data):
@@ -863,6 +832,27 @@ class WhatsApp(object):
             if "video" in data["messages"][0]:
                 return data["messages"][0]["video"]
 
+    def get_media(self, data)-> Union[Dict, None]:
+        """
+        Extracts the media object of an image, video, audio, document or sticker message.
+
+        Args:
+            data[dict]: The data received from the webhook
+
+        Returns:
+            dict: The media object with its id and mime_type
+
+        Example:
+            >>> from whatsapp import WhatsApp
+            >>> whatsapp = WhatsApp(token, phone_number_id)
+            >>> media = whatsapp.get_media(data)
+            >>> media_id, mime_type = media["id"], media["mime_type"]
+        """
+        data = self.preprocess(data)
+        if "messages" in data:
+            message = data["messages"][0]
+            return message.get(message.get("type"))
+
     def get_message_type(self, data)-> Union[str, None]:
         """
         Gets the type of the message sent by the sender from the data received from the webhook.
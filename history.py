@@ -0,0 +1,223 @@
+"""Streams conversation history in and out of the database as NDJSON.
+
+Every line is one JSON object, users first and then their messages:
+
+    {"type": "user", "phone_id": "5511999999999", "mode": "beginner"}
+    {"type": "message", "phone_id": "5511999999999", "timestamp": "2023-03-01T12:00:00",
+     "message_type": "user_message", "content": "Hello"}
+
+Usage:
+
+    python history.py export history.ndjson --phone-id 5511999999999 --since 2023-01-01
+    python history.py import history.ndjson
+    python history.py reindex
+    python history.py progress
+"""
+import argparse
+from datetime import datetime, timedelta
+import json
+import logging
+import sys
+from typing import IO, Dict, Iterable, Iterator, List, Optional
+
+from sqlalchemy import insert, or_
+
+from db import ACTIVITY_TYPES, ArchivedMessages, Message, MessageIndex, MessageType, Session, User, UserMode, UserStats, init_db
+
+# `progress` refuses to recount while a learner wrote within this many minutes, i.e. the app is running
+ACTIVE_MINUTES = 10
+
+
+def export_history(
+    out: IO[str],
+    phone_ids: Optional[List[str]] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    include_archived: bool = False,
+    batch_size: int = 1000,
+) -> int:
+    """Writes users and their messages to `out` as NDJSON without loading them all into memory.
+
+    Returns:
+        int: The number of messages written
+    """
+    count = 0
+    with Session() as session:
+        users = session.query(User).order_by(User.id)
+        if phone_ids:
+            users = users.filter(User.phone_id.in_(phone_ids))
+        for user in users.yield_per(batch_size):
+            _write(out, {"type": "user", "phone_id": user.phone_id, "mode": user.mode.value if user.mode else None})
+
+        if include_archived:
+            chunks = session.query(ArchivedMessages, User.phone_id).join(User, ArchivedMessages.user_id == User.id)
+            if phone_ids:
+                chunks = chunks.filter(User.phone_id.in_(phone_ids))
+            if since is not None:
+                chunks = chunks.filter(ArchivedMessages.last_timestamp >= since)
+            if until is not None:
+                chunks = chunks.filter(ArchivedMessages.first_timestamp < until)
+            for chunk, phone_id in chunks.order_by(ArchivedMessages.id).yield_per(batch_size):
+                for message in chunk.unpack():
+                    if (since is None or message.timestamp >= since) and (until is None or message.timestamp < until):
+                        _write(out, _message_record(phone_id, message))
+                        count += 1
+
+        messages = session.query(Message, User.phone_id).join(User, Message.user_id == User.id)
+        if phone_ids:
+            messages = messages.filter(User.phone_id.in_(phone_ids))
+        if since is not None:
+            messages = messages.filter(Message.timestamp >= since)
+        if until is not None:
+            messages = messages.filter(Message.timestamp < until)
+        for message, phone_id in messages.order_by(Message.id).yield_per(batch_size):
+            _write(out, _message_record(phone_id, message))
+            count += 1
+    return count
+
+
+def import_history(lines: Iterable[str], batch_size: int = 1000) -> int:
+    """Bulk inserts users and messages read from NDJSON lines, one transaction per batch.
+
+    Existing users are kept, messages are appended as new rows and added to the
+    search index once all batches are written.
+
+    Returns:
+        int: The number of messages imported
+    """
+    count = 0
+    for batch in _batches(_records(lines), batch_size):
+        with Session() as session:
+            user_ids = _resolve_users(session, batch)
+            messages = [
+                dict(
+                    user_id=user_ids[record["phone_id"]],
+                    content=record["content"],
+                    timestamp=datetime.fromisoformat(record["timestamp"]),
+                    message_type=MessageType(record["message_type"]),
+                )
+                for record in batch if record["type"] == "message"
+            ]
+            if messages:
+                session.execute(insert(Message), messages)
+            _update_last_active(session, messages)
+            session.commit()
+        count += len(messages)
+        logging.info("Imported %d messages", count)
+    MessageIndex.index_pending()
+    return count
+
+
+def _resolve_users(session, batch: List[Dict]) -> Dict[str, int]:
+    """Returns phone_id -> users.id for the users in a batch, creating missing users."""
+    modes = {record["phone_id"]: record.get("mode") for record in batch if record["type"] == "user"}
+    phone_ids = {record["phone_id"] for record in batch}
+    user_ids = dict(session.query(User.phone_id, User.id).filter(User.phone_id.in_(phone_ids)).all())
+    missing = [
+        dict(phone_id=phone_id, mode=UserMode(modes[phone_id]) if modes.get(phone_id) else None)
+        for phone_id in phone_ids - user_ids.keys()
+    ]
+    if missing:
+        session.execute(insert(User), missing)
+        user_ids.update(
+            session.query(User.phone_id, User.id).filter(User.phone_id.in_([user["phone_id"] for user in missing])).all()
+        )
+    return user_ids
+
+
+def _update_last_active(session, messages: List[Dict]) -> None:
+    last_active = {}
+    for message in messages:
+        if message["message_type"] in ACTIVITY_TYPES:
+            last_active[message["user_id"]] = max(message["timestamp"], last_active.get(message["user_id"], message["timestamp"]))
+    for user_id, timestamp in last_active.items():
+        session.query(User).filter(User.id == user_id).filter(
+            or_(User.last_active.is_(None), User.last_active < timestamp)
+        ).update({User.last_active: timestamp}, synchronize_session=False)
+
+
+def _message_record(phone_id: str, message: Message) -> Dict:
+    return {
+        "type": "message",
+        "phone_id": phone_id,
+        "timestamp": message.timestamp.isoformat(),
+        "message_type": message.message_type.value,
+        "content": message.content,
+    }
+
+
+def _write(out: IO[str], record: Dict) -> None:
+    out.write(json.dumps(record, ensure_ascii=False))
+    out.write("\n")
+
+
+def _records(lines: Iterable[str]) -> Iterator[Dict]:
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+
+
+def _batches(records: Iterator[Dict], batch_size: int) -> Iterator[List[Dict]]:
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import conversation history as NDJSON.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="write history to a file, '-' for stdout")
+    export_parser.add_argument("file")
+    export_parser.add_argument("--phone-id", action="append", dest="phone_ids", help="only export this user, repeatable")
+    export_parser.add_argument("--since", type=datetime.fromisoformat, help="only messages at or after this ISO date")
+    export_parser.add_argument("--until", type=datetime.fromisoformat, help="only messages before this ISO date")
+    export_parser.add_argument("--include-archived", action="store_true", help="also export archived messages")
+    export_parser.add_argument("--batch-size", type=int, default=1000)
+
+    import_parser = subparsers.add_parser("import", help="read history from a file, '-' for stdin")
+    import_parser.add_argument("file")
+    import_parser.add_argument("--batch-size", type=int, default=1000)
+
+    reindex_parser = subparsers.add_parser("reindex", help="add messages missing from the search index")
+    reindex_parser.add_argument("--batch-size", type=int, default=10000)
+
+    progress_parser = subparsers.add_parser("progress", help="recount every learner's progress from their messages")
+    progress_parser.add_argument("--batch-size", type=int, default=1000, help="learners counted per transaction")
+    progress_parser.add_argument("--force", action="store_true", help="recount although learners are active")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    init_db()
+
+    if args.command == "export":
+        out = sys.stdout if args.file == "-" else open(args.file, "w", encoding="utf-8")
+        with out:
+            count = export_history(out, args.phone_ids, args.since, args.until, args.include_archived, args.batch_size)
+        logging.info("Exported %d messages", count)
+    elif args.command == "reindex":
+        count = MessageIndex.index_pending(args.batch_size)
+        logging.info("Indexed %d messages", count)
+    elif args.command == "progress":
+        # totals are recounted while messages keep arriving only at the cost of miscounting them
+        since = datetime.now() - timedelta(minutes=ACTIVE_MINUTES)
+        with Session() as session:
+            active = session.query(User.id).filter(User.last_active >= since).first() is not None
+        if active and not args.force:
+            parser.error(f"learners wrote in the last {ACTIVE_MINUTES} minutes, stop the app first or pass --force")
+        count = UserStats.rebuild(args.batch_size)
+        logging.info("Counted %d messages", count)
+    else:
+        lines = sys.stdin if args.file == "-" else open(args.file, encoding="utf-8")
+        with lines:
+            count = import_history(lines, args.batch_size)
+        logging.info("Imported %d messages", count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Logging setup for the web app.
+
+Log lines carry their fields as `extra` attributes rather than formatted
+into the message, and formatting only happens for records that are emitted:
+
+    logging.info("New message", extra={"sender": mobile, "type": message_type})
+
+LOG_FORMAT=json writes one JSON object per line for log drains, the default
+text format appends the fields as key=value. Webhook payloads are only
+logged for a sample of requests (LOG_PAYLOAD_SAMPLE_RATE, or all of them at
+DEBUG) and every payload or message text is cut to LOG_MAX_CHARS, so the cost
+of logging does not grow with payload or history size.
+"""
+import json
+import logging
+from os import environ
+import random
+from typing import Any
+
+LOG_LEVEL = environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = environ.get("LOG_FORMAT", "text")
+LOG_PAYLOAD_SAMPLE_RATE = float(environ.get("LOG_PAYLOAD_SAMPLE_RATE", 0.01))
+LOG_MAX_CHARS = int(environ.get("LOG_MAX_CHARS", 1000))
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# attributes every LogRecord has, anything else was passed in `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class Truncated:
+    """Defers serializing a value to when a log record is formatted, and caps its length."""
+
+    __slots__ = ("value", "max_chars")
+
+    def __init__(self, value: Any, max_chars: int = None):
+        self.value = value
+        self.max_chars = LOG_MAX_CHARS if max_chars is None else max_chars
+
+    def __str__(self) -> str:
+        text = self.value if isinstance(self.value, str) else json.dumps(self.value, ensure_ascii=False, default=str)
+        if len(text) <= self.max_chars:
+            return text
+        return f"{text[:self.max_chars]}... ({len(text)} chars)"
+
+
+def fields(record: logging.LogRecord) -> dict:
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        extra = fields(record)
+        if not extra:
+            return line
+        return line + " " + " ".join(f"{key}={value}" for key, value in extra.items())
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **{key: str(value) if isinstance(value, Truncated) else value for key, value in fields(record).items()},
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure(level: str = LOG_LEVEL, format: str = LOG_FORMAT) -> None:
+    """Sets up the root logger, replacing any handlers configured before."""
+    if format not in ("text", "json"):
+        raise ValueError(f"Unknown log format {format}, expected text or json")
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if format == "json" else TextFormatter(TEXT_FORMAT))
+    logging.basicConfig(level=level, handlers=[handler], force=True)
+
+
+def log_payload(message: str, payload: Any, sample_rate: float = None) -> None:
+    """Logs a webhook payload at DEBUG, or for a sample of payloads at INFO."""
+    logger = logging.getLogger()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s: %s", message, Truncated(payload))
+    elif random.random() < (LOG_PAYLOAD_SAMPLE_RATE if sample_rate is None else sample_rate):
+        logger.info("%s: %s", message, Truncated(payload))
@@ -0,0 +1,147 @@
+"""Background download of media sent by users.
+
+Webhooks only enqueue media, a small worker pool downloads it so large
+uploads never hold up text turns. Downloads live in MEDIA_DIR, which is kept
+under MEDIA_QUOTA_BYTES by deleting the oldest files first.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+from os import environ
+from threading import BoundedSemaphore, Lock
+from typing import Callable, Dict, Optional
+
+from heyoo import WhatsApp
+from db import Media, MediaStatus
+
+MEDIA_DIR = environ.get("MEDIA_DIR", "media")
+MEDIA_QUOTA_BYTES = int(environ.get("MEDIA_QUOTA_BYTES", 256 * 1024 * 1024))
+MEDIA_WORKERS = int(environ.get("MEDIA_WORKERS", 2))
+MEDIA_QUEUE_SIZE = int(environ.get("MEDIA_QUEUE_SIZE", 100))
+
+# called with (phone_id, media_type, path, context) once a file is downloaded, context as given to `submit`
+MediaHandler = Callable[[str, str, str, Dict], None]
+
+
+class MediaQueue:
+    def __init__(
+        self,
+        client: Optional[WhatsApp] = None,
+        directory: str = MEDIA_DIR,
+        quota_bytes: int = MEDIA_QUOTA_BYTES,
+        workers: int = MEDIA_WORKERS,
+        queue_size: int = MEDIA_QUEUE_SIZE,
+    ):
+        self.client = client
+        self.directory = directory
+        self.quota_bytes = quota_bytes
+        self.workers = workers
+        self.handlers: Dict[str, MediaHandler] = {}
+
+        # jobs queued or running, submit never blocks the webhook once this is full
+        self._slots = BoundedSemaphore(queue_size)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = Lock()
+
+    def add_handler(self, media_type: str, handler: MediaHandler) -> None:
+        """Registers post-processing for a media type, run on the worker after download."""
+        self.handlers[media_type] = handler
+
+    def submit(
+        self,
+        phone_id: str,
+        media_type: str,
+        media: Dict[str, str],
+        client: Optional[WhatsApp] = None,
+        context: Optional[Dict] = None,
+    ) -> bool:
+        """Queues media from a webhook for download.
+
+        Args:
+            phone_id: sender of the media
+            media_type: image, video, audio or document
+            media: the media object of the webhook, with an id and a mime_type
+            client: client of the number that received the media, the queue's client by default
+            context: what the handler needs to know about the webhook, such as the tenant that received it
+
+        Returns:
+            bool: False if the queue is full or the media was already received
+        """
+        if not self._slots.acquire(blocking=False):
+            logging.warning("Media queue full, dropping %s %s from %s", media_type, media["id"], phone_id)
+            return False
+        try:
+            id = Media.add_media(phone_id, media["id"], media_type, media["mime_type"])
+            if id is None:
+                self._slots.release()
+                return False
+            self._get_executor().submit(
+                self._process, id, phone_id, media_type, media, client or self.client, context or {}
+            )
+        except Exception:
+            self._slots.release()
+            raise
+        return True
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="media")
+            return self._executor
+
+    def _process(
+        self, id: int, phone_id: str, media_type: str, media: Dict[str, str], client: WhatsApp, context: Dict
+    ) -> None:
+        try:
+            url = client.query_media_url(media["id"])
+            path = url and client.download_media(
+                url, media["mime_type"], os.path.join(self.directory, media["id"])
+            )
+            if not path:
+                Media.update_media(id, MediaStatus.failed)
+                return
+            Media.update_media(id, MediaStatus.downloaded, path=path, size=os.path.getsize(path))
+            logging.info("%s sent %s %s", phone_id, media_type, path)
+            self.cleanup(keep=path)
+
+            handler = self.handlers.get(media_type)
+            if handler:
+                handler(phone_id, media_type, path, context)
+        except Exception:
+            logging.exception("Processing %s %s failed", media_type, media["id"])
+            Media.update_media(id, MediaStatus.failed)
+        finally:
+            self._slots.release()
+
+    def cleanup(self, keep: Optional[str] = None) -> int:
+        """Deletes the oldest downloads until the directory is under quota.
+
+        Returns:
+            int: The number of files deleted
+        """
+        with self._lock:
+            files = []
+            for entry in os.scandir(self.directory):
+                if entry.is_file():
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in files)
+
+            deleted = []
+            for _, size, path in sorted(files):
+                if total <= self.quota_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                deleted.append(path)
+
+        if deleted:
+            Media.mark_deleted(deleted)
+            logging.info("Deleted %d media files over quota", len(deleted))
+        return len(deleted)
@@ -0,0 +1,221 @@
+"""Latency histograms and counters in the Prometheus text format.
+
+Stages of a turn are timed with `span`:
+
+    with span("openai"):
+        response = openai.ChatCompletion.create(...)
+
+Recording is a clock read, a bisect and a few additions under a lock, the
+text is only rendered when /metrics is scraped. Every gunicorn worker keeps
+its own values. With METRICS_DIR set, workers also write a snapshot there
+every METRICS_FLUSH_INTERVAL seconds and /metrics serves the sum over all
+workers, whichever worker the scrape lands on.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+import json
+import logging
+import os
+from os import environ
+from threading import Lock, Thread
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+METRICS_DIR = environ.get("METRICS_DIR")
+METRICS_FLUSH_INTERVAL = float(environ.get("METRICS_FLUSH_INTERVAL", 5))
+
+# seconds, from a cached database read to a slow OpenAI completion
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.type = "counter"
+        self._values: Dict[Labels, float] = {}
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self) -> Dict[Labels, float]:
+        with self._lock:
+            return dict(self._values)
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = BUCKETS):
+        self.name = name
+        self.help = help
+        self.type = "histogram"
+        self.buckets = buckets
+        # per label set: a count per bucket plus one for +Inf, then the sum
+        self._values: Dict[Labels, List[float]] = {}
+        self._lock = Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 2)
+            values[index] += 1
+            values[-1] += value
+
+    def snapshot(self) -> Dict[Labels, List[float]]:
+        with self._lock:
+            return {key: list(values) for key, values in self._values.items()}
+
+
+class Collected:
+    """Values read from a callback when metrics are collected, e.g. the size of a cache."""
+
+    def __init__(self, name: str, help: str, callback: Callable[[], Dict[Labels, float]], type: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.callback = callback
+
+    def snapshot(self) -> Dict[Labels, float]:
+        return self.callback()
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+        self._flushing_pid: Optional[int] = None
+        self._lock = Lock()
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._register(Counter(name, help))
+
+    def histogram(self, name: str, help: str, buckets: Tuple[float, ...] = BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, buckets))
+
+    def collect(self, name: str, help: str, callback: Callable[[], Dict[Labels, float]], type: str = "gauge") -> Collected:
+        """Registers metrics maintained elsewhere, `callback` returns their value per label set."""
+        return self._register(Collected(name, help, callback, type))
+
+    def _register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self) -> Dict[str, Dict[Labels, object]]:
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def render(self, directory: Optional[str] = METRICS_DIR) -> str:
+        """Renders all metrics, summed over the snapshots of every worker if `directory` is set."""
+        snapshot = self.snapshot()
+        if directory:
+            self.flush(directory, snapshot)
+            snapshot = _merge(self._read_snapshots(directory))
+
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            for labels, value in sorted(snapshot.get(name, {}).items()):
+                if metric.type != "histogram":
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip([*metric.buckets, "+Inf"], value[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {value[-1]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def start_flushing(self, directory: Optional[str] = METRICS_DIR, interval: float = METRICS_FLUSH_INTERVAL) -> None:
+        """Writes this worker's snapshot to `directory` every `interval` seconds, once per process."""
+        # called on every request, so that the thread is started in each forked worker
+        if not directory or self._flushing_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flushing_pid != os.getpid():
+                self._flushing_pid = os.getpid()
+                Thread(target=self._flush_loop, args=(directory, interval), name="metrics", daemon=True).start()
+
+    def _flush_loop(self, directory: str, interval: float) -> None:
+        while True:
+            time.sleep(interval)
+            try:
+                self.flush(directory)
+            except Exception:
+                logging.exception("Writing metrics to %s failed", directory)
+
+    def flush(self, directory: str, snapshot: Optional[Dict] = None) -> None:
+        os.makedirs(directory, exist_ok=True)
+        snapshot = self.snapshot() if snapshot is None else snapshot
+        path = os.path.join(directory, f"{os.getpid()}.json")
+        with open(f"{path}.tmp", "w") as file:
+            json.dump({name: [[list(labels), value] for labels, value in values.items()] for name, values in snapshot.items()}, file)
+        os.replace(f"{path}.tmp", path)
+
+    def _read_snapshots(self, directory: str) -> Iterator[Dict[str, Dict[Labels, object]]]:
+        # workers that stopped flushing have exited, their counters are dropped like on a restart
+        stale = time.time() - 6 * METRICS_FLUSH_INTERVAL
+        for entry in os.scandir(directory):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                if entry.stat().st_mtime < stale:
+                    os.remove(entry.path)
+                    continue
+                with open(entry.path) as file:
+                    data = json.load(file)
+            except (OSError, ValueError):
+                continue
+            yield {name: {tuple(map(tuple, labels)): value for labels, value in values} for name, values in data.items()}
+
+
+def _merge(snapshots: Iterator[Dict[str, Dict[Labels, object]]]) -> Dict[str, Dict[Labels, object]]:
+    merged: Dict[str, Dict[Labels, object]] = {}
+    for snapshot in snapshots:
+        for name, values in snapshot.items():
+            target = merged.setdefault(name, {})
+            for labels, value in values.items():
+                if labels not in target:
+                    target[labels] = list(value) if isinstance(value, list) else value
+                elif isinstance(value, list):
+                    target[labels] = [a + b for a, b in zip(target[labels], value)]
+                else:
+                    target[labels] += value
+    return merged
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram("gringolingo_stage_seconds", "Time spent in each stage of handling a message")
+REQUEST_SECONDS = registry.histogram("gringolingo_request_seconds", "Time to answer a request, by endpoint")
+REQUESTS = registry.counter("gringolingo_requests_total", "Requests answered, by endpoint and status")
+STAGE_ERRORS = registry.counter("gringolingo_stage_errors_total", "Stages that raised an exception")
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Times a stage of handling a message into `gringolingo_stage_seconds`."""
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
@@ -0,0 +1,262 @@
+"""Daily practice reminders for learners who stopped writing.
+
+Run once a day, e.g. from the Heroku Scheduler:
+
+    python nudges.py --days 3
+
+Inactive learners are found through the index on users.last_active, so a run
+never scans messages. Each selected learner first gets a pending row in the
+nudges table, at most one per period of inactivity. Openers in the style of
+`bot.get_starter` are then written by concurrent OpenAI calls, a batch at a
+time, and sent at most `--rate` per second. A nudge is marked as sending
+before it goes out and as sent afterwards. An interrupted run can simply be
+started again: it finishes the pending and generated nudges and never sends a
+nudge twice. A nudge that was being sent when the run died stays marked as
+sending and is not retried. A nudge that could not be written or sent is
+tried again by later runs, as long as its learner has not written since and
+is not inactive for more than --max-days.
+
+WhatsApp only delivers free-form messages within 24 hours of the learner's
+last message, so nudging after a day or more requires NUDGE_TEMPLATE, an
+approved template with one body parameter, which receives the opener.
+Messenger conversations are skipped.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import logging
+from os import environ
+import time
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+
+from bot import get_nudge
+from db import Message, MessageType, Nudge, NudgeStatus, Session, User, init_db
+from tenants import tenant_registry
+
+NUDGE_TEMPLATE = environ.get("NUDGE_TEMPLATE")
+NUDGE_TEMPLATE_LANGUAGE = environ.get("NUDGE_TEMPLATE_LANGUAGE", "en_US")
+
+
+def select_inactive(inactive_since: datetime, not_before: datetime, limit: int = 1000) -> int:
+    """Creates pending nudges for learners whose last message falls between two times.
+
+    Args:
+        inactive_since: learners who wrote after this are still active
+        not_before: learners who last wrote before this are not nudged anymore
+        limit: maximum number of nudges created
+
+    Returns:
+        int: The number of nudges created
+    """
+    with Session() as session:
+        nudged = (
+            session.query(Nudge.id)
+            .filter(Nudge.user_id == User.id, Nudge.since == User.last_active)
+            .exists()
+        )
+        users = (
+            session.query(User.id, User.last_active)
+            .filter(User.last_active < inactive_since, User.last_active >= not_before)
+            .filter(~nudged)
+            .order_by(User.last_active)
+            .limit(limit)
+            .all()
+        )
+        if not users:
+            return 0
+        now = datetime.now()
+        try:
+            session.execute(insert(Nudge), [
+                dict(user_id=user_id, since=last_active, status=NudgeStatus.pending, timestamp=now)
+                for user_id, last_active in users
+            ])
+            session.commit()
+        except IntegrityError:
+            # another run selected the same learners first
+            session.rollback()
+            return 0
+        return len(users)
+
+
+def retry_failed(not_before: datetime) -> int:
+    """Returns failed nudges of learners still inactive since `not_before` to the step that failed.
+
+    Returns:
+        int: The number of nudges to retry
+    """
+    with Session() as session:
+        current = (
+            session.query(User.id)
+            .filter(User.id == Nudge.user_id, User.last_active == Nudge.since)
+            .exists()
+        )
+        failed = session.query(Nudge).filter(Nudge.status == NudgeStatus.failed, Nudge.since >= not_before, current)
+        # nudges without an opener failed to be written, the others to be sent
+        retried = failed.filter(Nudge.content.is_(None)).update(
+            {Nudge.status: NudgeStatus.pending}, synchronize_session=False
+        ) + failed.filter(Nudge.content.isnot(None)).update(
+            {Nudge.status: NudgeStatus.generated}, synchronize_session=False
+        )
+        session.commit()
+        return retried
+
+
+def _get_nudges(status: NudgeStatus, limit: int) -> List[Tuple[int, str, Optional[str]]]:
+    """Returns (id, phone_id, content) of the oldest nudges in a status."""
+    with Session() as session:
+        return (
+            session.query(Nudge.id, User.phone_id, Nudge.content)
+            .join(User, User.id == Nudge.user_id)
+            .filter(Nudge.status == status)
+            .order_by(Nudge.id)
+            .limit(limit)
+            .all()
+        )
+
+
+def _update_nudges(updates: Dict[int, Dict]) -> None:
+    """Writes the new status and content of several nudges in one transaction."""
+    with Session() as session:
+        for id, values in updates.items():
+            session.query(Nudge).filter(Nudge.id == id).update(values, synchronize_session=False)
+        session.commit()
+
+
+def _write(phone_id: str) -> Dict:
+    tenant, _ = tenant_registry.split_key(phone_id)
+    if tenant is None or tenant.channel != "whatsapp":
+        return {Nudge.status: NudgeStatus.skipped}
+    try:
+        return {Nudge.status: NudgeStatus.generated, Nudge.content: get_nudge(phone_id, tenant.language)}
+    except Exception:
+        logging.exception("Writing the nudge for %s failed", phone_id)
+        return {Nudge.status: NudgeStatus.failed}
+
+
+def generate(batch_size: int = 50, concurrency: int = 8) -> int:
+    """Writes the openers of all pending nudges, `concurrency` OpenAI calls at a time.
+
+    Returns:
+        int: The number of nudges written
+    """
+    total = 0
+    with ThreadPoolExecutor(concurrency, thread_name_prefix="nudge") as executor:
+        while True:
+            batch = _get_nudges(NudgeStatus.pending, batch_size)
+            if not batch:
+                return total
+            results = executor.map(_write, [phone_id for _, phone_id, _ in batch])
+            updates = {id: values for (id, _, _), values in zip(batch, results)}
+            _update_nudges(updates)
+            written = sum(values[Nudge.status] == NudgeStatus.generated for values in updates.values())
+            total += written
+            logging.info("Wrote %d of %d nudges", written, len(batch))
+
+
+def send(phone_id: str, content: str) -> bool:
+    tenant, mobile = tenant_registry.split_key(phone_id)
+    if NUDGE_TEMPLATE:
+        result = tenant.client.send_template(
+            NUDGE_TEMPLATE,
+            mobile,
+            lang=NUDGE_TEMPLATE_LANGUAGE,
+            components=[{"type": "body", "parameters": [{"type": "text", "text": content}]}],
+        )
+    else:
+        result = tenant.client.send_message(content, mobile)
+    return bool(result and "messages" in result)
+
+
+def dispatch(rate: float = 5, batch_size: int = 50) -> int:
+    """Sends the generated nudges, at most `rate` per second.
+
+    Returns:
+        int: The number of nudges sent
+    """
+    total = 0
+    next_send = time.monotonic()
+    while True:
+        batch = _get_nudges(NudgeStatus.generated, batch_size)
+        if not batch:
+            return total
+        for id, phone_id, content in batch:
+            time.sleep(max(0.0, next_send - time.monotonic()))
+            next_send = max(next_send, time.monotonic()) + 1 / rate
+            # marked before sending, so a nudge is never sent twice even if the run dies right after
+            _update_nudges({id: {Nudge.status: NudgeStatus.sending}})
+            try:
+                sent = send(phone_id, content)
+            except Exception:
+                logging.exception("Sending the nudge to %s failed", phone_id)
+                sent = False
+            if sent:
+                # part of the conversation, so the tutor knows what the learner answers to
+                Message.add_message(phone_id, content, MessageType.bot_message)
+                total += 1
+            _update_nudges({id: {
+                Nudge.status: NudgeStatus.sent if sent else NudgeStatus.failed,
+                Nudge.timestamp: datetime.now(),
+            }})
+        logging.info("Sent %d nudges", total)
+
+
+def run(
+    days: float,
+    max_days: float = 30,
+    batch_size: int = 50,
+    concurrency: int = 8,
+    rate: float = 5,
+    dry_run: bool = False,
+) -> int:
+    """Nudges learners who last wrote between `days` and `max_days` days ago, returns how many were sent."""
+    now = datetime.now()
+    created = 0
+    while True:
+        selected = select_inactive(now - timedelta(days=days), now - timedelta(days=max_days), batch_size)
+        if selected == 0:
+            break
+        created += selected
+    logging.info("Selected %d inactive learners", created)
+    retried = retry_failed(now - timedelta(days=max_days))
+    if retried:
+        logging.info("Retrying %d nudges that failed in earlier runs", retried)
+
+    with Session() as session:
+        stuck = session.query(Nudge).filter(Nudge.status == NudgeStatus.sending).count()
+    if stuck:
+        logging.warning("%d nudges were being sent when an earlier run stopped, they are not sent again", stuck)
+
+    generate(batch_size, concurrency)
+    if dry_run:
+        for _, phone_id, content in _get_nudges(NudgeStatus.generated, batch_size):
+            print(f"{phone_id}: {content}")
+        return 0
+    return dispatch(rate, batch_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send practice reminders to learners who stopped writing.")
+    parser.add_argument("--days", type=float, default=3, help="nudge learners who have not written for this many days")
+    parser.add_argument("--max-days", type=float, default=30, help="leave learners alone after this many days")
+    parser.add_argument("--batch-size", type=int, default=50, help="nudges read and written per transaction")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent OpenAI calls")
+    parser.add_argument("--rate", type=float, default=5, help="messages sent per second")
+    parser.add_argument("--dry-run", action="store_true", help="write and print the nudges, a later run sends them")
+    args = parser.parse_args()
+    if args.max_days <= args.days:
+        parser.error("--max-days must be more than --days")
+    if args.days >= 1 and not NUDGE_TEMPLATE:
+        # every free-form message would be rejected outside the 24 hour window
+        parser.error("nudging after a day or more requires NUDGE_TEMPLATE, an approved WhatsApp template")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    init_db()
+    sent = run(args.days, args.max_days, args.batch_size, args.concurrency, args.rate, args.dry_run)
+    logging.info("Done, sent %d nudges", sent)
+
+
+if __name__ == "__main__":
+    main()
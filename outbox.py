@@ -0,0 +1,173 @@
+"""Delivery of stored replies.
+
+`bot.get_response` stores each reply together with an `OutboxMessage` row in
+one transaction, and the outbox delivers the row. A reply that could not be
+sent, because the Graph API failed or the worker died, is retried from the
+database with exponential backoff instead of being generated again. A turn
+that is answered a second time after a crash finds its reply already stored
+and does not call OpenAI again.
+
+Each worker delivers the replies of the shards it holds (see shards.py). The
+replies of one learner are sent one at a time in the order they were stored,
+replies to different learners are sent concurrently by OUTBOX_SENDERS
+threads. The outcome of a batch of deliveries is written in one transaction,
+so a reply is only sent twice if its worker dies between sending it and
+writing the batch. A batch waits at most OUTBOX_BATCH_TIMEOUT seconds for its
+deliveries, so one slow learner does not hold up everyone else's replies.
+Deliveries still running then are recorded when they finish, and their
+learner's replies are not picked up again until then.
+"""
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from functools import partial
+from datetime import datetime
+import logging
+from os import environ
+import random
+from threading import Event, Lock, Thread
+import time
+from typing import Callable, Dict, List, Optional, Set
+
+from db import OutboxMessage, OutboxStatus
+from green import cooperative
+from metrics import registry, span
+from shards import shard_queue
+
+OUTBOX_SENDERS = int(environ.get("OUTBOX_SENDERS", 64 if cooperative() else 8))
+OUTBOX_BATCH_SIZE = int(environ.get("OUTBOX_BATCH_SIZE", 100))
+OUTBOX_MAX_ATTEMPTS = int(environ.get("OUTBOX_MAX_ATTEMPTS", 6))
+# seconds before the first retry, doubled for every further attempt
+OUTBOX_BACKOFF = float(environ.get("OUTBOX_BACKOFF", 2))
+OUTBOX_MAX_BACKOFF = float(environ.get("OUTBOX_MAX_BACKOFF", 300))
+# seconds between checks for replies due for a retry
+OUTBOX_POLL_INTERVAL = float(environ.get("OUTBOX_POLL_INTERVAL", 1))
+# seconds a batch waits for its deliveries before the next batch starts
+OUTBOX_BATCH_TIMEOUT = float(environ.get("OUTBOX_BATCH_TIMEOUT", 30))
+
+DELIVERIES = registry.counter("gringolingo_outbox_deliveries_total", "Reply deliveries, by channel and result")
+
+# sends a reply, called with (tenant id, recipient id, content), returns the id the Graph API gave the message
+Sender = Callable[[str, str, str], str]
+
+
+class DeliveryError(Exception):
+    """Raised by senders when the Graph API did not accept a message."""
+
+
+class Outbox:
+    def __init__(
+        self,
+        senders: int = OUTBOX_SENDERS,
+        batch_size: int = OUTBOX_BATCH_SIZE,
+        max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+        backoff: float = OUTBOX_BACKOFF,
+        max_backoff: float = OUTBOX_MAX_BACKOFF,
+        poll_interval: float = OUTBOX_POLL_INTERVAL,
+        batch_timeout: float = OUTBOX_BATCH_TIMEOUT,
+    ):
+        self.senders: Dict[str, Sender] = {}
+        self.threads = senders
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self.batch_timeout = batch_timeout
+
+        # learners whose deliveries outlived their batch
+        self._in_flight: Set[str] = set()
+        self._wakeup = Event()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = Lock()
+
+    def add_sender(self, channel: str, sender: Sender) -> None:
+        """Registers the function delivering replies on a channel."""
+        self.senders[channel] = sender
+
+    def notify(self) -> None:
+        """Wakes the dispatcher after a reply was stored by this worker."""
+        self.start()
+        self._wakeup.set()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix="outbox")
+                Thread(target=self._run, name="outbox", daemon=True).start()
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                delivered = self.deliver_pending()
+            except Exception:
+                logging.exception("Delivering replies failed")
+                delivered = 0
+            if delivered < self.batch_size:
+                self._wakeup.wait(self.poll_interval)
+
+    def deliver_pending(self) -> int:
+        """Delivers a batch of due replies of this worker's shards.
+
+        Returns:
+            int: The number of replies tried
+        """
+        by_key: Dict[str, List[Dict]] = {}
+        for reply in OutboxMessage.get_pending(shard_queue.held(), self.batch_size):
+            if reply["key"] not in self._in_flight:
+                by_key.setdefault(reply["key"], []).append(reply)
+        if not by_key:
+            return 0
+
+        futures = {self._executor.submit(self._deliver_in_order, replies): key for key, replies in by_key.items()}
+        done, late = wait(futures, timeout=self.batch_timeout)
+        updates: Dict[int, Dict] = {}
+        for future in done:
+            updates.update(future.result())
+        OutboxMessage.update_batch(updates)
+        for future in late:
+            key = futures[future]
+            logging.warning("Replies to %s still being sent after %.0fs", key, self.batch_timeout)
+            self._in_flight.add(key)
+            future.add_done_callback(partial(self._record_late, key))
+        return len(updates)
+
+    def _record_late(self, key: str, future: Future) -> None:
+        try:
+            OutboxMessage.update_batch(future.result())
+        except Exception:
+            logging.exception("Recording replies to %s failed", key)
+        finally:
+            self._in_flight.discard(key)
+
+    def _deliver_in_order(self, replies: List[Dict]) -> Dict[int, Dict]:
+        updates = {}
+        for reply in replies:
+            updates[reply["id"]] = update = self._deliver(reply)
+            if update.get(OutboxMessage.status) != OutboxStatus.sent:
+                break
+        return updates
+
+    def _deliver(self, reply: Dict) -> Dict:
+        try:
+            with span("send_message"):
+                provider_id = self.senders[reply["channel"]](reply["tenant"], reply["recipient"], reply["content"])
+        except Exception as error:
+            attempts = reply["attempts"] + 1
+            if attempts >= self.max_attempts:
+                logging.error("Giving up on reply %d to %s after %d attempts: %s", reply["id"], reply["key"], attempts, error)
+                DELIVERIES.inc(channel=reply["channel"], result="failed")
+                return {OutboxMessage.status: OutboxStatus.failed, OutboxMessage.attempts: attempts}
+            delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1)) * random.uniform(0.5, 1.5)
+            logging.warning("Reply %d to %s not delivered, retrying in %.0fs: %s", reply["id"], reply["key"], delay, error)
+            DELIVERIES.inc(channel=reply["channel"], result="retry")
+            return {OutboxMessage.attempts: attempts, OutboxMessage.next_attempt: time.time() + delay}
+        DELIVERIES.inc(channel=reply["channel"], result="sent")
+        return {
+            OutboxMessage.status: OutboxStatus.sent,
+            OutboxMessage.attempts: reply["attempts"] + 1,
+            OutboxMessage.provider_id: provider_id,
+            OutboxMessage.sent: datetime.now(),
+        }
+
+
+outbox = Outbox()
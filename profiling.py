@@ -0,0 +1,246 @@
+"""Opt-in profiling of webhook requests and of the turns they queue.
+
+A request is profiled when it carries a valid X-Profile token, when it is
+picked by PROFILE_SAMPLE_RATE, or while a profiling window opened with
+POST /profile is running. Tokens are signed with PROFILE_SECRET and expire:
+
+    python profiling.py token --seconds 600
+    curl -H "X-Profile: <token>" -X POST https://.../whatsapi -d @payload.json
+    curl -H "X-Profile: <token>" -X POST "https://.../profile?seconds=60"
+
+Profiles are written to PROFILE_DIR, either as cProfile stats (PROFILE_FORMAT=pstats,
+open with `python -m pstats` or snakeviz) or as sampled call stacks in the
+folded format read by flamegraph.pl and speedscope (PROFILE_FORMAT=folded).
+Without PROFILE_SECRET and PROFILE_SAMPLE_RATE the handlers are not wrapped at all.
+
+The webhooks only store turns, the history, OpenAI and the reply are done
+later by the dispatchers (see shards.py). Turns are profiled on their own,
+when picked by PROFILE_SAMPLE_RATE or in a profiling window; a token only
+profiles the webhook request that carries it.
+"""
+import argparse
+from collections import Counter
+import cProfile
+from functools import wraps
+import hashlib
+import hmac
+import itertools
+import logging
+import os
+from os import environ
+import random
+import sys
+from threading import Event, Lock, Thread, get_ident
+import time
+from typing import Callable, Optional
+
+from flask import request
+
+PROFILE_DIR = environ.get("PROFILE_DIR", "profiles")
+PROFILE_SECRET = environ.get("PROFILE_SECRET")
+PROFILE_SAMPLE_RATE = float(environ.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_FORMAT = environ.get("PROFILE_FORMAT", "pstats")
+# seconds between stack samples in the folded format
+PROFILE_INTERVAL = float(environ.get("PROFILE_INTERVAL", 0.001))
+PROFILE_MAX_FILES = int(environ.get("PROFILE_MAX_FILES", 200))
+
+HEADER = "X-Profile"
+# file holding the end of the current profiling window, shared by the gunicorn workers
+WINDOW_FILE = "window"
+
+
+def sign(expires: int, secret: str = PROFILE_SECRET) -> str:
+    """Returns a token valid until the epoch time `expires`."""
+    signature = hmac.new(secret.encode(), str(expires).encode(), hashlib.sha256).hexdigest()
+    return f"{expires}:{signature}"
+
+
+def verify(token: str, secret: str = PROFILE_SECRET) -> bool:
+    expires, _, _ = token.partition(":")
+    if not secret or not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(token, sign(int(expires), secret))
+
+
+class StackSampler:
+    """Samples the call stack of one thread into folded stacks until stopped."""
+
+    def __init__(self, thread_id: int, interval: float = PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = Event()
+        self._thread = Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def dump(self, path: str) -> None:
+        with open(path, "w") as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f"{stack} {count}\n")
+
+
+class Profiler:
+    def __init__(
+        self,
+        directory: str = PROFILE_DIR,
+        secret: Optional[str] = PROFILE_SECRET,
+        sample_rate: float = PROFILE_SAMPLE_RATE,
+        format: str = PROFILE_FORMAT,
+        max_files: int = PROFILE_MAX_FILES,
+    ):
+        if format not in ("pstats", "folded"):
+            raise ValueError(f"Unknown profile format {format}, expected pstats or folded")
+        self.directory = directory
+        self.secret = secret
+        self.sample_rate = sample_rate
+        self.format = format
+        self.max_files = max_files
+        self._window_until = 0.0
+        self._window_checked = 0.0
+        self._sequence = itertools.count()
+        self._cprofile_lock = Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.secret) or self.sample_rate > 0
+
+    def wrap(self, view: Callable) -> Callable:
+        """Decorates a Flask view so that selected requests are profiled."""
+        if not self.enabled:
+            return view
+
+        @wraps(view)
+        def profiled(*args, **kwargs):
+            if not self._selected():
+                return view(*args, **kwargs)
+            return self._profile(request.endpoint, view, args, kwargs)
+        return profiled
+
+    def call(self, name: str, function: Callable, *args, **kwargs):
+        """Calls a function outside of a request, profiled when picked by PROFILE_SAMPLE_RATE or in a window."""
+        if not self.enabled or not self._sampled() and not (self.secret and self._in_window()):
+            return function(*args, **kwargs)
+        return self._profile(name, function, args, kwargs)
+
+    def open_window(self, seconds: float) -> float:
+        """Profiles every request of every worker for the next `seconds`, returns when the window ends."""
+        until = time.time() + seconds
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, WINDOW_FILE), "w") as file:
+            file.write(str(until))
+        self._window_checked = 0.0
+        return until
+
+    def _selected(self) -> bool:
+        if self._sampled():
+            return True
+        if not self.secret:
+            return False
+        token = request.headers.get(HEADER)
+        if token is not None:
+            return verify(token, self.secret)
+        return self._in_window()
+
+    def _sampled(self) -> bool:
+        return bool(self.sample_rate) and random.random() < self.sample_rate
+
+    def _in_window(self) -> bool:
+        now = time.time()
+        # the window file is read at most once a second per worker
+        if now - self._window_checked >= 1:
+            self._window_checked = now
+            try:
+                with open(os.path.join(self.directory, WINDOW_FILE)) as file:
+                    self._window_until = float(file.read())
+            except (OSError, ValueError):
+                self._window_until = 0.0
+        return now < self._window_until
+
+    def _profile(self, name: str, view: Callable, args, kwargs):
+        name = f"{name}-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{next(self._sequence)}"
+        started = time.perf_counter()
+        if self.format == "pstats":
+            # cProfile hooks the whole interpreter, requests running meanwhile on other threads are not profiled
+            if not self._cprofile_lock.acquire(blocking=False):
+                return view(*args, **kwargs)
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(view, *args, **kwargs)
+            finally:
+                self._cprofile_lock.release()
+                self._save(profile.dump_stats, f"{name}.prof", started)
+        sampler = StackSampler(get_ident())
+        sampler.start()
+        try:
+            return view(*args, **kwargs)
+        finally:
+            sampler.stop()
+            self._save(sampler.dump, f"{name}.folded", started)
+
+    def _save(self, write: Callable[[str], None], filename: str, started: float) -> None:
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, filename)
+            write(path)
+            logging.info("Profiled %.1f ms to %s", (time.perf_counter() - started) * 1000, path)
+            self._prune()
+        except OSError:
+            logging.exception("Writing profile %s failed", filename)
+
+    def _prune(self) -> None:
+        profiles = sorted(
+            (entry for entry in os.scandir(self.directory) if entry.name != WINDOW_FILE),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        for entry in profiles[:max(0, len(profiles) - self.max_files)]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+profiler = Profiler()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profiling helpers.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    token_parser = subparsers.add_parser("token", help=f"print a token for the {HEADER} header")
+    token_parser.add_argument("--seconds", type=int, default=600, help="how long the token is valid")
+
+    show_parser = subparsers.add_parser("show", help="print the most expensive calls of a .prof file")
+    show_parser.add_argument("file")
+    show_parser.add_argument("--limit", type=int, default=30)
+    show_parser.add_argument("--sort", default="cumulative")
+
+    args = parser.parse_args()
+    if args.command == "token":
+        if not PROFILE_SECRET:
+            parser.error("PROFILE_SECRET is not set")
+        print(sign(int(time.time()) + args.seconds))
+    else:
+        import pstats
+
+        pstats.Stats(args.file).sort_stats(args.sort).print_stats(args.limit)
+
+
+if __name__ == "__main__":
+    main()
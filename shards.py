@@ -0,0 +1,250 @@
+"""Per-user ordering of turns across gunicorn workers.
+
+Every conversation key hashes to one of SHARD_COUNT shards. Webhooks only
+store the turn in the `turns` table and return. The dispatcher threads of the
+worker holding a shard's lease (see `db.ShardLease`) answer the turns of the
+shard one at a time, in the order they arrived. Two messages from the same
+learner are never answered concurrently, while different learners are
+answered in parallel by all workers.
+
+Each worker prefers the shards `s` with `s % workers == index`, and the hooks
+in gunicorn.conf.py hand out indexes below the number of workers. A worker
+started by a reload or as a replacement gets the index of the worker it
+replaces, and takes over its shards once that worker has released them on exit
+or its leases expired. Shards no live worker prefers, e.g. after scaling down,
+are taken by any worker finding turns in them once their lease expired
+SHARD_LEASE_SECONDS ago, and given back when they have no turns left.
+
+Turns stored by this worker wake their dispatcher at once. Turns stored by
+other workers are found by one poller per worker, which looks up the shards
+with waiting turns every SHARD_POLL_INTERVAL seconds, renews the worker's
+leases and wakes only the dispatchers of those shards. Idle dispatchers block
+until they are woken, so an idle worker makes one query per interval however
+many dispatchers it runs. The worker holding a shard also holds its learners'
+conversation cache, which it drops when it takes a shard, so the cache is never
+stale.
+"""
+import json
+import logging
+import os
+from os import environ
+import socket
+from threading import Event, Lock, Thread
+import time
+from typing import Callable, Dict, List, Optional
+import zlib
+
+from cache import conversation_cache
+from db import OutboxMessage, ShardLease, Turn
+from green import cooperative
+from metrics import STAGE_SECONDS, span
+from profiling import profiler
+
+SHARD_COUNT = int(environ.get("SHARD_COUNT", 64))
+# dispatcher threads per worker, each answers the turns of a fixed subset of the shards,
+# greenlets on gevent workers, where many are cheap
+SHARD_THREADS = int(environ.get("SHARD_THREADS", 64 if cooperative() else 4))
+# seconds between polls for turns stored by other workers, one query per worker
+SHARD_POLL_INTERVAL = float(environ.get("SHARD_POLL_INTERVAL", 0.05))
+SHARD_BATCH_SIZE = int(environ.get("SHARD_BATCH_SIZE", 100))
+# seconds a worker holds its shards without renewing them, renewed three times as often,
+# so a worker that died without releasing its shards holds up their turns this long
+SHARD_LEASE_SECONDS = float(environ.get("SHARD_LEASE_SECONDS", 30))
+
+# called with (key, payload, turn id) for every turn of a kind
+TurnHandler = Callable[[str, Dict, int], None]
+
+
+def shard_of(key: str, count: int = SHARD_COUNT) -> int:
+    return zlib.crc32(key.encode()) % count
+
+
+class ShardedQueue:
+    def __init__(
+        self,
+        count: int = SHARD_COUNT,
+        threads: int = SHARD_THREADS,
+        poll_interval: float = SHARD_POLL_INTERVAL,
+        batch_size: int = SHARD_BATCH_SIZE,
+        lease_seconds: float = SHARD_LEASE_SECONDS,
+    ):
+        self.count = count
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.handlers: Dict[str, TurnHandler] = {}
+        # every shard until gunicorn assigns this worker its share
+        self.worker_index = 0
+        self.workers = 1
+        self.owner = ""
+
+        # shard -> epoch seconds its lease is held until
+        self._held: Dict[int, float] = {}
+        self._renewed = 0.0
+        self._wakeups: List[Event] = []
+        self._dispatchers: List[Thread] = []
+        self._started = False
+        self._stopped = Event()
+        self._lock = Lock()
+
+    def add_handler(self, kind: str, handler: TurnHandler) -> None:
+        """Registers the function answering turns of a kind."""
+        self.handlers[kind] = handler
+
+    def assign(self, worker_index: int, workers: int) -> None:
+        """Sets the worker this process is, before the dispatchers start."""
+        if self._started:
+            raise RuntimeError("Shards must be assigned before the dispatchers start")
+        if not 0 <= worker_index < workers:
+            raise ValueError(f"Worker index {worker_index} out of range for {workers} workers")
+        self.worker_index = worker_index
+        self.workers = workers
+
+    def owned(self) -> List[int]:
+        """Returns the shards this worker prefers, it answers them while it holds their leases."""
+        return [shard for shard in range(self.count) if shard % self.workers == self.worker_index]
+
+    def holds(self, shard: int) -> bool:
+        return self._held.get(shard, 0) > time.time()
+
+    def held(self) -> List[int]:
+        """Returns the shards whose turns this worker answers and whose replies it delivers."""
+        if not self._started:
+            # nothing is leased before the dispatchers start, e.g. in tools and tests calling the outbox directly
+            return self.owned()
+        return sorted(shard for shard in self._held if self.holds(shard))
+
+    def submit(self, key: str, kind: str, payload: Dict) -> int:
+        """Stores a turn for the worker holding the key's shard.
+
+        Args:
+            key: conversation key, turns with the same key are answered one at a time in order
+            kind: which handler answers the turn
+            payload: JSON serializable arguments for the handler
+
+        Returns:
+            int: id of the stored turn
+        """
+        if kind not in self.handlers:
+            raise ValueError(f"No handler for {kind} turns")
+        self.start()
+        shard = shard_of(key, self.count)
+        id = Turn.add_turn(shard, key, kind, payload)
+        if self.holds(shard):
+            # answered by this process, no need to wait for the next poll
+            self._wakeups[self._thread_of(shard)].set()
+        return id
+
+    def start(self) -> None:
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            self.owner = f"{socket.gethostname()}:{os.getpid()}"
+            for index in range(self.threads):
+                wakeup = Event()
+                self._wakeups.append(wakeup)
+                thread = Thread(target=self._run, args=(index, wakeup), name=f"shards-{index}", daemon=True)
+                self._dispatchers.append(thread)
+                thread.start()
+            Thread(target=self._poll, name="shards-poller", daemon=True).start()
+            logging.info("Worker %d of %d prefers %d shards", self.worker_index, self.workers, len(self.owned()))
+
+    def stop(self, timeout: float = 10) -> None:
+        """Finishes the turns being answered and releases the shards, called by gunicorn when a worker exits."""
+        if not self._started:
+            return
+        self._stopped.set()
+        for wakeup in self._wakeups:
+            wakeup.set()
+        deadline = time.monotonic() + timeout
+        for thread in self._dispatchers:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        held, self._held = list(self._held), {}
+        if any(thread.is_alive() for thread in self._dispatchers):
+            # still answering, its replacement takes the shards when the leases expire
+            logging.warning("Turns still being answered on exit, leaving shards %s to expire", held)
+            return
+        ShardLease.release(held, self.owner)
+
+    def _thread_of(self, shard: int) -> int:
+        return shard // self.workers % self.threads
+
+    def _run(self, index: int, wakeup: Event) -> None:
+        while not self._stopped.is_set():
+            wakeup.clear()
+            turns = []
+            try:
+                shards = [shard for shard in self._held if self._thread_of(shard) == index and self.holds(shard)]
+                if shards:
+                    turns = Turn.get_pending(shards, self.batch_size)
+                for turn in turns:
+                    if self._stopped.is_set() or not self.holds(turn.shard):
+                        break
+                    self._answer(turn)
+            except Exception:
+                logging.exception("Reading turns of dispatcher %d failed", index)
+                turns = []
+            if len(turns) < self.batch_size:
+                # woken by submit or by the poller
+                wakeup.wait()
+
+    def _poll(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                for shard in self._lease(Turn.pending_shards(list(range(self.count)))):
+                    self._wakeups[self._thread_of(shard)].set()
+            except Exception:
+                logging.exception("Polling for turns failed")
+            self._stopped.wait(self.poll_interval)
+
+    def _lease(self, pending: List[int], now: Optional[float] = None) -> List[int]:
+        """Renews and takes the leases of this worker's shards, returns the shards with turns it holds."""
+        if now is None:
+            now = time.time()
+        owned = set(self.owned())
+        pending = set(pending)
+        until = now + self.lease_seconds
+        if now >= self._renewed + self.lease_seconds / 3:
+            # shards this worker prefers, and the others only while they have turns or replies to deliver,
+            # unrenewed leases expire rather than being released, in case a turn just arrived
+            busy = pending.union(OutboxMessage.pending_shards())
+            renewed = owned.union(shard for shard in self._held if shard in busy)
+            held = dict.fromkeys(ShardLease.acquire(sorted(renewed), self.owner, until, expired_before=now), until)
+            # shards no live worker took for a whole lease, e.g. preferred by a worker scaled down
+            orphans = sorted(busy - renewed)
+            held.update(dict.fromkeys(
+                ShardLease.acquire(orphans, self.owner, until, expired_before=now - self.lease_seconds), until
+            ))
+            self._renewed = now
+        else:
+            # shards with turns this worker prefers, e.g. released by the worker it replaces
+            waiting = [shard for shard in pending if shard in owned and self._held.get(shard, 0) <= now]
+            taken = ShardLease.acquire(waiting, self.owner, until, expired_before=now)
+            held = {**self._held, **dict.fromkeys(taken, until)}
+        gained = {shard for shard in held if self._held.get(shard, 0) <= now}
+        if gained:
+            # another worker may have answered these learners since this one cached their conversation
+            conversation_cache.invalidate_matching(lambda key: shard_of(key, self.count) in gained)
+        # replaced rather than changed, the dispatchers read it meanwhile
+        self._held = held
+        return sorted(shard for shard in pending if held.get(shard, 0) > now)
+
+    def _answer(self, turn: Turn) -> None:
+        STAGE_SECONDS.observe(max(0.0, time.time() - turn.created), stage="shard_wait")
+        handler: Optional[TurnHandler] = self.handlers.get(turn.kind)
+        try:
+            if handler is None:
+                logging.error("No handler for %s turn %d of %s", turn.kind, turn.id, turn.key)
+            else:
+                with span("turn"):
+                    profiler.call(f"turn-{turn.kind}", handler, turn.key, json.loads(turn.payload), turn.id)
+        except Exception:
+            # a failing turn must not hold up the ones queued behind it
+            logging.exception("Answering %s turn %d of %s failed", turn.kind, turn.id, turn.key)
+        finally:
+            Turn.delete_turn(turn.id)
+
+
+shard_queue = ShardedQueue()
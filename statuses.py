@@ -0,0 +1,133 @@
+"""Recording of delivery and read statuses from the WhatsApp webhook.
+
+Every reply causes several status callbacks (sent, delivered, read), so they
+outnumber the learners' messages several times over. The webhook recognizes
+them from the raw body without parsing it (see `app.is_status_callback`),
+hands the body to the tracker and returns at once. A background thread
+parses the buffered bodies every STATUS_FLUSH_INTERVAL seconds, merges the
+statuses of the same message and upserts them into `message_statuses` in
+one statement per STATUS_BATCH_SIZE messages.
+
+Statuses are analytics, not state the bot relies on: bodies still buffered
+when a worker is killed are lost, and when more than STATUS_BUFFER_SIZE
+bodies are waiting new ones are dropped and counted.
+"""
+from collections import deque
+from datetime import datetime
+import json
+import logging
+from os import environ
+from threading import Event, Lock, Thread
+from typing import Deque, Dict, Iterator, List, Optional
+
+from db import DELIVERY_STATUS_CODES, MessageStatus
+from metrics import registry, span
+
+STATUS_FLUSH_INTERVAL = float(environ.get("STATUS_FLUSH_INTERVAL", 1))
+STATUS_BATCH_SIZE = int(environ.get("STATUS_BATCH_SIZE", 1000))
+STATUS_BUFFER_SIZE = int(environ.get("STATUS_BUFFER_SIZE", 10000))
+
+STATUSES = registry.counter("gringolingo_statuses_total", "Delivery statuses received, by status")
+DROPPED = registry.counter("gringolingo_status_callbacks_dropped_total", "Status callbacks not recorded, by reason")
+
+
+def parse_statuses(body: bytes) -> Iterator[Dict]:
+    """Yields the statuses of a webhook body as they appear in the payload."""
+    data = json.loads(body)
+    for entry in data.get("entry", ()):
+        for change in entry.get("changes", ()):
+            yield from change.get("value", {}).get("statuses", ())
+
+
+class StatusTracker:
+    def __init__(
+        self,
+        flush_interval: float = STATUS_FLUSH_INTERVAL,
+        batch_size: int = STATUS_BATCH_SIZE,
+        buffer_size: int = STATUS_BUFFER_SIZE,
+    ):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+
+        self._bodies: Deque[bytes] = deque()
+        self._thread: Optional[Thread] = None
+        self._stopped = Event()
+        self._lock = Lock()
+        self._flush_lock = Lock()
+
+    def add(self, body: bytes) -> None:
+        """Buffers the raw body of a status callback, called by the webhook."""
+        if len(self._bodies) >= self.buffer_size:
+            DROPPED.inc(reason="buffer_full")
+            return
+        self._bodies.append(body)
+        if self._thread is None:
+            self.start()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="statuses", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Recording delivery statuses failed")
+
+    def flush(self) -> int:
+        """Records the buffered statuses, also called by gunicorn when a worker exits.
+
+        Returns:
+            int: The number of messages whose status was recorded
+        """
+        with self._flush_lock:
+            bodies = []
+            while self._bodies:
+                bodies.append(self._bodies.popleft())
+            if not bodies:
+                return 0
+            with span("status_parse"):
+                rows = self._merge(bodies)
+            with span("status_upsert"):
+                for start in range(0, len(rows), self.batch_size):
+                    MessageStatus.upsert_batch(rows[start:start + self.batch_size])
+            return len(rows)
+
+    def _merge(self, bodies: List[bytes]) -> List[Dict]:
+        # one row per message, so that an upsert never touches the same row twice
+        rows: Dict[str, Dict] = {}
+        for body in bodies:
+            try:
+                statuses = list(parse_statuses(body))
+            except (ValueError, AttributeError):
+                DROPPED.inc(reason="malformed")
+                continue
+            for status in statuses:
+                code = DELIVERY_STATUS_CODES.get(status.get("status"))
+                if code is None or not status.get("id"):
+                    DROPPED.inc(reason="unknown_status")
+                    continue
+                try:
+                    reported = datetime.fromtimestamp(int(status["timestamp"])) if status.get("timestamp") else datetime.now()
+                except (ValueError, TypeError, OverflowError, OSError):
+                    # the buffer is already drained, one bad status must not lose the others
+                    DROPPED.inc(reason="malformed")
+                    continue
+                STATUSES.inc(status=status["status"])
+                row = rows.setdefault(status["id"], dict(
+                    provider_id=status["id"], recipient=status.get("recipient_id"), status=code,
+                    sent=None, delivered=None, read=None, failed=None, error=None,
+                ))
+                row["status"] = max(row["status"], code)
+                if row[status["status"]] is None or reported < row[status["status"]]:
+                    row[status["status"]] = reported
+                if status.get("errors"):
+                    row["error"] = status["errors"][0].get("code")
+        return list(rows.values())
+
+
+status_tracker = StatusTracker()
@@ -0,0 +1,163 @@
+"""Registry of the WhatsApp numbers and Messenger pages served by one deployment.
+
+Each tenant is one number or page, usually one per target language. Tenants
+are read from the TENANTS environment variable or the TENANTS_FILE JSON file:
+
+    [
+        {"name": "english", "channel": "whatsapp", "id": "105582068896304", "token_env": "TOKEN", "prefix": ""},
+        {"name": "portuguese", "channel": "whatsapp", "id": "105582068896305", "token_env": "TOKEN_PT",
+         "language": "Portuguese"},
+        {"name": "english-page", "channel": "messenger", "id": "109100192122534", "token_env": "MESSENGER_API_KEY",
+         "prefix": "messenger:"}
+    ]
+
+`id` is the phone number id or page id that webhooks are routed by. The
+token is given directly as `token` or read from the variable named by
+`token_env`. `prompt` replaces the tutor prompt for `language`. Voice notes
+are transcribed in `transcribe_language`, a Whisper code, by default the code
+of `language`. Conversations are stored under `prefix` + the sender's id, by
+default `<name>:`, so the same learner keeps a separate history with every
+tutor. No prefix may start another one, except the empty prefix: keys are
+split by their longest matching prefix, and a bare sender id never starts
+with a tenant's prefix.
+
+Without either variable the deployment serves the single number and page
+configured by TOKEN, PHONE_NUMBER_ID, MESSENGER_API_KEY and MESSENGER_PAGE_ID,
+with the conversation keys used before tenants existed.
+
+All tenants share one pooled HTTP session for the Graph API, and the media
+queue, transcription pipeline and database engine.
+"""
+import json
+import logging
+from os import environ
+from typing import Dict, List, Optional, Tuple
+
+from bot import LEARNING_MODE
+import facebook
+import graph
+from heyoo import WhatsApp
+from transcribe import language_code
+
+CHANNELS = ("whatsapp", "messenger")
+
+
+class Tenant:
+    def __init__(
+        self,
+        name: str,
+        channel: str,
+        id: str,
+        token: Optional[str],
+        language: str = LEARNING_MODE,
+        prompt: Optional[str] = None,
+        prefix: Optional[str] = None,
+        transcribe_language: Optional[str] = None,
+    ):
+        if channel not in CHANNELS:
+            raise ValueError(f"Unknown channel {channel} for tenant {name}, expected one of {', '.join(CHANNELS)}")
+        self.name = name
+        self.channel = channel
+        self.id = id
+        self.token = token
+        self.language = language
+        self.prompt = prompt
+        self.transcribe_language = transcribe_language or language_code(language)
+        self.prefix = f"{name}:" if prefix is None else prefix
+        self.client: Optional[WhatsApp] = None
+        if channel == "whatsapp":
+            self.client = WhatsApp(token, phone_number_id=id, graph_url=graph.GRAPH_API_URL, session=graph.session)
+
+    def conversation_key(self, sender_id: str) -> str:
+        """Key the sender's conversation with this tenant is stored under."""
+        return f"{self.prefix}{sender_id}"
+
+    def __repr__(self) -> str:
+        return f"Tenant({self.name!r}, {self.channel!r}, {self.id!r})"
+
+
+class TenantRegistry:
+    def __init__(self, tenants: List[Tenant]):
+        self.tenants = tenants
+        self._by_id: Dict[Tuple[str, str], Tenant] = {}
+        for tenant in tenants:
+            if (tenant.channel, tenant.id) in self._by_id:
+                raise ValueError(f"Tenants {self._by_id[tenant.channel, tenant.id].name} and {tenant.name} share {tenant.channel} id {tenant.id}")
+            self._by_id[tenant.channel, tenant.id] = tenant
+        for tenant in tenants:
+            for other in tenants:
+                # with two such prefixes, the conversations of one tenant would be split as the other's
+                if other is not tenant and other.prefix.startswith(tenant.prefix) and (
+                    tenant.prefix or other.prefix == tenant.prefix
+                ):
+                    raise ValueError(
+                        f"Tenants {tenant.name} and {other.name} have conflicting prefixes {tenant.prefix!r} and {other.prefix!r}"
+                    )
+        # longest prefix first, so that "portuguese:" wins over the empty prefix of a default number
+        self._by_prefix = sorted(tenants, key=lambda tenant: -len(tenant.prefix))
+
+    def get(self, channel: str, id: str) -> Optional[Tenant]:
+        return self._by_id.get((channel, id))
+
+    def for_whatsapp_webhook(self, data: Dict) -> Optional[Tenant]:
+        """The tenant whose number received a WhatsApp webhook."""
+        try:
+            phone_number_id = data["entry"][0]["changes"][0]["value"]["metadata"]["phone_number_id"]
+        except (KeyError, IndexError, TypeError):
+            return None
+        return self.get("whatsapp", phone_number_id)
+
+    def for_messenger_webhook(self, data: Dict) -> Optional[Tenant]:
+        """The tenant whose page received a Messenger webhook."""
+        try:
+            page_id = data["entry"][0]["id"]
+        except (KeyError, IndexError, TypeError):
+            return None
+        return self.get("messenger", page_id)
+
+    def split_key(self, key: str) -> Tuple[Optional[Tenant], str]:
+        """Returns the tenant and sender of a conversation key."""
+        for tenant in self._by_prefix:
+            if key.startswith(tenant.prefix):
+                return tenant, key[len(tenant.prefix):]
+        return None, key
+
+    @classmethod
+    def from_config(cls, config: List[Dict]) -> "TenantRegistry":
+        tenants = []
+        for entry in config:
+            token = entry.get("token") or environ.get(entry.get("token_env", ""))
+            if not token:
+                logging.warning("Tenant %s has no token", entry["name"])
+            tenants.append(Tenant(
+                entry["name"],
+                entry["channel"],
+                str(entry["id"]),
+                token,
+                language=entry.get("language", LEARNING_MODE),
+                prompt=entry.get("prompt"),
+                prefix=entry.get("prefix"),
+                transcribe_language=entry.get("transcribe_language"),
+            ))
+        return cls(tenants)
+
+    @classmethod
+    def from_environment(cls) -> "TenantRegistry":
+        if environ.get("TENANTS"):
+            return cls.from_config(json.loads(environ["TENANTS"]))
+        if environ.get("TENANTS_FILE"):
+            with open(environ["TENANTS_FILE"]) as file:
+                return cls.from_config(json.load(file))
+
+        # a single number and page, stored under the keys used before tenants existed
+        tenants = []
+        if environ.get("PHONE_NUMBER_ID"):
+            tenants.append(Tenant("whatsapp", "whatsapp", environ["PHONE_NUMBER_ID"], environ.get("TOKEN"), prefix=""))
+        tenants.append(Tenant(
+            "messenger", "messenger", facebook.MESSENGER_PAGE_ID, facebook.MESSENGER_API_KEY,
+            prefix=facebook.conversation_key(""),
+        ))
+        return cls(tenants)
+
+
+tenant_registry = TenantRegistry.from_environment()
@@ -0,0 +1,25 @@
+import os
+import tempfile
+
+# every test run gets its own database, set before db.py creates the engine
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="gringolingo-tests-"), "test.db"))
+
+import pytest  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+
+import db  # noqa: E402
+from cache import conversation_cache  # noqa: E402
+
+
+@pytest.fixture
+def database():
+    """An empty, migrated database, emptied again after the test."""
+    db.init_db()
+    yield db
+    with db.engine.begin() as connection:
+        for table in reversed(db.Base.metadata.sorted_tables):
+            connection.execute(table.delete())
+        if db.MessageIndex.enabled:
+            connection.execute(text("DELETE FROM messages_fts"))
+    db.User._ids.clear()
+    conversation_cache.invalidate()
@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta
+
+from archive import archive
+from db import ArchivedMessages, Message, MessageType, OutboxMessage, OutboxStatus, Session, User
+
+START = datetime(2023, 3, 1, 12)
+
+
+def session_with_reset(phone_id, before, after, reset_at):
+    for i in range(before):
+        Message.add_message(phone_id, f"antes {i}", MessageType.user_message, START + timedelta(minutes=i))
+    Message.add_message(phone_id, "/reset", MessageType.bot_command_message, START + timedelta(minutes=reset_at))
+    for i in range(after):
+        Message.add_message(phone_id, f"depois {i}", MessageType.user_message, START + timedelta(minutes=reset_at + 1 + i))
+
+
+def live(phone_id):
+    with Session() as session:
+        return [content for content, in session.query(Message.content).filter(Message.user_id == User.get_id(phone_id)).order_by(Message.id)]
+
+
+def test_closed_sessions_are_archived_per_user(database):
+    session_with_reset("5511", before=5, after=2, reset_at=10)
+    session_with_reset("5522", before=3, after=1, reset_at=4)
+    Message.add_message("5533", "sem reset", MessageType.user_message, START)
+
+    assert archive(closed_sessions=True, batch_size=2, pause=0) == 8
+    assert live("5511") == ["/reset", "depois 0", "depois 1"]
+    assert live("5522") == ["/reset", "depois 0"]
+    assert live("5533") == ["sem reset"]
+    assert [m.content for m in ArchivedMessages.get_messages(User.get_id("5511"))] == [f"antes {i}" for i in range(5)]
+
+
+def test_older_than_archives_users_without_a_reset(database):
+    session_with_reset("5511", before=2, after=2, reset_at=10)
+    Message.add_message("5533", "velha", MessageType.user_message, START)
+    Message.add_message("5533", "nova", MessageType.user_message, START + timedelta(days=10))
+
+    assert archive(older_than=START + timedelta(minutes=12), closed_sessions=True, pause=0) == 5
+    assert live("5511") == ["depois 1"]
+    assert live("5533") == ["nova"]
+
+
+def test_max_batches_bounds_the_run(database):
+    session_with_reset("5511", before=5, after=0, reset_at=10)
+
+    assert archive(closed_sessions=True, batch_size=2, max_batches=2, pause=0) == 4
+    assert len(live("5511")) == 2
+
+
+def test_replies_waiting_in_the_outbox_are_not_archived(database):
+    outbox = {"shard": 0, "channel": "whatsapp", "tenant": "1", "recipient": "5511"}
+    Message.add_message("5511", "olá", MessageType.user_message, START)
+    Message.add_message("5511", "ainda não enviada", MessageType.bot_message, START, outbox=outbox)
+    Message.add_message("5511", "enviada", MessageType.bot_message, START, outbox=outbox)
+    with Session() as session:
+        sent = session.query(Message.id).filter(Message.content == "enviada").scalar()
+        session.query(OutboxMessage).filter(OutboxMessage.message_id == sent).update({"status": OutboxStatus.sent})
+        session.commit()
+
+    assert archive(older_than=START + timedelta(days=1), pause=0) == 2
+    assert live("5511") == ["ainda não enviada"]
+    assert [reply["content"] for reply in OutboxMessage.get_pending([0])] == ["ainda não enviada"]
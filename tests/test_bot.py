@@ -0,0 +1,17 @@
+import bot
+
+
+def test_warmup_without_the_tokenizer_vocabulary_leaves_it_for_the_first_turn(monkeypatch, caplog):
+    calls = []
+    load = bot.get_encoding
+
+    def get_encoding():
+        calls.append(1)
+        if len(calls) == 1:
+            raise ConnectionError("openaipublic.blob.core.windows.net unreachable")
+        return load()
+
+    monkeypatch.setattr(bot, "get_encoding", get_encoding)
+    bot.warmup()
+    assert "tokenizer" in caplog.text
+    assert bot.get_num_tokens("olá") > 0
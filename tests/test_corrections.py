@@ -0,0 +1,44 @@
+import pytest
+
+from corrections import find_mistakes, is_correction
+
+
+@pytest.mark.parametrize("reply", [
+    "Small correction: 'I went home yesterday'. What did you do there?",
+    "We say 'I went', not 'I goed'. Where did you go?",
+    "It should be 'she doesn't like it'.",
+    "You can say 'I have been' instead of 'I have be'.",
+    "Pequena correção: 'eu fui ao mercado'.",
+    "O correto é 'nós fomos'. E depois?",
+    "Em vez de 'eu sou com fome', dizemos 'eu estou com fome'.",
+])
+def test_corrections(reply):
+    assert is_correction(reply)
+
+
+@pytest.mark.parametrize("reply", [
+    "That is correct! What else did you do?",
+    "You used the past tense correctly!",
+    "Perfect, your sentence is grammatically correct.",
+    "Isso mesmo, está correto! E você?",
+    "Great job! Tell me more about your weekend.",
+])
+def test_praise_is_not_a_correction(reply):
+    assert not is_correction(reply)
+    assert find_mistakes("I went to the beach", reply) == []
+
+
+def test_mistakes_are_the_replaced_words():
+    assert find_mistakes("I goed home yesterday", "Small correction: 'I went home yesterday'.") == ["goed"]
+
+
+def test_mistakes_from_a_quoted_mistake():
+    assert find_mistakes("Yesterday I goed to the park with friends", "We say 'I went', not 'I goed'.") == ["goed"]
+
+
+def test_apostrophes_inside_words_are_not_quotes():
+    assert find_mistakes("I dont like it", "Small correction: 'I don't like it'.") == ["dont"]
+
+
+def test_rewrites_are_not_attributed_to_words():
+    assert find_mistakes("me like beach much very", "It should be 'I really like the beach'.") == []
@@ -0,0 +1,32 @@
+import os
+import subprocess
+import sys
+
+import db
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_workers_of_an_initialized_database_do_not_migrate(database, monkeypatch):
+    def migrate(*args, **kwargs):
+        raise AssertionError("migrated in a worker")
+
+    monkeypatch.setenv("DATABASE_INITIALIZED", "1")
+    monkeypatch.setattr(db, "_initialized", False)
+    monkeypatch.setattr(db.Base.metadata, "create_all", migrate)
+    monkeypatch.setattr(db, "add_last_active", migrate)
+    monkeypatch.setattr(db.MessageIndex, "create", migrate)
+    monkeypatch.setattr(db.MessageIndex, "enabled", False)
+
+    db.init_db()
+    # the index the master created is used
+    assert db.MessageIndex.enabled
+
+
+def test_importing_the_app_opens_no_database(tmp_path):
+    path = tmp_path / "untouched.db"
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{path}")
+    code = f"import sys; sys.path.insert(0, {ROOT!r}); import app"
+    result = subprocess.run([sys.executable, "-c", code], env=env, cwd=tmp_path, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert not path.exists()
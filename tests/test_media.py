@@ -0,0 +1,32 @@
+import requests
+
+from heyoo import WhatsApp
+
+
+class FakeSession:
+    """Answers every GET with one status code and body."""
+
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+
+    def get(self, url, **kwargs):
+        response = requests.Response()
+        response.status_code = self.status_code
+        response._content = self.body
+        response._content_consumed = True
+        return response
+
+
+def test_media_is_saved_to_disk(tmp_path):
+    client = WhatsApp("token", "111", session=FakeSession(200, b"OggS audio"))
+    path = client.download_media("https://lookaside.fbsbx.com/media", "audio/ogg; codecs=opus", str(tmp_path / "m1"))
+    assert path == str(tmp_path / "m1.ogg")
+    assert (tmp_path / "m1.ogg").read_bytes() == b"OggS audio"
+
+
+def test_error_responses_are_not_saved_as_media(tmp_path):
+    body = b'{"error": {"message": "URL signature expired", "code": 190}}'
+    client = WhatsApp("token", "111", session=FakeSession(404, body))
+    assert client.download_media("https://lookaside.fbsbx.com/media", "audio/ogg", str(tmp_path / "m1")) is None
+    assert list(tmp_path.iterdir()) == []
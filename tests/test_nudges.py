@@ -0,0 +1,37 @@
+from datetime import datetime
+
+from db import Nudge, NudgeStatus, Session, User
+import nudges
+
+
+def nudge(phone_id, status, content=None, last_active=None, since=None):
+    user_id = User.get_id(phone_id, create=True)
+    last_active = last_active or datetime(2023, 3, 1, 12)
+    with Session() as session:
+        session.query(User).filter(User.id == user_id).update({User.last_active: last_active})
+        session.add(Nudge(user_id=user_id, since=since or last_active, status=status, content=content))
+        session.commit()
+
+
+def statuses():
+    with Session() as session:
+        return dict(session.query(User.phone_id, Nudge.status).join(User, User.id == Nudge.user_id))
+
+
+def test_failed_nudges_are_retried_from_the_step_that_failed(database):
+    nudge("5511", NudgeStatus.failed)
+    nudge("5522", NudgeStatus.failed, content="Oi! Vamos praticar?")
+    nudge("5533", NudgeStatus.sent, content="Oi!")
+
+    assert nudges.retry_failed(datetime(2023, 2, 1)) == 2
+    assert statuses() == {"5511": NudgeStatus.pending, "5522": NudgeStatus.generated, "5533": NudgeStatus.sent}
+
+
+def test_failed_nudges_are_not_retried_once_obsolete(database):
+    # the learner wrote again after the nudge failed
+    nudge("5511", NudgeStatus.failed, content="Oi!", since=datetime(2023, 3, 1), last_active=datetime(2023, 3, 5))
+    # the learner has been inactive for longer than --max-days
+    nudge("5522", NudgeStatus.failed, content="Oi!", last_active=datetime(2023, 1, 1))
+
+    assert nudges.retry_failed(datetime(2023, 2, 1)) == 0
+    assert set(statuses().values()) == {NudgeStatus.failed}
@@ -0,0 +1,128 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import pytest
+
+from db import Message, MessageType, OutboxMessage, OutboxStatus, Session
+from outbox import DeliveryError, Outbox
+from shards import shard_of, shard_queue
+
+
+class FakeGraph:
+    """Sender that fails the messages it is told to, and records what it sent."""
+
+    def __init__(self):
+        self.sent = []
+        self.failing = set()
+
+    def __call__(self, tenant, recipient, content):
+        if content in self.failing:
+            raise DeliveryError("(#131000) Something went wrong")
+        self.sent.append((recipient, content))
+        return f"wamid.{len(self.sent)}"
+
+
+@pytest.fixture
+def graph():
+    return FakeGraph()
+
+
+@pytest.fixture
+def outbox(database, graph):
+    box = Outbox(senders=4, batch_size=100, backoff=60, max_backoff=60, batch_timeout=5)
+    box.add_sender("whatsapp", graph)
+    box._executor = ThreadPoolExecutor(4)
+    yield box
+    box._executor.shutdown(wait=True)
+
+
+def reply(key, content):
+    outbox = {"shard": shard_of(key, shard_queue.count), "channel": "whatsapp", "tenant": "1", "recipient": key}
+    Message.add_message(key, content, MessageType.bot_message, outbox=outbox)
+
+
+def statuses():
+    with Session() as session:
+        return {content: (row.status, row.attempts) for row, content in
+                session.query(OutboxMessage, Message.content).join(Message, Message.id == OutboxMessage.message_id)}
+
+
+def test_replies_are_sent_in_order(outbox, graph):
+    reply("5511", "primeira")
+    reply("5511", "segunda")
+    reply("5522", "outra")
+
+    assert outbox.deliver_pending() == 3
+    assert [content for recipient, content in graph.sent if recipient == "5511"] == ["primeira", "segunda"]
+    assert outbox.deliver_pending() == 0
+
+
+def test_failed_reply_holds_back_later_replies_to_the_same_learner(outbox, graph):
+    graph.failing.add("primeira")
+    reply("5511", "primeira")
+    reply("5511", "segunda")
+    reply("5522", "outra")
+
+    outbox.deliver_pending()
+    graph.failing.clear()
+    # the failed reply waits for its backoff, and the reply after it waits too
+    assert outbox.deliver_pending() == 0
+    assert statuses() == {
+        "primeira": (OutboxStatus.pending, 1),
+        "segunda": (OutboxStatus.pending, 0),
+        "outra": (OutboxStatus.sent, 1),
+    }
+    assert [content for recipient, content in graph.sent] == ["outra"]
+
+
+def test_replies_in_backoff_do_not_fill_the_batch(outbox, graph):
+    outbox.batch_size = 3
+    for i in range(5):
+        graph.failing.add(f"falha {i}")
+        reply(f"55{i:02}", f"falha {i}")
+    outbox.deliver_pending()
+    outbox.deliver_pending()
+    reply("5599", "nova")
+
+    assert outbox.deliver_pending() == 1
+    assert graph.sent == [("5599", "nova")]
+
+
+def test_due_retry_is_sent_before_later_replies(outbox, graph):
+    graph.failing.add("primeira")
+    reply("5511", "primeira")
+    reply("5511", "segunda")
+    outbox.deliver_pending()
+    graph.failing.clear()
+    with Session() as session:
+        session.query(OutboxMessage).update({OutboxMessage.next_attempt: time.time() - 1})
+        session.commit()
+
+    assert outbox.deliver_pending() == 2
+    assert [content for recipient, content in graph.sent] == ["primeira", "segunda"]
+
+
+def test_slow_send_does_not_hold_up_other_learners(outbox, graph):
+    release = threading.Event()
+
+    def sender(tenant, recipient, content):
+        if recipient == "5511":
+            release.wait(10)
+        return graph(tenant, recipient, content)
+
+    outbox.add_sender("whatsapp", sender)
+    outbox.batch_timeout = 0.2
+    reply("5511", "lenta")
+    reply("5522", "rapida")
+
+    assert outbox.deliver_pending() == 1
+    # the slow learner is not picked up again while its send is running
+    assert outbox.deliver_pending() == 0
+    release.set()
+    for _ in range(100):
+        if "5511" not in outbox._in_flight:
+            break
+        time.sleep(0.01)
+    assert statuses()["lenta"] == (OutboxStatus.sent, 1)
+    assert sorted(graph.sent) == [("5511", "lenta"), ("5522", "rapida")]
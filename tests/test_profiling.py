@@ -0,0 +1,29 @@
+import os
+
+from db import Turn
+from profiling import Profiler
+from shards import ShardedQueue, shard_of
+import shards
+
+
+def test_answered_turns_are_profiled(database, tmp_path, monkeypatch):
+    monkeypatch.setattr(shards, "profiler", Profiler(directory=str(tmp_path), sample_rate=1, format="folded"))
+    queue = ShardedQueue(count=4)
+    answered = []
+    queue.add_handler("whatsapp", lambda key, payload, turn_id: answered.append(key))
+    Turn.add_turn(shard_of("5511", 4), "5511", "whatsapp", {"text": "olá"})
+
+    turn, = Turn.get_pending(list(range(4)))
+    queue._answer(turn)
+    assert answered == ["5511"]
+    assert [name.startswith("turn-whatsapp-") and name.endswith(".folded") for name in os.listdir(tmp_path)] == [True]
+
+
+def test_turns_are_not_profiled_without_a_sample_rate_or_window(tmp_path):
+    profiler = Profiler(directory=str(tmp_path), secret="secret", sample_rate=0)
+    assert profiler.call("turn-whatsapp", lambda: 42) == 42
+    assert os.listdir(tmp_path) == []
+    profiler.open_window(60)
+    assert profiler.call("turn-whatsapp", lambda: 42) == 42
+    # the window and the profile
+    assert len(os.listdir(tmp_path)) == 2
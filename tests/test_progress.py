@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta
+
+from archive import archive
+from db import Message, MessageType, Session, User, UserMistake, UserStats
+
+START = datetime(2023, 3, 1, 12)
+
+
+def conversation(phone_id, days):
+    """One exchange per day, every other reply a correction of the learner's past tense."""
+    for day in range(days):
+        timestamp = START + timedelta(days=day)
+        Message.add_message(phone_id, "Yesterday I goed to the park", MessageType.user_message, timestamp)
+        reply = "We say 'I went', not 'I goed'. Who did you go with?" if day % 2 == 0 else "Nice! Who did you go with?"
+        Message.add_message(
+            phone_id, reply, MessageType.bot_message, timestamp + timedelta(seconds=5),
+            answers="Yesterday I goed to the park",
+        )
+
+
+def totals(phone_id):
+    stats, mistakes = UserStats.get_progress(phone_id)
+    return stats.messages, stats.corrections, stats.streak, stats.longest_streak, mistakes
+
+
+def test_totals_are_kept_up_to_date(database):
+    conversation("5511", 4)
+    assert totals("5511") == (4, 2, 4, 4, [("goed", 2)])
+
+
+def test_rebuild_matches_the_running_totals(database):
+    conversation("5511", 4)
+    conversation("5522", 3)
+    expected = totals("5511"), totals("5522")
+
+    assert UserStats.rebuild(batch_size=1) == 14
+    assert (totals("5511"), totals("5522")) == expected
+
+
+def test_rebuild_counts_archived_messages(database):
+    conversation("5511", 6)
+    expected = totals("5511")
+    assert archive(older_than=START + timedelta(days=3), pause=0) == 6
+
+    UserStats.rebuild()
+    assert totals("5511") == expected
+
+
+def test_rebuild_replaces_wrong_totals(database):
+    conversation("5511", 2)
+    user_id = User.get_id("5511")
+    with Session() as session:
+        session.get(UserStats, user_id).corrections = 99
+        session.add(UserMistake(user_id=user_id, word="park", count=5))
+        session.commit()
+
+    UserStats.rebuild()
+    assert totals("5511") == (2, 1, 2, 2, [("goed", 1)])
@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta
+
+from bot import get_review
+from db import Message, MessageIndex, MessageType, Session, User
+
+
+def store_unindexed(phone_id, contents):
+    # as a bulk import or a database from before the index, which write no index rows
+    user_id = User.get_id(phone_id, create=True)
+    start = datetime(2023, 1, 1)
+    with Session() as session:
+        session.add_all(
+            Message(user_id=user_id, content=content, timestamp=start + timedelta(minutes=i), message_type=MessageType.user_message)
+            for i, content in enumerate(contents)
+        )
+        session.commit()
+
+
+def test_index_pending_indexes_older_messages_after_a_live_one(database):
+    store_unindexed("5511", ["eu fui ao mercado", "ela comeu a maçã"])
+    Message.add_message("5511", "nós fomos à praia", MessageType.user_message)
+
+    assert MessageIndex.index_pending() == 2
+    assert [m.content for m in MessageIndex.search("5511", "mercado")] == ["eu fui ao mercado"]
+    assert [m.content for m in MessageIndex.search("5511", "maca")] == ["ela comeu a maçã"]
+
+
+def test_index_pending_is_idempotent_and_batched(database):
+    store_unindexed("5511", [f"frase numero {i}" for i in range(25)])
+
+    assert MessageIndex.index_pending(batch_size=10) == 25
+    assert MessageIndex.index_pending(batch_size=10) == 0
+    assert len(MessageIndex.search("5511", "frase", limit=100)) == 25
+
+
+def test_index_pending_skips_non_searchable_messages(database):
+    user_id = User.get_id("5511", create=True)
+    with Session() as session:
+        session.add(Message(user_id=user_id, content="/reset", timestamp=datetime.now(), message_type=MessageType.user_command))
+        session.commit()
+
+    assert MessageIndex.index_pending() == 0
+
+
+def test_search_without_the_index_scans_live_messages(database, monkeypatch):
+    monkeypatch.setattr(MessageIndex, "enabled", False)
+    Message.add_message("5511", "Eu fui ao Mercado", MessageType.user_message)
+    Message.add_message("5511", "Small correction: 'fui ao mercado'", MessageType.bot_message)
+    Message.add_message("5511", "100% certo", MessageType.user_message)
+    Message.add_message("5522", "mercado", MessageType.user_message)
+
+    found = MessageIndex.search("5511", "mercado")
+    assert [m.content for m in found] == ["Small correction: 'fui ao mercado'", "Eu fui ao Mercado"]
+    assert MessageIndex.get_reply("5511", found[1].id).content == "Small correction: 'fui ao mercado'"
+    assert [m.content for m in MessageIndex.search("5511", "0%")] == ["100% certo"]
+    assert MessageIndex.search("5511", "_") == []
+
+
+def test_review_lists_only_corrections(database):
+    Message.add_message("5511", "I goed to the beach", MessageType.user_message)
+    Message.add_message("5511", "Small correction: 'I went to the beach'. What did you do there?", MessageType.bot_message)
+    Message.add_message("5511", "I went to the beach again", MessageType.user_message)
+    Message.add_message("5511", "That is correct! Which beach?", MessageType.bot_message)
+
+    review = get_review("5511", "beach")
+    assert "Small correction" in review
+    assert "Which beach" not in review
@@ -0,0 +1,160 @@
+import importlib.util
+import os
+import threading
+import time
+
+import pytest
+
+from cache import conversation_cache
+from db import Session, ShardLease, Turn
+from shards import ShardedQueue, shard_of
+
+
+def queue(worker_index=0, workers=1, owner="host:1", count=4, lease_seconds=30):
+    shards = ShardedQueue(count=count, threads=2, poll_interval=0.01, batch_size=10, lease_seconds=lease_seconds)
+    shards.assign(worker_index, workers)
+    shards.owner = owner
+    return shards
+
+
+def key_in(shard, count=4):
+    return next(key for key in (f"55{i}" for i in range(1000)) if shard_of(key, count) == shard)
+
+
+def add_turn(key, text="olá", kind="whatsapp", count=4):
+    return Turn.add_turn(shard_of(key, count), key, kind, {"text": text})
+
+
+def load_gunicorn_conf():
+    spec = importlib.util.spec_from_file_location("gunicorn_conf", os.path.join(os.path.dirname(__file__), "..", "gunicorn.conf.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_assign_checks_the_index():
+    shards = ShardedQueue(count=4)
+    with pytest.raises(ValueError):
+        shards.assign(2, 2)
+    shards.assign(1, 2)
+    assert shards.owned() == [1, 3]
+
+
+def test_reload_reuses_the_index_of_the_worker_being_replaced():
+    conf = load_gunicorn_conf()
+
+    class Worker:
+        pass
+
+    class Server:
+        num_workers = 2
+        WORKERS = {}
+
+    for pid in range(1, 5):
+        worker = Worker()
+        conf.pre_fork(Server, worker)
+        Server.WORKERS[pid] = worker
+    # two old workers and, during the reload, two new ones
+    assert [worker.shard_index for worker in Server.WORKERS.values()] == [0, 1, 0, 1]
+    # the old worker with index 0 stopped, its replacement takes index 0 again
+    del Server.WORKERS[3]
+    worker = Worker()
+    conf.pre_fork(Server, worker)
+    assert (worker.shard_index, worker.shard_workers) == (0, 2)
+
+
+def test_a_shard_is_leased_to_one_worker(database):
+    old, new = queue(0, 2, "host:1"), queue(0, 2, "host:2")
+    now = time.time()
+    assert old._lease([], now) == []
+    assert old._held.keys() == {0, 2}
+    # started by a reload while the old worker still holds the shards
+    assert new._lease([0, 2], now) == []
+    assert new._held == {}
+
+    ShardLease.release([0, 2], "host:1")
+    assert new._lease([0], now + 1) == [0]
+    assert ShardLease.acquire([0], "host:1", now + 60) == []
+
+
+def test_workers_disagreeing_on_their_number_never_share_a_shard(database):
+    # after TTIN, an old worker prefers the shards of 2 workers and the new one those of 3
+    old, new = queue(0, 2, "host:1", count=6), queue(2, 3, "host:2", count=6)
+    now = time.time()
+    old._lease([], now)
+    new._lease([], now)
+    assert old._held.keys() == {0, 2, 4}
+    assert new._held.keys() == {5}
+
+
+def test_shards_nobody_prefers_are_taken_once_their_lease_expired(database):
+    # after TTOU, no worker prefers shard 1 of the one that was stopped, which died without releasing it
+    now = time.time()
+    ShardLease.acquire([1], "host:9", now + 30)
+    shards = queue(0, 2, "host:1")
+    assert shards._lease([1], now + 31) == []
+    assert shards._lease([1], now + 61) == [1]
+    # given back once it has no turns, its lease is not renewed
+    assert 1 not in shards._lease([], now + 72)
+    assert 1 not in shards._held
+
+
+def test_taking_a_shard_drops_its_cached_conversations(database):
+    shards = queue(0, 2)
+    key = key_in(0)
+    conversation_cache.put(key, [{"role": "user", "content": "olá"}])
+    shards._lease([])
+    assert conversation_cache.get(key) is None
+
+
+def test_answer_runs_the_handler_and_deletes_the_turn(database):
+    shards = queue()
+    answered = []
+    shards.add_handler("whatsapp", lambda key, payload, turn_id: answered.append((key, payload, turn_id)))
+    id = add_turn("5511")
+    turn, = Turn.get_pending([shard_of("5511", 4)])
+
+    shards._answer(turn)
+    assert answered == [("5511", {"text": "olá"}, id)]
+    assert Turn.count_pending() == 0
+
+
+def test_failing_or_unknown_turns_do_not_block_the_queue(database):
+    shards = queue()
+
+    def fail(key, payload, turn_id):
+        raise RuntimeError("OpenAI is down")
+
+    shards.add_handler("whatsapp", fail)
+    add_turn("5511")
+    add_turn("5511", kind="fax")
+    for turn in Turn.get_pending(list(range(4))):
+        shards._answer(turn)
+    assert Turn.count_pending() == 0
+
+
+def test_turns_of_one_learner_are_answered_in_order_one_at_a_time(database):
+    shards = queue()
+    answering = threading.Lock()
+    answered = []
+
+    def handler(key, payload, turn_id):
+        assert answering.acquire(blocking=False), "two turns of one learner answered at once"
+        time.sleep(0.005)
+        answered.append(payload["text"])
+        answering.release()
+
+    shards.add_handler("whatsapp", handler)
+    key = key_in(1)
+    for i in range(5):
+        shards.submit(key, "whatsapp", {"text": str(i)})
+    for _ in range(200):
+        if len(answered) == 5:
+            break
+        time.sleep(0.01)
+    shards.stop(timeout=1)
+
+    assert answered == ["0", "1", "2", "3", "4"]
+    with Session() as session:
+        # released on exit, so that the next worker takes the shards at once
+        assert all(lease.expires == 0 for lease in session.query(ShardLease))
@@ -0,0 +1,67 @@
+import json
+
+from db import MessageStatus, Session
+from statuses import StatusTracker
+
+
+def callback(*statuses):
+    return json.dumps({"object": "whatsapp_business_account", "entry": [{"changes": [{
+        "field": "messages",
+        "value": {"metadata": {"phone_number_id": "111"}, "statuses": [
+            dict(id=id, status=status, timestamp=str(timestamp), recipient_id="5511", **extra)
+            for id, status, timestamp, extra in statuses
+        ]},
+    }]}]}).encode()
+
+
+def stored():
+    with Session() as session:
+        return {
+            row.provider_id: (
+                row.status, *(int(t.timestamp()) if t else None for t in (row.sent, row.delivered, row.read, row.failed)),
+                row.error,
+            )
+            for row in session.query(MessageStatus)
+        }
+
+
+def test_furthest_status_wins_and_steps_keep_their_first_time(database):
+    tracker = StatusTracker(batch_size=1)
+    tracker.add(callback(("wamid.A", "read", 1030, {})))
+    tracker.add(callback(("wamid.A", "sent", 1000, {}), ("wamid.B", "sent", 1001, {})))
+    assert tracker.flush() == 2
+
+    # duplicates and late callbacks in a later flush
+    tracker.add(callback(("wamid.A", "delivered", 1010, {}), ("wamid.A", "delivered", 1020, {})))
+    tracker.add(callback(("wamid.A", "sent", 990, {})))
+    tracker.add(callback(("wamid.B", "failed", 1005, {"errors": [{"code": 131047}]})))
+    tracker.flush()
+
+    assert stored() == {
+        "wamid.A": (3, 1000, 1010, 1030, None, None),
+        "wamid.B": (4, 1001, None, None, 1005, 131047),
+    }
+
+
+def test_malformed_and_unknown_statuses_are_dropped(database):
+    tracker = StatusTracker()
+    tracker.add(b"{not json")
+    tracker.add(callback(("wamid.A", "deleted", 1000, {}), ("", "sent", 1000, {})))
+    assert tracker.flush() == 0
+    assert stored() == {}
+
+
+def test_buffer_is_bounded(database):
+    tracker = StatusTracker(buffer_size=2)
+    tracker._thread = object()  # keep the flusher from starting
+    for i in range(5):
+        tracker.add(callback((f"wamid.{i}", "sent", 1000, {})))
+    assert tracker.flush() == 2
+
+
+def test_status_with_a_malformed_timestamp_is_dropped_alone(database):
+    tracker = StatusTracker()
+    tracker.add(callback(("wamid.A", "sent", "yesterday", {}), ("wamid.B", "sent", 1000, {})))
+    tracker.add(callback(("wamid.C", "read", 1001, {})))
+    assert tracker.flush() == 2
+    assert stored().keys() == {"wamid.B", "wamid.C"}
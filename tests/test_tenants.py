@@ -0,0 +1,26 @@
+import pytest
+
+from tenants import Tenant, TenantRegistry
+
+
+def tenant(name, prefix, channel="messenger", language="English", **kwargs):
+    return Tenant(name, channel, name, "token", language=language, prefix=prefix, **kwargs)
+
+
+def test_keys_are_split_by_prefix():
+    registry = TenantRegistry([tenant("english", ""), tenant("portuguese", "portuguese:"), tenant("page", "messenger:")])
+    assert [(t.name, sender) for t, sender in map(registry.split_key, ["5511", "portuguese:5511", "messenger:42"])] == [
+        ("english", "5511"), ("portuguese", "5511"), ("page", "42"),
+    ]
+
+
+@pytest.mark.parametrize("prefixes", [("pt:", "pt:"), ("pt", "pt2:"), ("", "")])
+def test_conflicting_prefixes_are_rejected(prefixes):
+    with pytest.raises(ValueError, match="conflicting prefixes"):
+        TenantRegistry([tenant("one", prefixes[0]), tenant("two", prefixes[1])])
+
+
+def test_transcription_language_follows_the_tenant():
+    assert tenant("english", "").transcribe_language == "en"
+    assert tenant("portuguese", "pt:", language="Portuguese").transcribe_language == "pt"
+    assert tenant("custom", "c:", language="Portuguese", transcribe_language="gl").transcribe_language == "gl"
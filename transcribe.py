@@ -0,0 +1,210 @@
+"""Speech-to-text for voice messages.
+
+Voice notes are transcribed in a separate process pool, a few at a time, so a
+burst of audio never competes with text turns for the web worker's CPU. The
+transcript of each note is handed to a callback, which feeds it to the bot as
+if the learner had typed it.
+
+Backends are chosen with TRANSCRIBE_BACKEND:
+    whisper: a local faster-whisper model (pip install faster-whisper, needs ffmpeg)
+    fake: returns TRANSCRIBE_FAKE_TEXT for every note, for tests and load tests
+"""
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import importlib.util
+import logging
+import os
+from os import environ
+import queue
+import shutil
+import subprocess
+from threading import BoundedSemaphore, Lock, Thread
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+TRANSCRIBE_BACKEND = environ.get("TRANSCRIBE_BACKEND", "whisper")
+TRANSCRIBE_MODEL = environ.get("TRANSCRIBE_MODEL", "base")
+# language of tenants whose language is not in LANGUAGE_CODES, detected from each note when unset
+TRANSCRIBE_LANGUAGE = environ.get("TRANSCRIBE_LANGUAGE") or None
+TRANSCRIBE_WORKERS = int(environ.get("TRANSCRIBE_WORKERS", 1))
+TRANSCRIBE_BATCH_SIZE = int(environ.get("TRANSCRIBE_BATCH_SIZE", 4))
+# seconds a note waits for others to fill its batch
+TRANSCRIBE_BATCH_WAIT = float(environ.get("TRANSCRIBE_BATCH_WAIT", 0.5))
+
+SAMPLE_RATE = 16000
+
+# Whisper codes of the languages tenants usually teach, see `language_code`
+LANGUAGE_CODES = {
+    "english": "en", "portuguese": "pt", "spanish": "es", "french": "fr", "german": "de", "italian": "it",
+    "dutch": "nl", "russian": "ru", "japanese": "ja", "korean": "ko", "chinese": "zh", "arabic": "ar",
+}
+
+
+def language_code(language: str) -> Optional[str]:
+    """The language a tenant's voice notes are transcribed in, from the language it teaches."""
+    return LANGUAGE_CODES.get(language.lower(), TRANSCRIBE_LANGUAGE)
+
+
+class Transcriber(ABC):
+    """Converts audio files to text. Instances live in the worker processes."""
+
+    @staticmethod
+    def available() -> bool:
+        """True if the backend's dependencies are installed."""
+        return True
+
+    @abstractmethod
+    def transcribe(self, path: str, language: Optional[str] = None) -> str:
+        """Returns the text of a note in `language`, a Whisper code, or detected when None."""
+
+
+class FakeTranscriber(Transcriber):
+    def __init__(self, text: str = None):
+        self.text = text if text is not None else environ.get("TRANSCRIBE_FAKE_TEXT", "Hello, how are you?")
+
+    def transcribe(self, path: str, language: Optional[str] = None) -> str:
+        return self.text
+
+
+class WhisperTranscriber(Transcriber):
+    @staticmethod
+    def available() -> bool:
+        return importlib.util.find_spec("faster_whisper") is not None and shutil.which("ffmpeg") is not None
+
+    def __init__(self, model: str = TRANSCRIBE_MODEL):
+        from faster_whisper import WhisperModel
+
+        self.model = WhisperModel(model, device="cpu", compute_type="int8")
+
+    def transcribe(self, path: str, language: Optional[str] = None) -> str:
+        segments, _ = self.model.transcribe(load_audio(path), language=language)
+        return " ".join(segment.text.strip() for segment in segments).strip()
+
+
+BACKENDS = {
+    "fake": FakeTranscriber,
+    "whisper": WhisperTranscriber,
+}
+
+
+def load_audio(path: str, chunk_size: int = 64 * 1024):
+    """Decodes any audio file to 16 kHz mono float32 samples.
+
+    ffmpeg transcodes and resamples in a pipe, so the PCM is read in chunks
+    while decoding runs rather than after writing a temporary WAV file.
+    """
+    import numpy as np
+
+    process = subprocess.Popen(
+        ["ffmpeg", "-nostdin", "-loglevel", "error", "-i", path, "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "-"],
+        stdout=subprocess.PIPE,
+    )
+    pcm = bytearray()
+    with process.stdout:
+        for chunk in iter(lambda: process.stdout.read(chunk_size), b""):
+            pcm.extend(chunk)
+    if process.wait() != 0:
+        raise RuntimeError(f"ffmpeg could not decode {path}")
+    return np.frombuffer(pcm, np.int16).astype(np.float32) / 32768.0
+
+
+# backend of the current worker process, loaded once by _init_worker
+_transcriber: Optional[Transcriber] = None
+
+def _init_worker(backend: str) -> None:
+    global _transcriber
+    # transcription is background work, let the web workers win the CPU
+    os.nice(10)
+    _transcriber = BACKENDS[backend]()
+
+def _transcribe_batch(notes: List[Tuple[str, Optional[str]]]) -> List[Optional[str]]:
+    transcripts = []
+    for path, language in notes:
+        try:
+            transcripts.append(_transcriber.transcribe(path, language))
+        except Exception:
+            logging.exception("Transcribing %s failed", path)
+            transcripts.append(None)
+    return transcripts
+
+
+# called with (phone_id, transcript, context) for every transcribed note, context as given to `submit`
+TranscriptHandler = Callable[[str, str, Dict], None]
+
+
+class VoicePipeline:
+    def __init__(
+        self,
+        on_transcript: TranscriptHandler,
+        backend: str = TRANSCRIBE_BACKEND,
+        workers: int = TRANSCRIBE_WORKERS,
+        batch_size: int = TRANSCRIBE_BATCH_SIZE,
+        batch_wait: float = TRANSCRIBE_BATCH_WAIT,
+    ):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown transcription backend {backend}, expected one of {', '.join(BACKENDS)}")
+        self.on_transcript = on_transcript
+        self.backend = backend
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+
+        self._queue: "queue.Queue[Tuple[str, str, Dict]]" = queue.Queue()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._replies: Optional[ThreadPoolExecutor] = None
+        # one batch per worker process at a time, notes arriving meanwhile join the next batch
+        self._in_flight = BoundedSemaphore(workers)
+        self._lock = Lock()
+
+    def submit(self, phone_id: str, media_type: str, path: str, context: Dict) -> None:
+        """Queues a downloaded voice note, can be registered as a `media.MediaQueue` handler.
+
+        Args:
+            context: handed to `on_transcript`, its "language" is the Whisper code to transcribe the note in
+        """
+        self._start()
+        self._queue.put((phone_id, path, context))
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self.backend,))
+                self._replies = ThreadPoolExecutor(self.workers * self.batch_size, thread_name_prefix="voice")
+                Thread(target=self._batch_loop, name="voice-batcher", daemon=True).start()
+
+    def _batch_loop(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            self._in_flight.acquire()
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            future = self._pool.submit(_transcribe_batch, [(path, context.get("language")) for _, path, context in batch])
+            future.add_done_callback(lambda future, batch=batch: self._dispatch(batch, future))
+
+    def _dispatch(self, batch: List[Tuple[str, str, Dict]], future: Future) -> None:
+        self._in_flight.release()
+        try:
+            transcripts = future.result()
+        except Exception:
+            logging.exception("Transcription batch of %d notes failed", len(batch))
+            return
+        for (phone_id, path, context), transcript in zip(batch, transcripts):
+            if transcript:
+                logging.info("Transcribed %s from %s", path, phone_id)
+                # replies call OpenAI, keep them off the pool's result thread
+                self._replies.submit(self._reply, phone_id, transcript, context)
+            else:
+                logging.warning("Empty transcript for %s from %s", path, phone_id)
+
+    def _reply(self, phone_id: str, transcript: str, context: Dict) -> None:
+        try:
+            self.on_transcript(phone_id, transcript, context)
+        except Exception:
+            logging.exception("Replying to the voice note of %s failed", phone_id)